@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+"""Run the same operations against each backend and report their latency and
+throughput side by side.
+
+Every backend gets its own copy of a seeded library, so writes made by one
+backend are never seen by another.
+
+$ ./benchmark.py --calibre /opt/calibre/calibredb --books 50 --iterations 20
+"""
+
+import argparse
+import logging
+import random
+import shutil
+import statistics
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+
+from calibre_rest.backend import BACKENDS, Backend, create_backend
+from calibre_rest.models import Book
+from config import Config
+
+# Operations run against each backend. Each takes the backend and the ids of
+# the seeded books.
+OPERATIONS = {
+    "get_book": lambda b, ids: b.get_book(random.choice(ids)),
+    "get_books": lambda b, ids: b.get_books(["title"], None, 1, 20),
+    "get_books_page": lambda b, ids: b.get_books(["-title"], None, 21, 20),
+    "search": lambda b, ids: b.get_books(None, ["tags:=benchmark"], 1, 20),
+    "count_books": lambda b, ids: b.count_books(["tags:=benchmark"]),
+    "show_metadata": lambda b, ids: b.show_metadata(random.choice(ids)),
+    "set_metadata": lambda b, ids: b.set_metadata(
+        random.choice(ids), Book(title=f"Book {random.random()}")
+    ),
+    "add_remove": lambda b, ids: b.remove(b.add_one_empty(Book(title="Temp"))),
+}
+
+
+def seed(calibredb: str, library: str, books: int) -> None:
+    """Create an empty library with the given number of books."""
+    config = {
+        **Config.config(),
+        "calibredb": calibredb,
+        "library": library,
+        "backend": "subprocess",
+    }
+    backend = create_backend(config)
+    for i in range(books):
+        backend.add_one_empty(
+            Book(title=f"Book {i:04}", authors=[f"Author {i % 7}"], tags=["benchmark"])
+        )
+
+
+def measure(backend: Backend, op, ids: list[int], iterations: int, threads: int):
+    """Run op iterations times on threads threads.
+
+    Returns:
+        list[float]: Latency of each run in seconds
+        float: Runs per second
+    """
+
+    def run(_):
+        start = time.perf_counter()
+        op(backend, ids)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        latencies = list(executor.map(run, range(iterations)))
+    return latencies, iterations / (time.perf_counter() - start)
+
+
+def benchmark(
+    calibredb: str,
+    backends: list[str],
+    books: int,
+    iterations: int,
+    threads: int,
+) -> dict:
+    """Benchmark each backend on its own copy of a seeded library.
+
+    Returns:
+        dict: Map of operation and backend to (p50 ms, p95 ms, runs per second)
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        seeded = path.join(tmp, "seeded")
+        shutil.copytree(
+            path.join(path.dirname(__file__), "tests/integration/testdata"), seeded
+        )
+        seed(calibredb, seeded, books)
+
+        for name in backends:
+            library = path.join(tmp, name)
+            shutil.copytree(seeded, library)
+
+            config = {
+                **Config.config(),
+                "calibredb": calibredb,
+                "library": library,
+                "backend": name,
+            }
+            backend = create_backend(config)
+            backend.check()
+            if backend.index is not None:
+                backend.index.load()
+
+            try:
+                ids = [b.id for b in backend.get_books()]
+                for op_name, op in OPERATIONS.items():
+                    latencies, throughput = measure(
+                        backend, op, ids, iterations, threads
+                    )
+                    quantiles = statistics.quantiles(latencies, n=20)
+                    results.setdefault(op_name, {})[name] = (
+                        statistics.median(latencies) * 1000,
+                        quantiles[-1] * 1000,
+                        throughput,
+                    )
+            finally:
+                if backend.worker is not None:
+                    backend.worker.close()
+
+    return results
+
+
+def report(results: dict, backends: list[str]) -> str:
+    """Format results as a table with one column per backend."""
+    width = 26
+    lines = [
+        f"{'operation':<16}"
+        + "".join(f"{name + ' p50/p95 ms, op/s':>{width}}" for name in backends)
+    ]
+    for op_name, by_backend in results.items():
+        cells = []
+        for name in backends:
+            p50, p95, throughput = by_backend[name]
+            cells.append(f"{f'{p50:.1f}/{p95:.1f}, {throughput:.1f}':>{width}}")
+        lines.append(f"{op_name:<16}" + "".join(cells))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("Benchmark calibre-rest backends")
+    parser.add_argument(
+        "-c",
+        "--calibre",
+        default=Config.get("calibredb"),
+        type=str,
+        help="Path to calibredb executable",
+    )
+    parser.add_argument(
+        "-b",
+        "--backend",
+        action="append",
+        choices=list(BACKENDS),
+        help="Backend to benchmark. Can be repeated. Defaults to all.",
+    )
+    parser.add_argument(
+        "-n", "--books", default=50, type=int, help="Number of books to seed"
+    )
+    parser.add_argument(
+        "-i",
+        "--iterations",
+        default=20,
+        type=int,
+        help="Number of runs of each operation",
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        default=1,
+        type=int,
+        help="Number of threads running operations concurrently",
+    )
+    args = parser.parse_args()
+    if args.iterations < 2:
+        parser.error("--iterations must be at least 2")
+
+    logging.basicConfig(level=logging.ERROR)
+    backends = args.backend or list(BACKENDS)
+    results = benchmark(
+        args.calibre, backends, args.books, args.iterations, args.threads
+    )
+    print(report(results, backends))
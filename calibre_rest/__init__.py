@@ -1,9 +1,15 @@
 import logging
+import os
+import sqlite3
+import tempfile
 
 from flask import Flask
 from gunicorn.app.base import BaseApplication
 
-from calibre_rest.calibre import CalibreWrapper
+from calibre_rest.backend import create_backend
+from calibre_rest.idempotency import IdempotencyStore
+from calibre_rest.jobs import JobQueue
+from calibre_rest.uploads import SpoolRequest, UploadStore
 from config import DevConfig
 
 __version__ = "0.1.0"
@@ -14,8 +20,8 @@ LOG_FORMAT = "%(asctime)s %(name)s - %(levelname)s - %(message)s"
 class GunicornApp(BaseApplication):
     defaults = {
         "bind": "localhost:5000",
-        # calibredb supports only one operation at any single time. Increasing
-        # the number of workers would result in concurrent execution errors.
+        # calibredb commands are serialized across workers by the wrapper's
+        # lock file, see CALIBRE_REST_LOCK_PATH
         "workers": 1,
         "backlog": 100,
         "worker_class": "sync",
@@ -41,6 +47,30 @@ class GunicornApp(BaseApplication):
         bind_addr = app_config.get("bind_addr")
         if bind_addr is not None:
             self.options["bind"] = bind_addr
+
+        workers = app_config.get("workers")
+        if workers is not None:
+            self.options["workers"] = workers
+
+        cdb = self.app.config["CALIBRE_WRAPPER"]
+        if cdb.worker is not None and self.options["workers"] > 1:
+            # the calibre worker holds calibre's library lock and its pipes
+            # cannot be shared by forked processes
+            self.app.logger.warning(
+                "The worker backend supports a single gunicorn worker. Setting workers to 1"
+            )
+            self.options["workers"] = 1
+
+        # connections opened while creating the app must not be shared by the
+        # forked workers, which open their own
+        cdb.close_connections()
+
+        jobs = self.app.config["JOB_QUEUE"]
+        if jobs is not None:
+            # threads do not survive the fork, so each worker starts a writer
+            # thread to run jobs queued before a restart. Only one of them
+            # runs jobs at a time, see JobQueue.
+            self.options["post_fork"] = lambda server, worker: jobs.start()
         super().__init__()
 
     def load_config(self):
@@ -58,6 +88,7 @@ class GunicornApp(BaseApplication):
 
 def create_app(config=None):
     app = Flask(__name__)
+    app.request_class = SpoolRequest
 
     if config is None:
         config = DevConfig()
@@ -80,16 +111,40 @@ def create_app(config=None):
     app.logger.debug(f"Server config: {config.config()}")
 
     try:
-        cdb = CalibreWrapper(
-            app.config["calibredb"],
-            app.config["library"],
-            app.config["username"],
-            app.config["password"],
-            flog,
-        )
+        cdb = create_backend(app.config, flog)
         cdb.check()
+        if cdb.worker is not None:
+            cdb.worker.start()
+        if cdb.index is not None:
+            cdb.index.load()
+        if cdb.fts is not None:
+            cdb.fts.refresh(force=True)
+        if cdb.hashes is not None:
+            cdb.hashes.load()
         app.config["CALIBRE_WRAPPER"] = cdb
-    except FileNotFoundError as exc:
+
+        # writes are run in the background if a job journal is configured
+        jobs = None
+        if app.config["jobs_path"]:
+            jobs = JobQueue(app.config["jobs_path"], cdb, flog)
+            jobs.recover()
+        app.config["JOB_QUEUE"] = jobs
+
+        spool_path = app.config["spool_path"]
+        if spool_path and not os.path.isdir(spool_path):
+            raise FileNotFoundError(f"Spool directory {spool_path} not found")
+        # resumable uploads are kept on the spool volume
+        uploads_path = os.path.join(
+            spool_path or tempfile.gettempdir(), "calibre-rest-uploads"
+        )
+        app.config["UPLOAD_STORE"] = UploadStore(uploads_path)
+
+        # responses replayed for retries with the same Idempotency-Key
+        idempotency_path = app.config["idempotency_path"] or os.path.join(
+            spool_path or tempfile.gettempdir(), "calibre-rest-idempotency.db"
+        )
+        app.config["IDEMPOTENCY_STORE"] = IdempotencyStore(idempotency_path)
+    except (FileNotFoundError, RuntimeError, ValueError, sqlite3.Error) as exc:
         # exit immediately if fail to initialize wrapper object
         raise SystemExit(exc)
 
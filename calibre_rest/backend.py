@@ -0,0 +1,242 @@
+import logging
+import re
+from datetime import datetime
+from os import path
+from typing import Callable, Iterator, Protocol, runtime_checkable
+
+from calibre_rest.calibre import CalibreWrapper
+from calibre_rest.content_server import ContentServerClient
+from calibre_rest.fts import FullTextIndex
+from calibre_rest.hashes import HashIndex
+from calibre_rest.index import BookIndex
+from calibre_rest.models import Book
+from calibre_rest.worker import CalibreWorker
+
+
+@runtime_checkable
+class Backend(Protocol):
+    """Operations the API needs from a calibre library.
+
+    See CalibreWrapper for the semantics of each operation. Every backend
+    returns the same data for the same library, which is checked by the
+    conformance tests in tests/integration/backend_test.py.
+
+    The optional components are None when they are not configured.
+    """
+
+    server: ContentServerClient | None
+    index: BookIndex | None
+    fts: FullTextIndex | None
+    hashes: HashIndex | None
+    worker: CalibreWorker | None
+
+    def check(self) -> None:
+        """Raise FileNotFoundError if the library cannot be used."""
+
+    def version(self) -> str:
+        ...
+
+    def lock_metrics(self) -> dict:
+        ...
+
+    def close_connections(self) -> None:
+        ...
+
+    def library_version(self) -> tuple[str, datetime]:
+        ...
+
+    def get_last_modified(self, id: int) -> str:
+        ...
+
+    def get_book(self, id: int, fields: list[str] = None) -> Book:
+        ...
+
+    def get_books(
+        self,
+        sort: list[str] = None,
+        search: list[str] = None,
+        start: int = 1,
+        limit: int = None,
+        fields: list[str] = None,
+    ) -> list[Book]:
+        ...
+
+    def iter_books(
+        self,
+        sort: list[str] = None,
+        search: list[str] = None,
+        fields: list[str] = None,
+    ) -> Iterator[Book]:
+        ...
+
+    def get_books_by_cursor(
+        self,
+        sort: list[str] = None,
+        search: list[str] = None,
+        cursor: str = "",
+        limit: int = 20,
+        fields: list[str] = None,
+    ) -> tuple[list[Book], str, str]:
+        ...
+
+    def search_text(
+        self,
+        q: str,
+        search: list[str] = None,
+        start: int = 1,
+        limit: int = None,
+        fields: list[str] = None,
+    ) -> tuple[list[Book], int]:
+        ...
+
+    def count_books(self, search: list[str] = None) -> int:
+        ...
+
+    def existing_ids(self, ids: list[int]) -> set[int]:
+        ...
+
+    def skip_duplicates(
+        self, hashes: list[str], book: Book = None, automerge: str = "ignore"
+    ) -> list[str] | None:
+        ...
+
+    def add_multiple(
+        self,
+        book_paths: list[str],
+        book: Book = None,
+        automerge: str = "ignore",
+        hashes: list[str] = None,
+    ) -> list[int]:
+        ...
+
+    def add_batch(
+        self,
+        book_paths: list[str],
+        book: Book = None,
+        automerge: str = "ignore",
+        hashes: list[str] = None,
+    ) -> tuple[dict[str, str], list[str]]:
+        ...
+
+    def add_one(
+        self, book_path: str, book: Book = None, automerge: str = "ignore"
+    ) -> list[int]:
+        ...
+
+    def add_one_empty(self, book: Book = None, automerge: str = "ignore") -> list[int]:
+        ...
+
+    def remove(self, ids: list[int], permanent: bool = False) -> None:
+        ...
+
+    def set_metadata(
+        self, id: int, book: Book = None, metadata_path: str = None
+    ) -> int:
+        ...
+
+    def update_book(self, id: int, book: Book, fields: list[str] = None) -> Book:
+        ...
+
+    def update_books(self, updates: list[tuple[int, Book]]) -> Iterator[dict]:
+        ...
+
+    def show_metadata(self, id: int) -> str:
+        ...
+
+    def export(
+        self, ids: list[int], exports_dir: str = "/exports", formats: list[str] = None
+    ) -> None:
+        ...
+
+
+def library_lock_path(config: dict) -> str:
+    """Get the path of the lock file that serializes calibredb across processes.
+
+    Defaults to .calibre-rest.lock in a library on the filesystem. A library on
+    calibre-server has no lock file unless one is configured, as the server
+    serializes writes itself.
+    """
+    if config["lock_path"]:
+        return config["lock_path"]
+    if re.match(r"^https?://", str(config["library"])) is not None:
+        return ""
+    return path.join(config["library"], ".calibre-rest.lock")
+
+
+def calibre_wrapper(
+    config: dict,
+    logger: logging.Logger = None,
+    read_engine: str = None,
+    worker: bool = False,
+) -> CalibreWrapper:
+    """Create the CalibreWrapper that every backend is a configuration of.
+
+    Args:
+        config (dict): Server config, see Config
+        logger (logging.Logger): Custom logger object
+        read_engine (str): Read engine, defaults to config["read_engine"]
+        worker (bool): Run calibredb in a persistent calibre worker
+    """
+    return CalibreWrapper(
+        config["calibredb"],
+        config["library"],
+        config["username"],
+        config["password"],
+        logger,
+        read_engine or config["read_engine"],
+        config["fts_path"],
+        worker=worker,
+        lock_path=library_lock_path(config),
+        hash_path=config["hash_path"],
+    )
+
+
+def subprocess_backend(config: dict, logger: logging.Logger = None) -> Backend:
+    """Run a calibredb process for every operation. Reads use the configured
+    read engine, which defaults to calibredb.
+    """
+    return calibre_wrapper(config, logger)
+
+
+def sqlite_backend(config: dict, logger: logging.Logger = None) -> Backend:
+    """Read books directly from metadata.db, or from the in-memory index if it
+    is the configured read engine. Writes run a calibredb process.
+
+    This is the subprocess backend with the read engine forced to sqlite
+    unless it is index.
+    """
+    read_engine = "index" if config["read_engine"] == "index" else "sqlite"
+    return calibre_wrapper(config, logger, read_engine)
+
+
+def worker_backend(config: dict, logger: logging.Logger = None) -> Backend:
+    """Run every calibredb operation in a persistent calibre worker process.
+    Reads use the configured read engine, which defaults to calibredb.
+    """
+    return calibre_wrapper(config, logger, worker=True)
+
+
+BACKENDS: dict[str, Callable[[dict, logging.Logger], Backend]] = {
+    "subprocess": subprocess_backend,
+    "sqlite": sqlite_backend,
+    "worker": worker_backend,
+}
+
+
+def create_backend(config: dict, logger: logging.Logger = None) -> Backend:
+    """Create the backend selected by config["backend"].
+
+    Args:
+        config (dict): Server config, see Config
+        logger (logging.Logger): Custom logger object
+
+    Returns:
+        Backend: Backend that is not checked or started yet
+
+    Raises:
+        ValueError: The backend is not supported
+    """
+    name = config["backend"]
+    if name not in BACKENDS:
+        raise ValueError(f'Backend "{name}" not supported')
+    return BACKENDS[name](config, logger)
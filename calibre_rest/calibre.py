@@ -1,18 +1,33 @@
+import codecs
+import itertools
 import json
 import logging
 import re
 import shlex
 import shutil
+import sqlite3
 import subprocess
-import threading
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timezone
 from os import path
+from typing import BinaryIO, Iterator
 
+from calibre_rest import search as search_parser
+from calibre_rest.content_server import ContentServerClient
 from calibre_rest.errors import (
     CalibreConcurrencyError,
     CalibreRuntimeError,
     ExistingItemError,
+    UnsupportedSearchError,
 )
-from calibre_rest.models import Book
+from calibre_rest.fts import FullTextIndex
+from calibre_rest.hashes import HashIndex, hash_file
+from calibre_rest.index import BookIndex
+from calibre_rest.lock import FileLock, ReadWriteLock
+from calibre_rest.models import Book, cursor_digest, decode_cursor, encode_cursor
+from calibre_rest.sqlite import SQLiteReader, chunks, db_version
+from calibre_rest.worker import SCRIPT, CalibreWorker
 
 
 class CalibreWrapper:
@@ -101,7 +116,21 @@ class CalibreWrapper:
         ".txtz",
     )
     AUTOMERGE_VALID_VALUES = ["overwrite", "new_record", "ignore"]
+    READ_ENGINES = ["calibredb", "sqlite", "index"]
 
+    # calibredb subcommands that never change the library, and the global
+    # options that precede the subcommand with a value
+    READ_ONLY_COMMANDS = ("list", "search", "show_metadata", "export", "--version")
+    GLOBAL_OPTIONS = ("--with-library", "--library-path", "--username", "--password")
+
+    # Size of the reads from a streamed calibredb list
+    STREAM_CHUNK_SIZE = 64 * 1024
+    # Number of ids in a single calibredb id search. calibre's search parser
+    # recurses once per "or" term, so long searches can exceed Python's
+    # recursion limit well before the argument reaches Linux's 128 KiB limit.
+    SEARCH_IDS_CHUNK_SIZE = 200
+
+    LIST_SEPARATOR_REGEX = re.compile(r"[\s\[\],]*")
     CONCURRENCY_ERR_REGEX = re.compile(r"^Another calibre program.*is running.")
     CALIBRE_VERSION_REGEX = re.compile(r"calibre ([\d.]+)")
     BOOK_ADDED_REGEX = re.compile(r"^Added book ids: ([0-9, ]+)")
@@ -117,6 +146,11 @@ class CalibreWrapper:
         username: str = "",
         password: str = "",
         logger: logging.Logger = None,
+        read_engine: str = "calibredb",
+        fts_path: str = "",
+        worker: bool = False,
+        lock_path: str = "",
+        hash_path: str = "",
     ) -> None:
         """Initialize the calibredb command-line wrapper.
 
@@ -124,25 +158,92 @@ class CalibreWrapper:
 
         Args:
             calibredb (str): Path to calibredb executable.
-            lib (str): Path to calibre library on the filesystem.
+            lib (str): Path to calibre library on the filesystem, or URL of a
+                library on a running calibre-server, e.g.
+                http://localhost:8080/#calibre. Books in a calibre-server
+                library are read from the server's JSON endpoints.
             username (str): calibre server username
             password (str): calibre server password
             logger (logging.Logger): Custom logger object
+            read_engine (str): Engine used to read books. One of "calibredb"
+                (default), "sqlite" or "index". The sqlite engine reads
+                metadata.db directly and falls back to calibredb on any
+                database error. The index engine additionally serves reads
+                from an in-memory BookIndex, which must be loaded with
+                index.load().
+            fts_path (str): Path to the side-car database of the full-text
+                index. The index is disabled if empty. It must be built with
+                fts.refresh().
+            worker (bool): Run calibredb commands in a persistent calibre
+                worker process started with the calibre-debug executable next
+                to calibredb, instead of starting calibredb for every command.
+            lock_path (str): Path to a lock file that serializes calibredb
+                commands across processes, such as several gunicorn workers
+                serving the same library. Disabled if empty.
+            hash_path (str): Path to the side-car database of the hash index
+                of the library's files, used to skip uploads of files that
+                are already in the library. Disabled if empty. It must be
+                built with hashes.load().
         """
         if logger is None:
             logger = logging.getLogger(__name__)
         self.logger = logger
 
         self.cdb = path.abspath(calibredb)
-        self.lib = path.abspath(lib)
+
+        self.server = None
+        if re.match(r"^https?://", str(lib)) is not None:
+            if read_engine != "calibredb" or fts_path or hash_path:
+                raise ValueError(
+                    "The sqlite and index read engines, full-text search and "
+                    "the hash index require a library on the filesystem"
+                )
+            self.server = ContentServerClient(lib, username, password, self.logger)
+            self.lib = lib
+        else:
+            self.lib = path.abspath(lib)
         self.cdb_with_lib = f"{self.cdb} --with-library {self.lib}"
 
         if username != "" and password != "":
             self.cdb_with_lib += f" --username {username} --password {password}"
 
-        # It is safer to limit calibredb to running one operation at any given
-        # time. Any concurrent requests will result in calibre complaining.
-        self.mutex = threading.Lock()
+        # Mutating calibredb commands always run alone. calibredb refuses to
+        # open a local library that another calibre program has open, so read
+        # commands only share the lock when they run against a calibre-server
+        # library or in the worker, which queues them itself.
+        self.mutex = ReadWriteLock()
+        self.concurrent_reads = self.server is not None or worker
+        # the same rules apply across processes when a lock file is given
+        self.file_lock = FileLock(lock_path) if lock_path else None
+
+        if read_engine not in self.READ_ENGINES:
+            raise ValueError(f'Read engine "{read_engine}" not supported')
+
+        self.reader = None
+        if read_engine in ("sqlite", "index"):
+            self.reader = SQLiteReader(self.lib, self.logger)
+
+        self.index = None
+        if read_engine == "index":
+            self.index = BookIndex(self.reader, self.logger)
+
+        # (library version, {id: last_modified}) for the calibredb engine
+        self.last_modified_cache = (None, {})
+
+        self.fts = None
+        if fts_path:
+            reader = self.reader or SQLiteReader(self.lib, self.logger)
+            self.fts = FullTextIndex(reader, fts_path, self.logger)
+
+        self.hashes = None
+        if hash_path:
+            reader = self.reader or SQLiteReader(self.lib, self.logger)
+            self.hashes = HashIndex(reader, hash_path, self.logger)
+
+        self.worker = None
+        if worker:
+            calibre_debug = path.join(path.dirname(self.cdb), "calibre-debug")
+            self.worker = CalibreWorker([calibre_debug, "-e", SCRIPT], self.logger)
 
     def check(self) -> None:
         """Check that wrapper's executable and library exists.
@@ -151,17 +252,83 @@ class CalibreWrapper:
         testing.
 
         Raises:
-            FileNotFoundError: If the calibredb executable is not valid or
-                metadata.db is not found in the given library path
+            FileNotFoundError: If the calibredb executable is not valid,
+                metadata.db is not found in the given library path or the
+                lock file cannot be created
         """
         if not shutil.which(self.cdb):
             raise FileNotFoundError(f"{self.cdb} is not a valid executable")
 
-        if not path.exists(path.join(self.lib, "metadata.db")):
+        if self.worker is not None and not shutil.which(self.worker.cmd[0]):
+            raise FileNotFoundError(f"{self.worker.cmd[0]} is not a valid executable")
+
+        if self.file_lock is not None:
+            lock_dir = path.dirname(path.abspath(self.file_lock.path))
+            if not path.isdir(lock_dir):
+                raise FileNotFoundError(f"Lock file directory {lock_dir} not found")
+
+        if self.server is not None:
+            self.server.check()
+        elif not path.exists(path.join(self.lib, "metadata.db")):
             raise FileNotFoundError(
                 f"Failed to find Calibre database file {path.join(self.lib, 'metadata.db')}"
             )
 
+    @classmethod
+    def subcommand(cls, cmd: str) -> str:
+        """Get the calibredb subcommand of a command string.
+
+        Args:
+            cmd (str): Full command string, including the executable and any
+                global options
+
+        Returns:
+            str: Subcommand, "--version", or "" if there is none
+        """
+        args = iter(shlex.split(cmd)[1:])
+        for arg in args:
+            if arg in cls.GLOBAL_OPTIONS:
+                next(args, None)
+            elif not arg.startswith("--") or arg == "--version":
+                return arg
+        return ""
+
+    @contextmanager
+    def _lock(self, cmd: str) -> Iterator[None]:
+        """Hold the locks that cmd must run in.
+
+        Mutating commands hold the lock exclusively. Read-only commands share
+        it when concurrent calibredb reads are safe, see __init__(). calibredb
+        --version never opens the library, so it always shares the lock and
+        skips the lock file.
+        """
+        subcommand = self.subcommand(cmd)
+        if subcommand == "--version":
+            with self.mutex.read():
+                yield
+            return
+
+        shared = self.concurrent_reads and subcommand in self.READ_ONLY_COMMANDS
+        mode = "read" if shared else "write"
+        with getattr(self.mutex, mode)():
+            if self.file_lock is None:
+                yield
+            else:
+                with getattr(self.file_lock, mode)():
+                    yield
+
+    def lock_metrics(self) -> dict:
+        """Get the wait metrics of the wrapper's lock and lock file.
+
+        Returns:
+            dict: Metrics of the in-process lock under "process" and of the
+                lock file, if any, under "library". See ReadWriteLock.metrics().
+        """
+        metrics = {"process": self.mutex.metrics()}
+        if self.file_lock is not None:
+            metrics["library"] = self.file_lock.metrics()
+        return metrics
+
     def _run(self, cmd: str) -> (str, str):
         """Execute calibredb on the command line.
 
@@ -183,18 +350,20 @@ class CalibreWrapper:
                 be running.
         """
         self.logger.debug(f'Running "{cmd}"')
+        if self.worker is not None:
+            return self._run_worker(cmd)
+
         try:
-            self.mutex.acquire()
-
-            process = subprocess.run(
-                shlex.split(cmd),
-                capture_output=True,
-                check=True,
-                text=True,
-                encoding="utf-8",
-                env=None,
-                timeout=None,
-            )
+            with self._lock(cmd):
+                process = subprocess.run(
+                    shlex.split(cmd),
+                    capture_output=True,
+                    check=True,
+                    text=True,
+                    encoding="utf-8",
+                    env=None,
+                    timeout=None,
+                )
         except FileNotFoundError as err:
             raise FileNotFoundError(f"Executable could not be found.\n\n{err}") from err
 
@@ -205,14 +374,111 @@ class CalibreWrapper:
             else:
                 raise CalibreRuntimeError(e.cmd, e.returncode, e.stdout, e.stderr)
 
-        finally:
-            self.mutex.release()
-
         if process.stderr:
             self.logger.warning(process.stderr)
 
         return process.stdout, process.stderr
 
+    def _run_worker(self, cmd: str) -> (str, str):
+        """Execute calibredb in the persistent worker. See _run()."""
+        # the worker is calibredb, so the executable is dropped
+        args = shlex.split(cmd)[1:]
+        with self._lock(cmd):
+            returncode, stdout, stderr = self.worker.run(args)
+
+        if returncode != 0:
+            match = re.search(self.CONCURRENCY_ERR_REGEX, stderr)
+            if match is not None:
+                raise CalibreConcurrencyError(cmd, returncode)
+            raise CalibreRuntimeError(cmd, returncode, stdout, stderr)
+
+        if stderr:
+            self.logger.warning(stderr)
+
+        return stdout, stderr
+
+    @contextmanager
+    def _popen(self, cmd: str) -> Iterator[BinaryIO]:
+        """Execute calibredb on the command line and stream its stdout.
+
+        calibredb writes its stdout to a temporary spool file, which is read
+        back once it exits. Like _run(), the command holds the wrapper's lock
+        until it exits, but the lock is released before the output is read,
+        so a slow client never keeps writers waiting.
+
+        Args:
+            cmd (str): Full command string to execute.
+
+        Yields:
+            BinaryIO: Stdout of command
+
+        Raises:
+            FileNotFoundError: The command's executable is invalid.
+            CalibreRuntimeError: The command returns a non-zero exit code.
+            CalibreConcurrencyError: Calibre detects another Calibre program to
+                be running.
+        """
+        self.logger.debug(f'Streaming "{cmd}"')
+        with tempfile.TemporaryFile() as stdout:
+            # stderr goes to a file too so that calibredb never blocks on a
+            # full pipe that nobody reads
+            with self._lock(cmd), tempfile.TemporaryFile(
+                "w+", encoding="utf-8"
+            ) as stderr:
+                try:
+                    process = subprocess.Popen(
+                        shlex.split(cmd), stdout=stdout, stderr=stderr
+                    )
+                except FileNotFoundError as err:
+                    raise FileNotFoundError(
+                        f"Executable could not be found.\n\n{err}"
+                    ) from err
+
+                try:
+                    returncode = process.wait()
+                except BaseException:
+                    process.kill()
+                    process.wait()
+                    raise
+                stderr.seek(0)
+                err = stderr.read()
+
+            if returncode != 0:
+                match = re.search(self.CONCURRENCY_ERR_REGEX, err)
+                if match is not None:
+                    raise CalibreConcurrencyError(cmd, returncode)
+                raise CalibreRuntimeError(cmd, returncode, "", err)
+
+            if err:
+                self.logger.warning(err)
+
+            stdout.seek(0)
+            yield stdout
+
+    def close_connections(self) -> None:
+        """Close this thread's connections to the library. They are reopened
+        on the next read.
+        """
+        if self.reader is not None:
+            self.reader.close()
+        if self.fts is not None:
+            self.fts.close()
+            self.fts.reader.close()
+        if self.hashes is not None:
+            self.hashes.close()
+            self.hashes.reader.close()
+        if self.server is not None:
+            self.server.close()
+
+    def _invalidate(self, ids: list[int]) -> None:
+        """Mark books changed by a calibredb write as stale in the indexes."""
+        if self.server is not None:
+            self.server.invalidate()
+        if self.index is not None:
+            self.index.invalidate(ids)
+        if self.fts is not None:
+            self.fts.invalidate(ids)
+
     def version(self) -> str:
         """Get calibredb version.
 
@@ -229,20 +495,37 @@ class CalibreWrapper:
         else:
             self.logger.error("failed to parse calibredb version")
 
-    def get_book(self, id: int) -> Book:
+    def get_book(self, id: int, fields: list[str] = None) -> Book:
         """Get book from calibre database.
 
         Args:
             id (int): Book ID
+            fields (list[str]): Book fields to fetch. Fields that are not
+                fetched keep their default value. Defaults to all.
 
         Returns:
             Book: Book object
         """
         validate_id(id)
 
+        if self.server is not None:
+            return self.server.get_book(id)
+
+        if self.index is not None:
+            try:
+                return self.index.get_book(id)
+            except sqlite3.Error as exc:
+                self.logger.warning(f"Falling back to calibredb: {exc}")
+
+        elif self.reader is not None:
+            try:
+                return self.reader.get_book(id, fields)
+            except sqlite3.Error as exc:
+                self.logger.warning(f"Falling back to calibredb: {exc}")
+
         cmd = (
             f"{self.cdb_with_lib} list "
-            f"--for-machine --fields=all "
+            f"--for-machine --fields={list_fields(fields)} "
             f"--search=id:{id} --limit=1"
         )
         out, _ = self._run(cmd)
@@ -261,54 +544,542 @@ class CalibreWrapper:
         if len(b) == 1:
             return Book(**b[0])
 
+    def get_last_modified(self, id: int) -> str:
+        """Get the last_modified time of a book without fetching the book.
+
+        With the calibredb read engine, the times are cached until the library
+        changes, so polling an unchanged book does not run calibredb.
+
+        Args:
+            id (int): Book ID
+
+        Returns:
+            str: ISO 8601 time or None if the book does not exist
+        """
+        validate_id(id)
+
+        if self.server is not None:
+            return self.server.get_last_modified(id)
+
+        if self.index is not None:
+            try:
+                return self.index.get_last_modified(id)
+            except sqlite3.Error as exc:
+                self.logger.warning(f"Falling back to calibredb: {exc}")
+
+        elif self.reader is not None:
+            try:
+                return self.reader.get_last_modified(id)
+            except sqlite3.Error as exc:
+                self.logger.warning(f"Falling back to calibredb: {exc}")
+
+        version, _ = self.library_version()
+        cached_version, cache = self.last_modified_cache
+        if cached_version != version:
+            cache = {}
+            self.last_modified_cache = (version, cache)
+
+        if id not in cache:
+            books = self._list_json("last_modified", None, [f"id:{id}"], 1)
+            cache[id] = books[0]["last_modified"] if len(books) else None
+        return cache[id]
+
+    def library_version(self) -> tuple[str, datetime]:
+        """Get the version of the library and the time it was last modified.
+
+        The version changes whenever any book in the library changes. It is
+        derived from metadata.db on the filesystem, so it is the same for every
+        process serving the library. The in-memory indexes are refreshed first,
+        which checks metadata.db at most once every REFRESH_INTERVAL seconds,
+        and report the version they hold, so that data read after this call
+        is never older than the version.
+
+        Returns:
+            str: Opaque version string
+            datetime: Time the library was last modified
+        """
+        if self.server is not None:
+            return self.server.version()
+
+        versions = []
+        for index in (self.index, self.fts):
+            if index is not None:
+                index.refresh()
+                versions.append(index.version)
+        if not len(versions):
+            versions.append(db_version(path.join(self.lib, "metadata.db")))
+
+        # versions are tuples of modification time (ns) and size of each file
+        mtime = max(v for version in versions for v in version[::2])
+        version = "-".join(str(v) for version in versions for v in version)
+        return version, datetime.fromtimestamp(mtime / 1e9, timezone.utc)
+
     def get_books(
         self,
         sort: list[str] = None,
         search: list[str] = None,
-        all: bool = False,
+        start: int = 1,
+        limit: int = None,
+        fields: list[str] = None,
     ) -> list[Book]:
-        """Get a list of (sorted and filtered) books from the calibre database.
+        """Get a page of (sorted and filtered) books from the calibre database.
 
-        A maximum limit of 5000 is set on the total number of results. This limit
-        was introduced as calibredb does not natively support offset or cursor
-        pagination for its results. If a user should require more results than
-        the maximum limit, they can opt to ignore the limit by passing the
-        all=True argument or narrow their search with appropriate filters.
+        Only the books in the requested page are fetched and built. Use
+        count_books() to get the total number of results.
 
-         Args:
-             sort (list[str]): List of sort keys to sort results by
-             search (str): List of search terms
-             all (bool): Return all results of filtered query.
+        calibredb does not natively support offset pagination. For any page
+        other than the first, the ids of all books up to the end of the page
+        are listed cheaply before the page's full metadata is fetched by id.
+
+        Args:
+            sort (list[str]): List of sort keys to sort results by
+            search (list[str]): List of search terms
+            start (int): 1-based offset of the first book to return
+            limit (int): Maximum number of books to return. Defaults to all.
+            fields (list[str]): Book fields to fetch. Fields that are not
+                fetched keep their default value. Defaults to all.
+
+        Returns:
+            list[Book]: List of books
+
+        Raises:
+            ValueError: start or limit is < 1
+        """
+        if start < 1:
+            raise ValueError(f"Value {start=} cannot be < 1")
+        if limit is not None and limit < 1:
+            raise ValueError(f"Value {limit=} cannot be < 1")
+
+        if self.server is not None:
+            return self.server.get_books(sort, search, start, limit)
+
+        if self.index is not None and self.index.supports(search):
+            try:
+                return self.index.get_books(sort, search, start, limit)
+            except sqlite3.Error as exc:
+                self.logger.warning(f"Falling back to calibredb: {exc}")
+
+        elif self.reader is not None:
+            try:
+                return self.reader.get_books(sort, search, start, limit, fields)
+            except UnsupportedSearchError as exc:
+                self.logger.debug(f"Passing search to calibredb: {exc}")
+            except sqlite3.Error as exc:
+                self.logger.warning(f"Falling back to calibredb: {exc}")
+
+        if start == 1:
+            return self._list(list_fields(fields), sort, search, limit)
+
+        end = None if limit is None else start - 1 + limit
+        ids = [b["id"] for b in self._list_json("id", sort, search, end)]
+        return self.get_books_by_ids(ids[start - 1 :], fields)  # noqa: E203
+
+    def iter_books(
+        self,
+        sort: list[str] = None,
+        search: list[str] = None,
+        fields: list[str] = None,
+    ) -> Iterator[Book]:
+        """Iterate over every (sorted and filtered) book in the calibre database.
+
+        Unlike get_books(), books are read in batches as they are consumed, so
+        memory use does not grow with the size of the library. With the sqlite
+        engine, each batch is a short keyset query so that writers are never
+        blocked for the duration of the iteration.
+
+        The first batch is read before returning, so that errors are raised
+        before the caller starts to send books, e.g. before the headers of a
+        streamed response.
+
+        Args:
+            sort (list[str]): List of sort keys to sort results by
+            search (list[str]): List of search terms
+            fields (list[str]): Book fields to fetch. Fields that are not
+                fetched keep their default value. Defaults to all.
+
+        Returns:
+            Iterator[Book]: Books in sort order
+        """
+        if self.server is not None:
+            return prime(self.server.iter_books(sort, search))
+
+        if self.index is not None and self.index.supports(search):
+            return prime(self.index.iter_books(sort, search))
+
+        if self.reader is not None:
+            try:
+                # check the search up front, as it cannot fall back to
+                # calibredb once books have been sent
+                search_parser.validate(search_parser.parse(search))
+                return prime(self.reader.iter_books(sort, search, fields=fields))
+            except UnsupportedSearchError as exc:
+                self.logger.debug(f"Passing search to calibredb: {exc}")
+            except sqlite3.Error as exc:
+                self.logger.warning(f"Falling back to calibredb: {exc}")
+
+        books = self._iter_list_json(list_fields(fields), sort, search)
+        return prime(Book(**b) for b in books)
+
+    def get_books_by_ids(self, ids: list[int], fields: list[str] = None) -> list[Book]:
+        """Get books with the given ids from the calibre database.
+
+        Args:
+            ids (list[int]): List of book IDs
+            fields (list[str]): Book fields to fetch. Fields that are not
+                fetched keep their default value. Defaults to all.
+
+        Returns:
+            list[Book]: List of books in the order of ids. Ids that do not
+                exist are skipped.
+        """
+        if not len(ids):
+            return []
+
+        if self.server is not None:
+            return self.server.get_books_by_ids(ids)
+
+        if self.index is not None:
+            try:
+                return self.index.get_books_by_ids(ids)
+            except sqlite3.Error as exc:
+                self.logger.warning(f"Falling back to calibredb: {exc}")
+
+        elif self.reader is not None:
+            try:
+                return self.reader.get_books_by_ids(ids, fields)
+            except sqlite3.Error as exc:
+                self.logger.warning(f"Falling back to calibredb: {exc}")
+
+        books = []
+        for chunk in chunks(ids, self.SEARCH_IDS_CHUNK_SIZE):
+            search = [" or ".join(f"id:{i}" for i in chunk)]
+            books.extend(self._list(list_fields(fields), None, search))
+        order = {id: i for i, id in enumerate(ids)}
+        return sorted(books, key=lambda b: order[b.id])
+
+    def existing_ids(self, ids: list[int]) -> set[int]:
+        """Get the given ids that exist in the library.
+
+        Unlike calling get_book() for each id, this reads every id in a single
+        query, or a single calibredb list per SEARCH_IDS_CHUNK_SIZE ids.
+
+        Args:
+            ids (list[int]): List of book IDs
+
+        Returns:
+            set[int]: IDs that exist
+        """
+        return {book.id for book in self.get_books_by_ids(ids, ["id"])}
+
+    def search_text(
+        self,
+        q: str,
+        search: list[str] = None,
+        start: int = 1,
+        limit: int = None,
+        fields: list[str] = None,
+    ) -> tuple[list[Book], int]:
+        """Get a page of books matching a free-text query, best match first.
+
+        Args:
+            q (str): Free-text query matched against title, authors, tags,
+                series, publisher and comments
+            search (list[str]): List of search terms that results must also
+                match
+            start (int): 1-based offset of the first book to return
+            limit (int): Maximum number of books to return. Defaults to all.
+            fields (list[str]): Book fields to fetch. Defaults to all.
+
+        Returns:
+            list[Book]: List of books
+            int: Total number of matching books
+
+        Raises:
+            ValueError: Full-text search is disabled, q has no words or start
+                or limit is < 1
+        """
+        if self.fts is None:
+            raise ValueError("Full-text search is not enabled")
+        if start < 1:
+            raise ValueError(f"Value {start=} cannot be < 1")
+        if limit is not None and limit < 1:
+            raise ValueError(f"Value {limit=} cannot be < 1")
+
+        ids = self.fts.search(q)
+        if search is not None and len(search):
+            matches = set(self.search_ids(search))
+            ids = [i for i in ids if i in matches]
+
+        end = None if limit is None else start - 1 + limit
+        books = self.get_books_by_ids(ids[start - 1 : end], fields)  # noqa: E203
+        return books, len(ids)
+
+    def get_books_by_cursor(
+        self,
+        sort: list[str] = None,
+        search: list[str] = None,
+        cursor: str = "",
+        limit: int = 20,
+        fields: list[str] = None,
+    ) -> tuple[list[Book], str, str]:
+        """Get a page of (sorted and filtered) books with cursor pagination.
+
+        A cursor encodes the sort key and id of the book at the edge of a page,
+        and a digest of the sort keys and search, see cursor_digest(). A cursor
+        used with another sort or search is rejected.
+        With the sqlite read engine, pages are fetched with keyset queries so
+        deep pages are as cheap as the first and stay stable when books are
+        added or removed. Cursors also record their offset, which calibredb
+        (and searches that cannot be translated to SQL) fall back to.
+
+        Args:
+            sort (list[str]): List of sort keys to sort results by
+            search (list[str]): List of search terms
+            cursor (str): Cursor returned by a previous call. An empty cursor
+                returns the first page.
+            limit (int): Maximum number of books to return
+            fields (list[str]): Book fields to fetch. Defaults to all.
+
+        Returns:
+            list[Book]: List of books
+            str: Cursor of the previous page, empty if this is the first page
+            str: Cursor of the next page, empty if this is the last page
+
+        Raises:
+            ValueError: Invalid cursor or limit, or the cursor was created with
+                another sort or search
+        """
+        if limit < 1:
+            raise ValueError(f"Value {limit=} cannot be < 1")
+
+        digest = cursor_digest(sort, search)
+        data = decode_cursor(cursor) if cursor else {}
+        if data and data.get("q") != digest:
+            raise ValueError("cursor does not match sort keys or search")
+
+        before = data.get("d") == "before"
+        offset = data.get("o", 0)
+        key = data.get("k")
+        if data and (
+            data.get("d") not in ("before", "after")
+            or isinstance(offset, bool)
+            or not isinstance(offset, int)
+            or offset < 0
+            or not (key is None or isinstance(key, list))
+            or not all(isinstance(v, (str, int, float)) for v in key or [])
+        ):
+            raise ValueError(f"Invalid cursor {cursor}")
+
+        def make_cursor(direction: str, offset: int, key: list = None) -> str:
+            c = {"q": digest, "d": direction, "o": max(offset, 0)}
+            if key is not None:
+                c["k"] = key
+            return encode_cursor(c)
+
+        if self.reader is not None and (key or not data):
+            try:
+                books, keys, more = self.reader.get_books_by_keyset(
+                    sort, search, key, before, limit, fields
+                )
+            except UnsupportedSearchError as exc:
+                self.logger.debug(f"Passing search to calibredb: {exc}")
+            except sqlite3.Error as exc:
+                self.logger.warning(f"Falling back to calibredb: {exc}")
+            else:
+                # offset of the first book in this page
+                start = offset - len(books) if before else offset
+                has_prev = more if before else bool(data)
+                has_next = bool(data) if before else more
+
+                prev_cursor = next_cursor = ""
+                if len(books) and has_prev:
+                    prev_cursor = make_cursor("before", start, keys[0])
+                if len(books) and has_next:
+                    next_cursor = make_cursor("after", start + len(books), keys[-1])
+                return books, prev_cursor, next_cursor
+
+        # offset pagination
+        start = max(offset - limit, 0) if before else offset
+        books = self.get_books(sort, search, start + 1, limit, fields)
+        count = self.count_books(search)
+
+        prev_cursor = next_cursor = ""
+        if start > 0:
+            prev_cursor = make_cursor("before", start)
+        if start + len(books) < count:
+            next_cursor = make_cursor("after", start + len(books))
+        return books, prev_cursor, next_cursor
+
+    def count_books(self, search: list[str] = None) -> int:
+        """Count the number of (filtered) books in the calibre database.
+
+        Args:
+            search (list[str]): List of search terms
+
+        Returns:
+            int: Number of books matching the search terms
+        """
+        if self.server is not None:
+            return self.server.count_books(search)
+
+        if self.index is not None and self.index.supports(search):
+            try:
+                return self.index.count_books(search)
+            except sqlite3.Error as exc:
+                self.logger.warning(f"Falling back to calibredb: {exc}")
+
+        elif self.reader is not None:
+            try:
+                return self.reader.count_books(search)
+            except UnsupportedSearchError as exc:
+                self.logger.debug(f"Passing search to calibredb: {exc}")
+            except sqlite3.Error as exc:
+                self.logger.warning(f"Falling back to calibredb: {exc}")
+
+        return len(self._search_ids(search))
+
+    def search_ids(self, search: list[str] = None) -> list[int]:
+        """Get the ids of all (filtered) books in the calibre database.
+
+        Args:
+            search (list[str]): List of search terms
+
+        Returns:
+            list[int]: Ids of books matching the search terms
+        """
+        if self.server is not None:
+            return self.server.search_ids(search)
+
+        if self.index is not None and self.index.supports(search):
+            try:
+                return self.index.search_ids(search)
+            except sqlite3.Error as exc:
+                self.logger.warning(f"Falling back to calibredb: {exc}")
+
+        elif self.reader is not None:
+            try:
+                return self.reader.search_ids(search)
+            except UnsupportedSearchError as exc:
+                self.logger.debug(f"Passing search to calibredb: {exc}")
+            except sqlite3.Error as exc:
+                self.logger.warning(f"Falling back to calibredb: {exc}")
+
+        return self._search_ids(search)
+
+    def _search_ids(self, search: list[str] = None) -> list[int]:
+        query = "id:>0"
+        if search is not None and len(search):
+            query = " ".join(search)
+
+        # "calibredb search" prints matching ids only, which is far cheaper
+        # than listing the books
+        cmd = f'{self.cdb_with_lib} search "{query}"'
+        try:
+            out, _ = self._run(cmd)
+        except CalibreRuntimeError as e:
+            if "No books matching" in e.stderr:
+                return []
+            raise
 
-         Returns:
-             list[Book]: List of books
+        out = out.strip()
+        if out == "":
+            return []
+        return [int(i) for i in out.split(",")]
+
+    def _list(
+        self, fields: str, sort: list[str], search: list[str], limit: int = None
+    ) -> list[Book]:
+        return [Book(**b) for b in self._list_json(fields, sort, search, limit)]
+
+    def _list_json(
+        self, fields: str, sort: list[str], search: list[str], limit: int = None
+    ) -> list[dict]:
+        """Run calibredb list subcommand and decode its output.
+
+        Args:
+            fields (str): Comma-separated fields to return
+            sort (list[str]): List of sort keys
+            search (list[str]): List of search terms
+            limit (int): Maximum number of results. Defaults to all.
+
+        Returns:
+            list[dict]: List of decoded books
         """
-        max_limit = "all"
-        if not all:
-            max_limit = "5000"
+        out, _ = self._run(self._list_cmd(fields, sort, search, limit))
+        return json.loads(out)
+
+    def _iter_list_json(
+        self, fields: str, sort: list[str], search: list[str]
+    ) -> Iterator[dict]:
+        """Run calibredb list subcommand and decode its output incrementally.
 
+        calibredb's output is spooled to disk, see _popen(), and books are
+        decoded and yielded one at a time as they are read back, so the whole
+        output is never held in memory.
+
+        Args:
+            fields (str): Comma-separated fields to return
+            sort (list[str]): List of sort keys
+            search (list[str]): List of search terms
+
+        Returns:
+            Iterator[dict]: Decoded books
+        """
+        # build the command before iterating so that invalid arguments are
+        # raised immediately
+        return self._iter_json(self._list_cmd(fields, sort, search))
+
+    def _iter_json(self, cmd: str) -> Iterator[dict]:
+        if self.worker is not None:
+            # the worker runs calibredb in-process and returns the output in
+            # one piece
+            out, _ = self._run(cmd)
+            yield from json.loads(out)
+            return
+
+        decoder = json.JSONDecoder()
+        utf8 = codecs.getincrementaldecoder("utf-8")()
+        buf = ""
+        with self._popen(cmd) as stdout:
+            for chunk in iter(lambda: stdout.read(self.STREAM_CHUNK_SIZE), b""):
+                buf += utf8.decode(chunk)
+                pos = 0
+                while True:
+                    # skip the enclosing brackets and separators between books
+                    pos = self.LIST_SEPARATOR_REGEX.match(buf, pos).end()
+                    if pos == len(buf):
+                        break
+                    try:
+                        book, pos = decoder.raw_decode(buf, pos)
+                    except json.JSONDecodeError:
+                        # incomplete book, wait for the next chunk
+                        break
+                    yield book
+                buf = buf[pos:]
+
+        if buf.strip():
+            raise json.JSONDecodeError("Unexpected data", buf, 0)
+
+    def _list_cmd(
+        self, fields: str, sort: list[str], search: list[str], limit: int = None
+    ) -> str:
+        max_limit = "all" if limit is None else str(limit)
         cmd = (
             f"{self.cdb_with_lib} list "
-            f"--for-machine --fields=all "
+            f"--for-machine --fields={fields} "
             f"--limit={max_limit}"
         )
 
         cmd = self._handle_sort(cmd, sort)
-        cmd = self._handle_search(cmd, search)
-
-        out, _ = self._run(cmd)
-
-        books = json.loads(out)
-        if not len(books):
-            return []
-
-        return [Book(**b) for b in books]
+        return self._handle_search(cmd, search)
 
     def _handle_sort(self, cmd: str, sort: list[str]) -> str:
         """Handle sort.
 
-        Defaults to ascending sort, unless a `-` is prepended to ANY sort keys.
-        Sort keys that are not supported are dropped with a warning.
+        calibredb sorts every key in the same direction: ascending, unless a
+        `-` is prepended to ANY sort keys. Sorting each key in its own
+        direction requires the sqlite or index read engine. Sort keys that are
+        not supported are dropped with a warning.
 
         Args:
             cmd (str): Command string to run
@@ -350,7 +1121,11 @@ class CalibreWrapper:
         return cmd
 
     def add_multiple(
-        self, book_paths: list[str], book: Book = None, automerge: str = "ignore"
+        self,
+        book_paths: list[str],
+        book: Book = None,
+        automerge: str = "ignore",
+        hashes: list[str] = None,
     ) -> list[int]:
         """Add multiple books to the calibredb database.
 
@@ -377,18 +1152,210 @@ class CalibreWrapper:
              add another instance of the same file with `automerge=overwrite`,
              the new file would overwrite ALL existing entries with the same file
              in the library.
+             hashes (list[str]): Optional SHA-256 hex digests of the files,
+                 recorded in the hash index for the files that are matched to
+                 their books once they are added, see _match_added().
 
         Returns:
              list[int]: List of IDs of added/merged book(s).
         """
         if len(book_paths) == 1:
-            return self.add_one(book_paths[0], book, automerge)
+            ids = self.add_one(book_paths[0], book, automerge)
+        else:
+            if any(map(lambda x: not path.exists(x), book_paths)):
+                raise FileNotFoundError(f"Failed to find book at {book_paths}")
+
+            cmd = f"{self.cdb_with_lib} add {' '.join(book_paths)}"
+            ids = self._run_add(cmd, book, automerge)
+
+        if self.hashes is not None and hashes is not None:
+            matched = self._match_added(book_paths, hashes, ids)
+            self._record_hashes(matched, dict(zip(book_paths, hashes)))
+        return ids
+
+    def add_batch(
+        self,
+        book_paths: list[str],
+        book: Book = None,
+        automerge: str = "ignore",
+        hashes: list[str] = None,
+    ) -> (dict[str, str], list[str]):
+        """Add the books of several requests with a single calibredb add.
+
+        Unlike add_multiple(), books that already exist do not fail the whole
+        batch. calibredb reports the ids of the added books in no particular
+        order, so each file is matched to its book by the format file calibre
+        stored for it, see _match_added().
+
+        Args:
+            book_paths (list[str]): List of book file paths to upload
+            book (Book): Optional book instance with metadata for every book
+            automerge (str): "ignore" or "new_record". Merged books cannot be
+                matched to their files, so "overwrite" is not supported.
+            hashes (list[str]): Optional SHA-256 hex digests of the files,
+                recorded in the hash index once the books are added. Unknown
+                digests may be None.
+
+        Returns:
+            dict[str, str]: IDs of the added books by the path of their file.
+                Files that could not be matched to a book are missing.
+            list[str]: Paths of the books that were ignored as they already
+                exist
+
+        Raises:
+            ValueError: automerge is not supported
+        """
+        if automerge not in ("ignore", "new_record"):
+            raise ValueError(f'automerge value "{automerge}" not supported in a batch')
 
         if any(map(lambda x: not path.exists(x), book_paths)):
             raise FileNotFoundError(f"Failed to find book at {book_paths}")
 
-        cmd = f"{self.cdb_with_lib} add {' '.join(book_paths)}"
-        return self._run_add(cmd, book, automerge)
+        cmd = f"{self.cdb_with_lib} add {' '.join(book_paths)} --automerge={automerge}"
+        cmd = self._handle_add_flags(cmd, book)
+        out, stderr = self._run(cmd)
+
+        ignored = []
+        if re.search(self.BOOK_IGNORED_REGEX, stderr) is not None:
+            # the paths of ignored books follow their titles, on stdout or
+            # stderr depending on the calibre version
+            lines = {line.strip() for line in (out + stderr).splitlines()}
+            ignored = [p for p in book_paths if path.abspath(p) in lines]
+
+        book_ids = []
+        for line in out.splitlines():
+            # the ignored paths may come before the added ids
+            book_added_match = re.match(self.BOOK_ADDED_REGEX, line)
+            if book_added_match is not None:
+                book_ids = book_added_match.group(1).split(", ")
+                self._invalidate(book_ids)
+
+        if hashes is None:
+            hashes = [None] * len(book_paths)
+        added = [(p, h) for p, h in zip(book_paths, hashes) if p not in ignored]
+        matched = self._match_added(
+            [p for p, _ in added], [h for _, h in added], book_ids
+        )
+        self._record_hashes(matched, dict(added))
+        return matched, ignored
+
+    def _match_added(
+        self, book_paths: list[str], hashes: list[str], ids: list[str]
+    ) -> dict[str, str]:
+        """Match added files to the books calibredb created for them.
+
+        A single file is matched to a single book. Otherwise, each file is
+        matched to the new book with a format file of the same SHA-256 digest.
+        Identical files are interchangeable, so they are matched to their books
+        in any order. Files that calibre changed on import are not matched, so
+        their digests are never recorded for the wrong content. Books of a
+        remote library cannot be read back.
+
+        Args:
+            book_paths (list[str]): Paths of the files that were added
+            hashes (list[str]): SHA-256 hex digests of the files. Unknown
+                digests may be None.
+            ids (list[str]): IDs of the added books, as printed by calibredb
+
+        Returns:
+            dict[str, str]: IDs of the books by the path of their file. Files
+                that could not be matched are missing.
+        """
+        if len(book_paths) == 1 and len(ids) == 1:
+            return {book_paths[0]: ids[0]}
+        if not len(book_paths) or not len(ids) or self.server is not None:
+            return {}
+
+        printed = {int(id): id for id in ids}
+        stored = {}
+        for b in self.get_books_by_ids(list(printed), ["id", "formats"]):
+            for filepath in b.formats or []:
+                try:
+                    stored.setdefault(hash_file(filepath), []).append(printed[b.id])
+                except OSError:
+                    continue
+
+        matched = {}
+        for book_path, sha256 in zip(book_paths, hashes):
+            try:
+                sha256 = sha256 or hash_file(book_path)
+            except OSError:
+                continue
+            free = [id for id in stored.get(sha256, []) if id not in matched.values()]
+            if len(free):
+                matched[book_path] = free[0]
+        return matched
+
+    def skip_duplicates(
+        self, hashes: list[str], book: Book = None, automerge: str = "ignore"
+    ) -> list[str] | None:
+        """Check uploads against the hash index before adding them.
+
+        calibredb detects duplicates by title and authors, which it reads from
+        the file unless they are given in book. Files whose hash is in the
+        index are therefore duplicates of their books, unless book sets a
+        title or authors or automerge is "new_record". Files already in the
+        library are never added again:
+
+            - ignore: ExistingItemError is raised
+            - overwrite: The ids of the existing books are returned, as
+              overwriting them with identical files would not change them
+
+        Args:
+            hashes (list[str]): SHA-256 hex digests of the uploaded files
+            book (Book): Optional book instance with metadata
+            automerge (str): Defaults to "ignore"
+
+        Returns:
+            list[str]: IDs of the existing books, in the same form as the IDs
+                returned by add_multiple(), or None if the files must be added
+                with calibredb
+
+        Raises:
+            ExistingItemError: Every file is already in the library and
+                automerge is "ignore"
+        """
+        if self.hashes is None or not len(hashes) or automerge == "new_record":
+            return None
+        if book is not None and (book.title or len(book.authors)):
+            return None
+
+        ids = []
+        for sha256 in hashes:
+            book_ids = self.hashes.lookup(sha256)
+            if not len(book_ids):
+                return None
+            ids.extend(i for i in book_ids if i not in ids)
+
+        if automerge == "overwrite":
+            # calibredb reports the ids of added books as strings
+            return [str(i) for i in ids]
+
+        ids = ", ".join(map(str, ids))
+        self.logger.info(f"Books {ids} already exist. Ignoring...")
+        raise ExistingItemError(
+            f"Book {ids} already exists. Include automerge=overwrite to overwrite."
+        )
+
+    def _record_hashes(self, matched: dict[str, str], hashes: dict[str, str]) -> None:
+        """Record the hashes of added files in the hash index.
+
+        Args:
+            matched (dict[str, str]): IDs of the added books by the path of
+                their file, see _match_added()
+            hashes (dict[str, str]): SHA-256 hex digests by file path
+        """
+        if self.hashes is None:
+            return
+
+        try:
+            for book_path, id in matched.items():
+                sha256 = hashes.get(book_path)
+                if sha256 is not None:
+                    self.hashes.record(sha256, int(id), path.splitext(book_path)[1])
+        except sqlite3.Error as exc:
+            # the index only saves work, the books were added
+            self.logger.warning(f"Failed to update the hash index: {exc}")
 
     def add_one(
         self, book_path: str, book: Book = None, automerge: str = "ignore"
@@ -500,6 +1467,7 @@ class CalibreWrapper:
                 )
                 raise Exception("No books were merged, something went wrong...")
             else:
+                self._invalidate(book_ids)
                 return book_ids
 
         book_added_match = re.search(self.BOOK_ADDED_REGEX, out)
@@ -514,6 +1482,7 @@ class CalibreWrapper:
                 )
                 raise Exception("No books were added, something went wrong...")
             else:
+                self._invalidate(book_ids)
                 return book_ids
 
         self.logger.error(
@@ -580,6 +1549,9 @@ class CalibreWrapper:
             cmd += " --permanent"
 
         self._run(cmd)
+        self._invalidate(ids)
+        if self.hashes is not None:
+            self.hashes.remove(ids)
 
     def add_format(
         self, id: int, replace: bool = False, data_file: bool = False
@@ -600,6 +1572,7 @@ class CalibreWrapper:
             cmd += " --as-extra-data-file"
 
         out, _ = self._run(cmd)
+        self._invalidate([id])
         return out
 
     def remove_format(self, id: int, format: str) -> str:
@@ -614,6 +1587,7 @@ class CalibreWrapper:
         # TODO check format
         cmd = f"{self.cdb_with_lib} remove_format {id} {format}"
         out, _ = self._run(cmd)
+        self._invalidate([id])
         return out
 
     def show_metadata(self, id: int) -> str:
@@ -646,10 +1620,6 @@ class CalibreWrapper:
         """
         validate_id(id)
 
-        # check if book exists
-        if self.get_book(id) is None:
-            return -1
-
         cmd = f"{self.cdb_with_lib} set_metadata {id}"
 
         if metadata_path:
@@ -662,10 +1632,81 @@ class CalibreWrapper:
         else:
             raise ValueError("No metadata given for update")
 
-        # Difficult to check for error. Best way is for user to check entry.
-        self._run(cmd)
+        try:
+            self._run(cmd)
+        except CalibreRuntimeError:
+            # calibredb fails if the book does not exist. Checking for it
+            # only now saves a read on every successful update.
+            if not self.existing_ids([id]):
+                return -1
+            raise
+
+        self._invalidate([id])
         return id
 
+    def update_book(self, id: int, book: Book, fields: list[str] = None) -> Book:
+        """Set the metadata of a book and read it back.
+
+        The update is a single calibredb set_metadata. The book is read back
+        with the read engine, which does not run calibredb unless it is the
+        calibredb engine.
+
+        Args:
+            id (int): Book ID
+            book (Book): Book instance with the fields to update
+            fields (list[str]): Book fields to read back. Defaults to all.
+
+        Returns:
+            Book: Updated book, or None if it does not exist
+        """
+        if self.set_metadata(id, book) == -1:
+            return None
+        return self.get_book(id, fields)
+
+    def update_books(self, updates: list[tuple[int, Book]]) -> Iterator[dict]:
+        """Set the metadata of several books, one set_metadata per book.
+
+        Ids that do not exist are found with a single existing_ids() query
+        before this returns, so that errors of the query are raised before
+        the caller starts to send outcomes, and missing books never run
+        calibredb. The updates run as the outcomes are consumed. A failed
+        update does not stop the remaining ones.
+
+        Args:
+            updates (list[tuple[int, Book]]): Book IDs and the fields to
+                update, see set_metadata()
+
+        Returns:
+            Iterator[dict]: Outcome of each update as it finishes, in order:
+                the id and a status of "updated", "not_found" or "failed",
+                with an error for failed updates.
+        """
+        for id, _ in updates:
+            validate_id(id)
+
+        existing = self.existing_ids([id for id, _ in updates])
+        return self._update_books(updates, existing)
+
+    def _update_books(
+        self, updates: list[tuple[int, Book]], existing: set[int]
+    ) -> Iterator[dict]:
+        for id, book in updates:
+            if id not in existing:
+                yield {"id": id, "status": "not_found"}
+                continue
+
+            try:
+                updated = self.set_metadata(id, book) != -1
+            except Exception as exc:
+                # the outcomes are streamed, so an error ends only this update
+                self.logger.warning(f"Failed to update book {id}: {exc}")
+                error = getattr(exc, "stderr", "") or str(exc)
+                yield {"id": id, "status": "failed", "error": error.strip()}
+                continue
+
+            # the book may have been removed since the check
+            yield {"id": id, "status": "updated" if updated else "not_found"}
+
     def _handle_update_flags(self, cmd: str, book: Book = None) -> str:
         """Build flags for set_metadata.
 
@@ -743,6 +1784,26 @@ class CalibreWrapper:
                 raise CalibreRuntimeError from e
 
 
+def prime(iterator: Iterator) -> Iterator:
+    """Read the first item of an iterator, so that an error in starting it is
+    raised immediately. The returned iterator yields every item, including the
+    first.
+    """
+    iterator = iter(iterator)
+    try:
+        first = next(iterator)
+    except StopIteration:
+        return iter(())
+    return itertools.chain((first,), iterator)
+
+
+def list_fields(fields: list[str] = None) -> str:
+    """Build the value of "calibredb list --fields" for the given Book fields."""
+    if fields is None:
+        return "all"
+    return ",".join(fields)
+
+
 def join_list(lst: list, sep: str) -> str:
     lst = list(map(str.strip, lst))
     return sep.join(lst)
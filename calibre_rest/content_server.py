@@ -0,0 +1,351 @@
+import base64
+import http.client
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Iterator
+from urllib.parse import urlencode, urljoin, urlsplit
+
+from calibre_rest.errors import ContentServerError
+from calibre_rest.models import Book
+from calibre_rest.sqlite import sort_keys
+
+
+class ContentServerClient:
+    """Read access to a library served by a running calibre-server.
+
+    Books are read from the server's JSON (ajax) endpoints instead of running
+    calibredb. The server handles any number of concurrent requests, so reads
+    are not serialized behind CalibreWrapper's mutex and several processes
+    can serve the same library.
+
+    Each thread keeps its own keep-alive connection to the server. A request
+    on a connection that the server has since closed is retried once on a new
+    connection.
+
+    The library is given as a URL in calibredb's format, with the library id
+    as the fragment: http://localhost:8080/#calibre. Without a library id, the
+    server's default library is used. Authentication requires the server to
+    run with --auth-mode=basic.
+    """
+
+    # Sort keys calibre-server can sort by
+    SORT_KEYS = (
+        "author_sort",
+        "authors",
+        "id",
+        "languages",
+        "last_modified",
+        "pubdate",
+        "publisher",
+        "rating",
+        "series",
+        "series_index",
+        "size",
+        "tags",
+        "timestamp",
+        "title",
+        "uuid",
+    )
+
+    # Number of books read in a single request
+    CHUNK_SIZE = 500
+    # Largest number of search results calibre-server returns at once
+    MAX_RESULTS = 2**31 - 1
+    # Seconds the library's version is cached for, see version()
+    VERSION_TTL = 1.0
+
+    def __init__(
+        self,
+        url: str,
+        username: str = "",
+        password: str = "",
+        logger: logging.Logger = None,
+        timeout: float = 30,
+    ) -> None:
+        """Initialize the content server client.
+
+        Args:
+            url (str): URL of the library on calibre-server
+            username (str): calibre-server username
+            password (str): calibre-server password
+            logger (logging.Logger): Custom logger object
+            timeout (float): Timeout of each request in seconds
+
+        Raises:
+            ValueError: url is not an http(s) URL
+        """
+        if logger is None:
+            logger = logging.getLogger(__name__)
+        self.logger = logger
+
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.netloc:
+            raise ValueError(f"Invalid calibre-server URL {url}")
+
+        self.url = url
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.base_path = parts.path.rstrip("/")
+        self.library_id = parts.fragment
+        self.timeout = timeout
+
+        self.headers = {"Accept": "application/json"}
+        if username != "" and password != "":
+            token = base64.b64encode(f"{username}:{password}".encode("utf-8"))
+            self.headers["Authorization"] = f"Basic {token.decode('ascii')}"
+
+        self.local = threading.local()
+        # time the version was read (monotonic), and the version
+        self.cached_version = (0.0, None)
+
+    def connect(self) -> http.client.HTTPConnection:
+        """Return this thread's connection to the server, opening it if required."""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            if self.scheme == "https":
+                conn = http.client.HTTPSConnection(self.netloc, timeout=self.timeout)
+            else:
+                conn = http.client.HTTPConnection(self.netloc, timeout=self.timeout)
+            self.local.conn = conn
+        return conn
+
+    def close(self) -> None:
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def request(self, endpoint: str, params: dict = None, library: bool = True):
+        """GET a JSON endpoint of the server.
+
+        Args:
+            endpoint (str): Endpoint without the library id, e.g. "ajax/search"
+            params (dict): Query parameters
+            library (bool): Whether the endpoint takes the library id
+
+        Returns:
+            Decoded JSON response
+
+        Raises:
+            ContentServerError: The request failed or the server returned an
+                error.
+        """
+        url = f"{self.base_path}/{endpoint}"
+        if library and self.library_id:
+            url += f"/{self.library_id}"
+        if params:
+            url += f"?{urlencode(params)}"
+
+        for retry in (False, True):
+            conn = self.connect()
+            try:
+                conn.request("GET", url, headers=self.headers)
+                resp = conn.getresponse()
+                body = resp.read()
+                break
+            except (
+                http.client.RemoteDisconnected,
+                BrokenPipeError,
+                ConnectionResetError,
+            ) as exc:
+                # the server closed an idle keep-alive connection
+                self.close()
+                if retry:
+                    raise ContentServerError(f"GET {url} failed: {exc}") from exc
+            except (OSError, http.client.HTTPException) as exc:
+                self.close()
+                raise ContentServerError(f"GET {url} failed: {exc}") from exc
+
+        if resp.status != 200:
+            message = body.decode("utf-8", errors="replace").strip()
+            raise ContentServerError(f"GET {url} returned {resp.status}: {message}")
+        return json.loads(body)
+
+    def check(self) -> None:
+        """Check that the server is reachable and serves the library.
+
+        Raises:
+            FileNotFoundError: The library is not served by the server.
+        """
+        try:
+            info = self.request("ajax/library-info", library=False)
+        except ContentServerError as exc:
+            raise FileNotFoundError(f"Failed to reach calibre-server: {exc}") from exc
+
+        if self.library_id and self.library_id not in info.get("library_map", {}):
+            raise FileNotFoundError(
+                f"Library {self.library_id} not found on calibre-server {self.url}"
+            )
+
+    def get_book(self, id: int) -> Book:
+        """Get book from the server.
+
+        Returns:
+            Book: Book object or None if the book does not exist
+        """
+        books = self.get_books_by_ids([id])
+        if len(books) == 1:
+            return books[0]
+
+    def get_last_modified(self, id: int) -> str:
+        """Get the last_modified time of a book.
+
+        Returns:
+            str: ISO 8601 time or None if the book does not exist
+        """
+        book = self.get_book(id)
+        if book is not None:
+            return book.last_modified
+
+    def get_books(
+        self,
+        sort: list[str] = None,
+        search: list[str] = None,
+        start: int = 1,
+        limit: int = None,
+    ) -> list[Book]:
+        """Get a page of sorted and filtered books from the server.
+
+        Each sort key is sorted in its own direction, see sqlite.sort_keys().
+
+        Args:
+            sort (list[str]): List of sort keys to sort results by
+            search (list[str]): List of search terms
+            start (int): 1-based offset of the first book to return
+            limit (int): Maximum number of books to return. Defaults to all.
+
+        Returns:
+            list[Book]: List of books
+        """
+        ids, _ = self._search(sort, search, start - 1, limit)
+        return self.get_books_by_ids(ids)
+
+    def get_books_by_ids(self, ids: list[int]) -> list[Book]:
+        """Get books with the given ids from the server, in the order of ids.
+        Ids that do not exist are skipped.
+        """
+        books = {}
+        for i in range(0, len(ids), self.CHUNK_SIZE):
+            chunk = ids[i : i + self.CHUNK_SIZE]  # noqa: E203
+            data = self.request("ajax/books", {"ids": ",".join(map(str, chunk))})
+            for key, value in data.items():
+                if value is not None:
+                    books[int(key)] = self.to_book(value)
+
+        return [books[i] for i in ids if i in books]
+
+    def iter_books(
+        self,
+        sort: list[str] = None,
+        search: list[str] = None,
+        batch_size: int = CHUNK_SIZE,
+    ) -> Iterator[Book]:
+        """Iterate over every sorted and filtered book, reading them in batches."""
+        ids, _ = self._search(sort, search)
+        for i in range(0, len(ids), batch_size):
+            yield from self.get_books_by_ids(ids[i : i + batch_size])  # noqa: E203
+
+    def search_ids(self, search: list[str] = None) -> list[int]:
+        """Get the ids of all books matching search, in ascending order."""
+        ids, _ = self._search(None, search)
+        return ids
+
+    def count_books(self, search: list[str] = None) -> int:
+        """Count the number of (filtered) books on the server."""
+        _, count = self._search(None, search, 0, 0)
+        return count
+
+    def version(self) -> tuple[str, datetime]:
+        """Get the version of the library and the time it was last modified.
+
+        The version is derived from the number of books and the most recently
+        modified book, so it changes when any book is added, removed or
+        modified. Reading it takes two requests, so it is cached for
+        VERSION_TTL seconds, or until invalidate() is called.
+
+        Returns:
+            str: Opaque version string
+            datetime: Time the library was last modified, or None if the
+                library is empty
+        """
+        now = time.monotonic()
+        checked, version = self.cached_version
+        if version is not None and now - checked < self.VERSION_TTL:
+            return version
+
+        ids, count = self._search(["-last_modified"], None, 0, 1)
+        if not count:
+            version = ("0", None)
+        else:
+            last_modified = self.get_last_modified(ids[0])
+            modified = datetime.fromisoformat(last_modified)
+            if modified.tzinfo is None:
+                modified = modified.replace(tzinfo=timezone.utc)
+            version = (f"{count}-{ids[0]}-{last_modified}", modified)
+
+        self.cached_version = (now, version)
+        return version
+
+    def invalidate(self) -> None:
+        """Forget the cached version, e.g. after a write through calibredb."""
+        self.cached_version = (0.0, None)
+
+    def _search(
+        self,
+        sort: list[str] = None,
+        search: list[str] = None,
+        offset: int = 0,
+        limit: int = None,
+    ) -> tuple[list[int], int]:
+        keys = sort_keys(sort, self.SORT_KEYS, self.logger)
+        # the id breaks ties in the direction of the last sort key, like the
+        # sqlite engine
+        keys.append(("id", keys[-1][1] if len(keys) else False))
+
+        params = {
+            "query": " ".join(search or []),
+            "sort": ",".join(k for k, _ in keys),
+            "sort_order": ",".join("desc" if desc else "asc" for _, desc in keys),
+            "offset": offset,
+            "num": self.MAX_RESULTS if limit is None else limit,
+        }
+        data = self.request("ajax/search", params)
+        return data["book_ids"], data["total_num"]
+
+    def to_book(self, data: dict) -> Book:
+        """Convert calibre-server's JSON metadata of a book into a Book.
+
+        The result is shaped like the output of calibredb list, except that
+        the cover is the URL of the cover on the server.
+        """
+        formats = data.get("format_metadata") or {}
+        identifiers = data.get("identifiers") or {}
+
+        book = Book(
+            id=data["application_id"],
+            title=data.get("title") or "",
+            authors=" & ".join(data.get("authors") or []),
+            author_sort=data.get("author_sort") or "",
+            comments=data.get("comments") or "",
+            formats=[m["path"] for m in formats.values() if "path" in m],
+            identifiers=identifiers,
+            isbn=identifiers.get("isbn", ""),
+            languages=data.get("languages") or [],
+            last_modified=data.get("last_modified") or "",
+            pubdate=data.get("pubdate") or "",
+            publisher=data.get("publisher") or "",
+            # calibre-server halves ratings to 0-5 stars
+            rating=round((data.get("rating") or 0) * 2),
+            series=data.get("series") or "",
+            series_index=data.get("series_index") or 0.0,
+            size=max((m.get("size") or 0 for m in formats.values()), default=0),
+            tags=data.get("tags") or [],
+            timestamp=data.get("timestamp") or "",
+            uuid=data.get("uuid") or "",
+        )
+        if data.get("cover"):
+            book.cover = urljoin(f"{self.scheme}://{self.netloc}", data["cover"])
+        return book
@@ -20,6 +20,10 @@ class CalibreConcurrencyError(CalibreRuntimeError):
         super().__init__(cmd, exit_code, "", message)
 
 
+class ContentServerError(Exception):
+    """Raise when a request to calibre-server fails."""
+
+
 class InvalidPayloadError(HTTPException):
     """Raise when HTTP request payload is invalid or missing."""
 
@@ -33,5 +37,17 @@ class ExistingItemError(Exception):
     pass
 
 
+class UploadOffsetError(Exception):
+    """Raise when a chunk of a resumable upload does not continue the upload."""
+
+    def __init__(self, message: str, offset: int):
+        self.offset = offset
+        super().__init__(message)
+
+
 class NoItemsError(Exception):
     pass
+
+
+class UnsupportedSearchError(Exception):
+    """Raise when a search cannot be handled without calibredb."""
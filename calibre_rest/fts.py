@@ -0,0 +1,235 @@
+import html
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from calibre_rest.sqlite import SQLiteReader, chunks, db_version, read_transaction
+
+HTML_TAG_REGEX = re.compile(r"<[^>]+>")
+WORD_REGEX = re.compile(r"\w+")
+
+
+class FullTextIndex:
+    """Side-car SQLite FTS5 index of the library's text metadata.
+
+    The index lives in its own database file and is never written into
+    metadata.db. It covers title, authors, tags, series, publisher and
+    comments and is kept up to date incrementally: books with a last_modified
+    newer than the last sync, books that were added or removed and books
+    invalidated by writes made through CalibreWrapper are re-indexed. Like
+    BookIndex, metadata.db is polled for changes at most once every
+    REFRESH_INTERVAL seconds.
+    """
+
+    REFRESH_INTERVAL = 1.0
+    COLUMNS = ("title", "authors", "tags", "series", "publisher", "comments")
+    # bm25 weight of each column, so that title and author matches rank first
+    WEIGHTS = (10.0, 8.0, 4.0, 4.0, 2.0, 1.0)
+
+    SCHEMA = (
+        "CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5("
+        f"{', '.join(COLUMNS)}, tokenize='unicode61 remove_diacritics 2')",
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+    )
+
+    def __init__(
+        self, reader: SQLiteReader, path: str, logger: logging.Logger = None
+    ) -> None:
+        """Initialize the full-text index. Use refresh() to build it.
+
+        Args:
+            reader (SQLiteReader): Reader used to read books from metadata.db
+            path (str): Path to the side-car database file
+            logger (logging.Logger): Custom logger object
+        """
+        if logger is None:
+            logger = logging.getLogger(__name__)
+        self.logger = logger
+
+        self.reader = reader
+        self.path = os.path.abspath(path)
+        if self.path == os.path.abspath(reader.db_path):
+            raise ValueError("Full-text index cannot be stored in metadata.db")
+
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.dirty = set()
+
+        self.version = None
+        self.checked = 0.0
+
+    def connect(self) -> sqlite3.Connection:
+        """Return this thread's connection to the side-car database."""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.path, timeout=10, isolation_level=None, check_same_thread=False
+            )
+            conn.execute("PRAGMA journal_mode = WAL")
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            self.local.conn = conn
+        return conn
+
+    def close(self) -> None:
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def invalidate(self, ids: list[int]) -> None:
+        """Mark books as changed so they are re-indexed before the next search."""
+        with self.lock:
+            self.dirty.update(int(i) for i in ids)
+
+    def refresh(self, force: bool = False) -> None:
+        """Bring the index up to date with metadata.db.
+
+        The first refresh of a new (or rebuilt) side-car database indexes
+        every book. Later refreshes only re-index books that changed since
+        the stored last_modified watermark.
+
+        Args:
+            force (bool): Check metadata.db even if it was checked less than
+                REFRESH_INTERVAL seconds ago
+        """
+        with self.lock:
+            now = time.monotonic()
+            if (
+                not force
+                and not len(self.dirty)
+                and now - self.checked < self.REFRESH_INTERVAL
+            ):
+                return
+            self.checked = now
+
+            version = db_version(self.reader.db_path)
+            ids = set(self.dirty)
+            removed = set()
+
+            fts = self.connect()
+            meta = dict(fts.execute("SELECT key, value FROM meta").fetchall())
+            watermark = meta.get("watermark", "")
+
+            conn = self.reader.connect()
+            with read_transaction(conn):
+                (library_id,) = conn.execute(
+                    "SELECT uuid FROM library_id"
+                ).fetchone() or ("",)
+                rebuild = meta.get("library_id") != library_id
+                if rebuild:
+                    # new side-car or a different library, index everything
+                    watermark = ""
+
+                if rebuild or version != self.version:
+                    all_ids = {row[0] for row in conn.execute("SELECT id FROM books")}
+                    indexed = {
+                        row[0] for row in fts.execute("SELECT rowid FROM books_fts")
+                    }
+                    removed = indexed - all_ids
+                    ids |= all_ids - indexed
+
+                    # timestamps share one format, so they compare as text
+                    query = "SELECT id FROM books WHERE last_modified >= ?"
+                    ids |= {row[0] for row in conn.execute(query, (watermark,))}
+                    (watermark,) = conn.execute(
+                        "SELECT coalesce(max(last_modified), '') FROM books"
+                    ).fetchone()
+
+                rows = {}
+                if len(ids):
+                    # only the indexed fields are read from metadata.db
+                    rows = self.reader.load_rows(conn, list(ids), self.COLUMNS)
+
+            if not len(ids) and not len(removed) and not rebuild:
+                self.version = version
+                return
+
+            fts.execute("BEGIN IMMEDIATE")
+            try:
+                if rebuild:
+                    fts.execute("DELETE FROM books_fts")
+                for chunk in chunks(list(ids | removed), self.reader.CHUNK_SIZE):
+                    marks = ",".join("?" * len(chunk))
+                    fts.execute(
+                        f"DELETE FROM books_fts WHERE rowid IN ({marks})", chunk
+                    )
+                fts.executemany(
+                    f"INSERT INTO books_fts (rowid, {', '.join(self.COLUMNS)}) "
+                    f"VALUES (?{', ?' * len(self.COLUMNS)})",
+                    (document(row) for row in rows.values()),
+                )
+                fts.executemany(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                    (("library_id", library_id), ("watermark", watermark)),
+                )
+                fts.execute("COMMIT")
+            except Exception:
+                fts.execute("ROLLBACK")
+                raise
+
+            self.dirty.clear()
+            self.version = version
+
+        if len(ids) or len(removed):
+            self.logger.debug(
+                f"Refreshed full-text index: {len(rows)} indexed, "
+                f"{len(ids) + len(removed) - len(rows)} removed"
+            )
+
+    def search(self, q: str) -> list[int]:
+        """Search the index.
+
+        Every word in q must match. The last word also matches as a prefix so
+        that results can be shown while the user is still typing.
+
+        Args:
+            q (str): Free-text query
+
+        Returns:
+            list[int]: Ids of matching books, best match first
+
+        Raises:
+            ValueError: q does not contain any words
+        """
+        expr = match_expression(q)
+        self.refresh()
+
+        weights = ", ".join(str(w) for w in self.WEIGHTS)
+        query = (
+            "SELECT rowid FROM books_fts WHERE books_fts MATCH ? "
+            f"ORDER BY bm25(books_fts, {weights}), rowid"
+        )
+        return [row[0] for row in self.connect().execute(query, (expr,))]
+
+
+def match_expression(q: str) -> str:
+    """Build an FTS5 MATCH expression from free text.
+
+    Words are quoted so that FTS5 operators and punctuation in q are matched
+    literally instead of being interpreted.
+    """
+    words = WORD_REGEX.findall(q or "")
+    if not len(words):
+        raise ValueError("Full-text query must contain at least one word")
+
+    terms = [f'"{w}"' for w in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def document(row: dict) -> tuple:
+    """Convert a row from SQLiteReader.load_rows() into an FTS5 row."""
+    comments = HTML_TAG_REGEX.sub(" ", row.get("comments", ""))
+    return (
+        row["id"],
+        row.get("title", ""),
+        row.get("authors", ""),
+        " ".join(row.get("tags", [])),
+        row.get("series", ""),
+        row.get("publisher", ""),
+        html.unescape(comments),
+    )
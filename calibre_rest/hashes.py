@@ -0,0 +1,246 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from calibre_rest.sqlite import SQLiteReader, chunks, read_transaction
+
+
+class HashIndex:
+    """Side-car SQLite index of the SHA-256 hashes of the library's files.
+
+    The index maps the hash of every format file in the library to its book,
+    so that uploads of files that are already in the library can be
+    recognized without running calibredb add. Like FullTextIndex, it lives
+    in its own database file and is never written into metadata.db.
+
+    Each entry records the path of the format file, relative to the library,
+    with its size and modification time. An entry whose file was changed or
+    removed since it was hashed is dropped when it is looked up, so a stale
+    index only ever misses a duplicate and never reports a book that no
+    longer has the file.
+    """
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS hashes ("
+        "sha256 TEXT NOT NULL, book_id INTEGER NOT NULL, path TEXT NOT NULL, "
+        "size INTEGER NOT NULL, mtime INTEGER NOT NULL, "
+        "PRIMARY KEY (sha256, book_id, path))",
+        "CREATE INDEX IF NOT EXISTS hashes_book_id ON hashes (book_id)",
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)",
+    )
+
+    def __init__(
+        self, reader: SQLiteReader, path: str, logger: logging.Logger = None
+    ) -> None:
+        """Initialize the hash index. Use load() to build it.
+
+        Args:
+            reader (SQLiteReader): Reader used to find the format files of
+                each book in metadata.db
+            path (str): Path to the side-car database file
+            logger (logging.Logger): Custom logger object
+        """
+        if logger is None:
+            logger = logging.getLogger(__name__)
+        self.logger = logger
+
+        self.reader = reader
+        self.path = os.path.abspath(path)
+        if self.path == os.path.abspath(reader.db_path):
+            raise ValueError("Hash index cannot be stored in metadata.db")
+
+        self.local = threading.local()
+
+    def connect(self) -> sqlite3.Connection:
+        """Return this thread's connection to the side-car database."""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.path, timeout=10, isolation_level=None, check_same_thread=False
+            )
+            conn.execute("PRAGMA journal_mode = WAL")
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+            self.local.conn = conn
+        return conn
+
+    def close(self) -> None:
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def load(self, workers: int = None) -> None:
+        """Build the index if it was never built for this library."""
+        meta = dict(self.connect().execute("SELECT key, value FROM meta").fetchall())
+        if meta.get("library_id") != self.library_id():
+            self.build(workers)
+
+    def build(self, workers: int = None) -> None:
+        """Hash every format file in the library and replace the index.
+
+        Files are hashed in parallel. hashlib releases the GIL while hashing,
+        so threads hash several files at once.
+
+        Args:
+            workers (int): Number of files hashed at once. Defaults to the
+                ThreadPoolExecutor default.
+        """
+        library_id = self.library_id()
+        files = self.format_files()
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            entries = [
+                entry
+                for entry in executor.map(lambda f: self.hash_entry(*f), files)
+                if entry is not None
+            ]
+
+        conn = self.connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute("DELETE FROM hashes")
+            conn.executemany(
+                "INSERT OR REPLACE INTO hashes (sha256, book_id, path, size, mtime) "
+                "VALUES (?, ?, ?, ?, ?)",
+                entries,
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                ("library_id", library_id),
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+        self.logger.debug(f"Built hash index: {len(entries)} files hashed")
+
+    def lookup(self, sha256: str) -> list[int]:
+        """Find the books that have a file with the given hash.
+
+        Args:
+            sha256 (str): Hex digest of the file
+
+        Returns:
+            list[int]: Ids of the books, in ascending order
+        """
+        conn = self.connect()
+        rows = conn.execute(
+            "SELECT book_id, path, size, mtime FROM hashes WHERE sha256 = ?",
+            (sha256,),
+        ).fetchall()
+
+        ids = set()
+        for book_id, relpath, size, mtime in rows:
+            if file_stat(os.path.join(self.reader.lib, relpath)) == (size, mtime):
+                ids.add(book_id)
+            else:
+                conn.execute(
+                    "DELETE FROM hashes WHERE sha256 = ? AND book_id = ? AND path = ?",
+                    (sha256, book_id, relpath),
+                )
+        return sorted(ids)
+
+    def record(self, sha256: str, id: int, ext: str) -> None:
+        """Record that a book was added from a file with the given hash.
+
+        The entry is attached to the book's format file of the same
+        extension. Nothing is recorded if the book has no such file.
+
+        Args:
+            sha256 (str): Hex digest of the uploaded file
+            id (int): Book id
+            ext (str): Extension of the uploaded file
+        """
+        ext = ext.lstrip(".").lower()
+        for book_id, relpath in self.format_files([id]):
+            if not relpath.lower().endswith(f".{ext}"):
+                continue
+
+            stat = file_stat(os.path.join(self.reader.lib, relpath))
+            if stat is not None:
+                self.connect().execute(
+                    "INSERT OR REPLACE INTO hashes (sha256, book_id, path, size, "
+                    "mtime) VALUES (?, ?, ?, ?, ?)",
+                    (sha256, book_id, relpath, *stat),
+                )
+
+    def remove(self, ids: list[int]) -> None:
+        """Remove the entries of removed books."""
+        conn = self.connect()
+        for chunk in chunks([int(i) for i in ids], self.reader.CHUNK_SIZE):
+            marks = ",".join("?" * len(chunk))
+            conn.execute(f"DELETE FROM hashes WHERE book_id IN ({marks})", chunk)
+
+    def library_id(self) -> str:
+        conn = self.reader.connect()
+        with read_transaction(conn):
+            (library_id,) = conn.execute("SELECT uuid FROM library_id").fetchone() or (
+                "",
+            )
+        return library_id
+
+    def format_files(self, ids: list[int] = None) -> list[tuple[int, str]]:
+        """List the format files of books in metadata.db.
+
+        Args:
+            ids (list[int]): Book ids. Every book if None.
+
+        Returns:
+            list[tuple[int, str]]: Book id and path of each file, relative to
+                the library
+        """
+        query = (
+            "SELECT books.id, books.path, data.name, data.format FROM data "
+            "JOIN books ON books.id = data.book"
+        )
+        conn = self.reader.connect()
+        rows = []
+        with read_transaction(conn):
+            if ids is None:
+                rows = conn.execute(query).fetchall()
+            else:
+                for chunk in chunks([int(i) for i in ids], self.reader.CHUNK_SIZE):
+                    marks = ",".join("?" * len(chunk))
+                    rows += conn.execute(
+                        f"{query} WHERE books.id IN ({marks})", chunk
+                    ).fetchall()
+
+        return [
+            (id, os.path.join(book_path, f"{name}.{fmt.lower()}"))
+            for id, book_path, name, fmt in rows
+        ]
+
+    def hash_entry(self, id: int, relpath: str) -> tuple | None:
+        """Hash a format file into an index entry, or None if it is missing."""
+        filepath = os.path.join(self.reader.lib, relpath)
+        try:
+            stat = file_stat(filepath)
+            sha256 = hash_file(filepath)
+        except OSError as exc:
+            self.logger.warning(f"Failed to hash {filepath}: {exc}")
+            return None
+        if stat is None:
+            return None
+        return (sha256, id, relpath, *stat)
+
+
+def hash_file(filepath: str) -> str:
+    """Get the SHA-256 hex digest of a file."""
+    with open(filepath, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def file_stat(filepath: str) -> tuple[int, int] | None:
+    """Get the size and modification time (ns) of a file, or None if it does
+    not exist.
+    """
+    try:
+        stat = os.stat(filepath)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
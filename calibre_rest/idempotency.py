@@ -0,0 +1,199 @@
+import functools
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+from flask import abort
+from flask import current_app as app
+from flask import make_response, request
+
+# Headers of a response that are replayed with it
+REPLAYED_HEADERS = ("Content-Type", "Location")
+FORM_MIMETYPES = ("multipart/form-data", "application/x-www-form-urlencoded")
+
+
+class IdempotencyStore:
+    """Responses of requests made with an Idempotency-Key header.
+
+    A client that retries a request with the same key gets the response of
+    the first request back instead of running it again. Keys are kept in a
+    small SQLite database for TTL seconds.
+
+    A key is claimed before its request runs, so a retry that arrives while
+    the first request is still running can be told apart from a new
+    request. A claim that was never completed, because the server stopped
+    while running the request, is taken over after PENDING_TTL seconds.
+    """
+
+    TTL = 24 * 60 * 60
+    PENDING_TTL = 10 * 60
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS responses ("
+        "key TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, status INTEGER, "
+        "headers TEXT, body TEXT, created REAL NOT NULL)",
+    )
+
+    def __init__(self, path: str) -> None:
+        """Initialize the store.
+
+        Args:
+            path (str): Path to the database file
+        """
+        self.path = os.path.abspath(path)
+
+    def connect(self) -> sqlite3.Connection:
+        """Open a new connection to the database.
+
+        Like JobQueue.connect(), connections are not cached so that the store
+        can be used before and after gunicorn forks its workers.
+        """
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode = WAL")
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+        return conn
+
+    def claim(self, key: str, fingerprint: str) -> dict | None:
+        """Claim a key for a request, unless it was used before.
+
+        Args:
+            key (str): Idempotency key
+            fingerprint (str): Identifies the request the key is used with,
+                e.g. its method, path and body digest
+
+        Returns:
+            dict: The earlier use of the key, with its fingerprint and, once
+                its request completed, the status, headers and body of the
+                response (None while it runs). None if the key was claimed.
+        """
+        now = time.time()
+        with closing(self.connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "DELETE FROM responses WHERE created < ? "
+                    "OR (status IS NULL AND created < ?)",
+                    (now - self.TTL, now - self.PENDING_TTL),
+                )
+                row = conn.execute(
+                    "SELECT fingerprint, status, headers, body FROM responses "
+                    "WHERE key = ?",
+                    (key,),
+                ).fetchone()
+                if row is None:
+                    conn.execute(
+                        "INSERT INTO responses (key, fingerprint, created) "
+                        "VALUES (?, ?, ?)",
+                        (key, fingerprint, now),
+                    )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+        if row is None:
+            return None
+
+        fingerprint, status, headers, body = row
+        return {
+            "fingerprint": fingerprint,
+            "status": status,
+            "headers": json.loads(headers) if headers is not None else None,
+            "body": body,
+        }
+
+    def complete(self, key: str, status: int, headers: dict, body: str) -> None:
+        """Store the response of a claimed key's request."""
+        with closing(self.connect()) as conn:
+            conn.execute(
+                "UPDATE responses SET status = ?, headers = ?, body = ? "
+                "WHERE key = ?",
+                (status, json.dumps(headers), body, key),
+            )
+
+    def release(self, key: str) -> None:
+        """Release a claimed key whose request failed, so it can be retried."""
+        with closing(self.connect()) as conn:
+            conn.execute(
+                "DELETE FROM responses WHERE key = ? AND status IS NULL", (key,)
+            )
+
+
+def body_digest() -> str:
+    """Get the SHA-256 digest of the request body.
+
+    Form bodies are digested by their fields and the SHA-256 of each uploaded
+    file, which SpoolRequest computed while spooling it, so that uploads are
+    not read again.
+    """
+    if request.mimetype in FORM_MIMETYPES:
+        form = sorted(request.form.items(multi=True))
+        files = [
+            (name, file.filename, file.stream.hexdigest())
+            for name, file in request.files.items(multi=True)
+        ]
+        body = json.dumps([form, files]).encode("utf-8")
+    else:
+        body = request.get_data()
+    return hashlib.sha256(body).hexdigest()
+
+
+def idempotent(view):
+    """Replay the response of an earlier request with the same Idempotency-Key.
+
+    Requests without the header run as usual. Successful (2xx) responses are
+    stored, while a failed request releases its key so that it can be
+    retried. Replayed responses have an Idempotent-Replayed header.
+
+    Raises:
+        HTTPException: 400 for an invalid key, 409 if a request with the key
+            is still running, 422 if the key was used with another endpoint
+            or body
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        if key is None:
+            return view(*args, **kwargs)
+        if not 0 < len(key) <= 255:
+            abort(400, "Idempotency-Key must be 1 to 255 characters long")
+
+        store = app.config["IDEMPOTENCY_STORE"]
+        endpoint = f"{request.method} {request.path}"
+        fingerprint = f"{endpoint} {body_digest()}"
+        earlier = store.claim(key, fingerprint)
+        if earlier is not None:
+            if earlier["fingerprint"] != fingerprint:
+                used = earlier["fingerprint"].rsplit(" ", 1)[0]
+                if used == endpoint:
+                    abort(422, "Idempotency-Key was used with another request body")
+                abort(422, f"Idempotency-Key was used with {used}")
+            if earlier["status"] is None:
+                abort(409, "A request with this Idempotency-Key is still running")
+
+            resp = make_response(earlier["body"], earlier["status"])
+            resp.headers.update(earlier["headers"])
+            resp.headers["Idempotent-Replayed"] = "true"
+            return resp
+
+        try:
+            resp = make_response(view(*args, **kwargs))
+        except BaseException:
+            store.release(key)
+            raise
+
+        if 200 <= resp.status_code < 300:
+            headers = {
+                h: resp.headers[h] for h in REPLAYED_HEADERS if h in resp.headers
+            }
+            store.complete(key, resp.status_code, headers, resp.get_data(as_text=True))
+        else:
+            store.release(key)
+        return resp
+
+    return wrapper
@@ -0,0 +1,456 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from typing import Iterator, NamedTuple
+
+from calibre_rest import search as search_parser
+from calibre_rest.errors import UnsupportedSearchError
+from calibre_rest.models import Book
+from calibre_rest.sqlite import (
+    SQLiteReader,
+    collation_key,
+    db_version,
+    read_transaction,
+    sort_keys,
+)
+
+
+class BookRecord(NamedTuple):
+    """Compact, immutable in-memory copy of a book.
+
+    Holds the same fields as Book plus the title's sort value. Multi-valued
+    fields are stored as tuples.
+    """
+
+    authors: str
+    author_sort: str
+    comments: str
+    cover: str
+    formats: tuple
+    id: int
+    identifiers: dict
+    isbn: str
+    languages: tuple
+    last_modified: str
+    pubdate: str
+    publisher: str
+    rating: int
+    series: str
+    series_index: float
+    size: int
+    tags: tuple
+    timestamp: str
+    title: str
+    title_sort: str
+    uuid: str
+
+    @classmethod
+    def from_row(cls, row: dict):
+        return cls(
+            authors=row.get("authors", ""),
+            author_sort=row.get("author_sort") or "",
+            comments=row.get("comments", ""),
+            cover=row.get("cover", ""),
+            formats=tuple(row.get("formats", ())),
+            id=row["id"],
+            identifiers=row.get("identifiers", {}),
+            isbn=row.get("isbn", ""),
+            languages=tuple(row.get("languages", ())),
+            last_modified=row.get("last_modified", ""),
+            pubdate=row.get("pubdate", ""),
+            publisher=row.get("publisher", ""),
+            rating=row.get("rating", 0),
+            series=row.get("series", ""),
+            series_index=row.get("series_index", 0.0),
+            size=row.get("size", 0),
+            tags=tuple(row.get("tags", ())),
+            timestamp=row.get("timestamp", ""),
+            title=row.get("title", ""),
+            title_sort=row.get("sort", ""),
+            uuid=row.get("uuid") or "",
+        )
+
+    def to_book(self) -> Book:
+        return Book(
+            authors=self.authors,
+            author_sort=self.author_sort,
+            comments=self.comments,
+            cover=self.cover,
+            formats=list(self.formats),
+            id=self.id,
+            identifiers=dict(self.identifiers),
+            isbn=self.isbn,
+            languages=list(self.languages),
+            last_modified=self.last_modified,
+            pubdate=self.pubdate,
+            publisher=self.publisher,
+            rating=self.rating,
+            series=self.series,
+            series_index=self.series_index,
+            size=self.size,
+            tags=list(self.tags),
+            timestamp=self.timestamp,
+            title=self.title,
+            uuid=self.uuid,
+        )
+
+
+class BookIndex:
+    """In-process index of every book in the library.
+
+    The index is loaded once from metadata.db and then kept up to date
+    incrementally. Before serving a read, the modification time of metadata.db
+    (and its WAL file) is polled at most once every REFRESH_INTERVAL seconds.
+    When it has changed, only books that were added, removed or have a newer
+    last_modified are re-read. Writes made through CalibreWrapper invalidate
+    the ids they touch so that they are visible on the very next read.
+
+    The most common sort keys (ORDERED_KEYS) are kept presorted as arrays of
+    (sort value, id), so a page sorted by one of them without a search is a
+    slice instead of a sort of the whole library. Other sorts use the
+    precomputed arrays as ranks. Text is sorted case and accent insensitively.
+
+    Filtering supports the same subset of calibre's search grammar as
+    SQLiteReader (see search.parse()). Other searches are not supported by
+    the index.
+    """
+
+    REFRESH_INTERVAL = 1.0
+
+    # Sort key functions. These sort the same values as
+    # SQLiteReader.SORT_COLUMNS.
+    SORT_KEYS = {
+        "author_sort": lambda r: collation_key(r.author_sort),
+        "authors": lambda r: collation_key(r.author_sort),
+        "comments": lambda r: collation_key(r.comments),
+        "cover": lambda r: int(bool(r.cover)),
+        "formats": lambda r: ",".join(
+            sorted(os.path.splitext(f)[1][1:].upper() for f in r.formats)
+        ),
+        "id": lambda r: r.id,
+        "identifiers": lambda r: ",".join(f"{k}:{v}" for k, v in r.identifiers.items()),
+        "isbn": lambda r: r.isbn,
+        "languages": lambda r: ",".join(r.languages),
+        "last_modified": lambda r: r.last_modified,
+        "pubdate": lambda r: r.pubdate,
+        "publisher": lambda r: collation_key(r.publisher),
+        "rating": lambda r: r.rating,
+        "series": lambda r: (collation_key(r.series), r.series_index),
+        "series_index": lambda r: r.series_index,
+        "size": lambda r: r.size,
+        "tags": lambda r: collation_key(",".join(r.tags)),
+        "timestamp": lambda r: r.timestamp,
+        "title": lambda r: collation_key(r.title_sort),
+        "uuid": lambda r: r.uuid,
+    }
+
+    # Sort keys kept presorted, and keys that share the same values
+    ORDERED_KEYS = ("id", "title", "author_sort", "series", "pubdate", "timestamp")
+    ORDERED_ALIASES = {"authors": "author_sort"}
+
+    # Fields that may be searched and the values they are matched against
+    SEARCH_FIELDS = {
+        "authors": lambda r: r.authors.split(" & ") if r.authors else [],
+        "comments": lambda r: [r.comments],
+        "formats": lambda r: [os.path.splitext(f)[1][1:].upper() for f in r.formats],
+        "id": lambda r: r.id,
+        "publisher": lambda r: [r.publisher],
+        # ratings are stored as 0-10 but searched as 0-5 stars
+        "rating": lambda r: (r.rating or 0) / 2,
+        "series": lambda r: [r.series],
+        "series_index": lambda r: r.series_index,
+        "tags": lambda r: r.tags,
+        "title": lambda r: [r.title],
+        "uuid": lambda r: [r.uuid],
+    }
+
+    def __init__(self, reader: SQLiteReader, logger: logging.Logger = None) -> None:
+        """Initialize an empty book index. Use load() to populate it.
+
+        Args:
+            reader (SQLiteReader): Reader used to read books from metadata.db
+            logger (logging.Logger): Custom logger object
+        """
+        if logger is None:
+            logger = logging.getLogger(__name__)
+        self.logger = logger
+
+        self.reader = reader
+        self.records = {}
+        self.orders = {key: [] for key in self.ORDERED_KEYS}
+        self.ranks = {}
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+        self.version = None
+        self.watermark = ""
+        self.checked = 0.0
+
+    def load(self) -> None:
+        """Load every book in the library into the index."""
+        with self.lock:
+            version = db_version(self.reader.db_path)
+            conn = self.reader.connect()
+            with read_transaction(conn):
+                ids = [row[0] for row in conn.execute("SELECT id FROM books")]
+                watermark = self._max_last_modified(conn)
+                rows = self.reader.load_rows(conn, ids)
+
+            self.records = {id: BookRecord.from_row(row) for id, row in rows.items()}
+            self.orders = {
+                key: sorted(
+                    (self.SORT_KEYS[key](r), r.id) for r in self.records.values()
+                )
+                for key in self.ORDERED_KEYS
+            }
+            self.ranks = {}
+            self.dirty.clear()
+            self.version = version
+            self.watermark = watermark
+            self.checked = time.monotonic()
+
+        self.logger.info(f"Loaded {len(self.records)} books into index")
+
+    def invalidate(self, ids: list[int]) -> None:
+        """Mark books as changed so they are re-read before the next read."""
+        with self.lock:
+            self.dirty.update(int(i) for i in ids)
+
+    def refresh(self, force: bool = False) -> None:
+        """Bring the index up to date with metadata.db.
+
+        Only invalidated books and, if metadata.db has been modified since the
+        last refresh, books that were added, removed or modified are re-read.
+
+        Args:
+            force (bool): Check metadata.db even if it was checked less than
+                REFRESH_INTERVAL seconds ago
+        """
+        with self.lock:
+            now = time.monotonic()
+            if (
+                not force
+                and not len(self.dirty)
+                and now - self.checked < self.REFRESH_INTERVAL
+            ):
+                return
+            self.checked = now
+
+            version = db_version(self.reader.db_path)
+            ids = set(self.dirty)
+            removed = set()
+            watermark = self.watermark
+
+            conn = self.reader.connect()
+            with read_transaction(conn):
+                if version != self.version:
+                    all_ids = {row[0] for row in conn.execute("SELECT id FROM books")}
+                    removed = self.records.keys() - all_ids
+                    ids |= all_ids - self.records.keys()
+
+                    # timestamps share one format, so they compare as text
+                    query = "SELECT id FROM books WHERE last_modified >= ?"
+                    ids |= {row[0] for row in conn.execute(query, (watermark,))}
+                    watermark = self._max_last_modified(conn)
+
+                rows = self.reader.load_rows(conn, list(ids)) if len(ids) else {}
+
+            if not len(ids) and not len(removed):
+                self.version = version
+                return
+
+            # copy on write, as readers iterate over records without the lock
+            records = dict(self.records)
+            orders = {key: list(order) for key, order in self.orders.items()}
+            for id in removed | ids:
+                old = records.pop(id, None)
+                if old is not None:
+                    for key, order in orders.items():
+                        entry = (self.SORT_KEYS[key](old), id)
+                        del order[bisect.bisect_left(order, entry)]
+
+                if id in rows:
+                    new = records[id] = BookRecord.from_row(rows[id])
+                    for key, order in orders.items():
+                        bisect.insort(order, (self.SORT_KEYS[key](new), id))
+
+            self.records = records
+            self.orders = orders
+            self.ranks = {}
+            self.dirty.clear()
+            self.version = version
+            self.watermark = watermark
+
+        if len(ids) or len(removed):
+            self.logger.debug(
+                f"Refreshed index: {len(ids)} updated, {len(removed)} removed"
+            )
+
+    def supports(self, search: list[str]) -> bool:
+        """Check if the index can serve the given search terms."""
+        try:
+            search_parser.validate(search_parser.parse(search))
+        except UnsupportedSearchError:
+            return False
+        return True
+
+    def get_book(self, id: int) -> Book:
+        """Get book from the index.
+
+        Args:
+            id (int): Book ID
+
+        Returns:
+            Book: Book object or None if the book does not exist
+        """
+        self.refresh()
+        record = self.records.get(id)
+        if record is not None:
+            return record.to_book()
+
+    def get_last_modified(self, id: int) -> str:
+        """Get the last_modified time of a book in the index.
+
+        Returns:
+            str: ISO 8601 time or None if the book does not exist
+        """
+        self.refresh()
+        record = self.records.get(id)
+        if record is not None:
+            return record.last_modified
+
+    def get_books(
+        self,
+        sort: list[str] = None,
+        search: list[str] = None,
+        start: int = 1,
+        limit: int = None,
+    ) -> list[Book]:
+        """Get a page of sorted and filtered books from the index.
+
+        Args:
+            sort (list[str]): List of sort keys to sort results by. Keys
+                prefixed with `-` are sorted in descending order.
+            search (list[str]): List of search terms
+            start (int): 1-based offset of the first book to return
+            limit (int): Maximum number of books to return. Defaults to all.
+
+        Returns:
+            list[Book]: List of books
+        """
+        end = None if limit is None else start - 1 + limit
+        keys = sort_keys(sort, self.SORT_KEYS, self.logger) or [("id", False)]
+
+        # a single presorted key without a search is a slice of its order
+        key, desc = keys[0]
+        key = self.ORDERED_ALIASES.get(key, key)
+        if len(keys) == 1 and key in self.orders and not search:
+            self.refresh()
+            records = self.records
+            order = self.orders[key]
+            if desc:
+                lo = 0 if end is None else max(len(order) - end, 0)
+                hi = max(len(order) - start + 1, 0)
+                page = order[lo:hi][::-1]
+            else:
+                page = order[start - 1 : end]  # noqa: E203
+            return [records[id].to_book() for _, id in page if id in records]
+
+        records = self._sort(self._filter(search), keys)
+        return [r.to_book() for r in records[start - 1 : end]]  # noqa: E203
+
+    def iter_books(
+        self, sort: list[str] = None, search: list[str] = None
+    ) -> Iterator[Book]:
+        """Iterate over every sorted and filtered book in the index.
+
+        Books are built as they are consumed from a snapshot of the index.
+        """
+        keys = sort_keys(sort, self.SORT_KEYS, self.logger) or [("id", False)]
+
+        key, desc = keys[0]
+        key = self.ORDERED_ALIASES.get(key, key)
+        if len(keys) == 1 and key in self.orders and not search:
+            self.refresh()
+            records = self.records
+            order = self.orders[key]
+            ids = (id for _, id in (reversed(order) if desc else order))
+            return (records[id].to_book() for id in ids if id in records)
+
+        records = self._sort(self._filter(search), keys)
+        return (r.to_book() for r in records)
+
+    def get_books_by_ids(self, ids: list[int]) -> list[Book]:
+        """Get books with the given ids from the index, in the order of ids.
+        Ids that do not exist are skipped.
+        """
+        self.refresh()
+        records = self.records
+        return [records[i].to_book() for i in ids if i in records]
+
+    def search_ids(self, search: list[str] = None) -> list[int]:
+        """Get the ids of all books matching search, in ascending order."""
+        return sorted(r.id for r in self._filter(search))
+
+    def count_books(self, search: list[str] = None) -> int:
+        """Count the number of books in the index matching search."""
+        return len(self._filter(search))
+
+    def _filter(self, search: list[str]) -> list[BookRecord]:
+        try:
+            tree = search_parser.parse(search)
+            search_parser.validate(tree)
+        except UnsupportedSearchError as exc:
+            raise ValueError(
+                f"Search {search} is not supported by the index: {exc}"
+            ) from exc
+
+        self.refresh()
+        records = list(self.records.values())
+        if tree is None:
+            return records
+
+        predicate = search_parser.compile_predicate(
+            tree, lambda r, field: self.SEARCH_FIELDS[field](r)
+        )
+        return [r for r in records if predicate(r)]
+
+    def _sort(
+        self, records: list[BookRecord], keys: list[tuple[str, bool]]
+    ) -> list[BookRecord]:
+        """Sort records by (key, descending) pairs.
+
+        Keys may be sorted in different directions, so records are sorted once
+        per key, from the last key to the first, relying on the stability of
+        sorted(). The id breaks ties in the direction of the last key.
+        """
+        records = sorted(records, key=lambda r: r.id, reverse=keys[-1][1])
+        for key, desc in reversed(keys):
+            records.sort(key=self._sort_func(key), reverse=desc)
+        return records
+
+    def _sort_func(self, key: str):
+        key = self.ORDERED_ALIASES.get(key, key)
+        if key not in self.orders:
+            return self.SORT_KEYS[key]
+
+        # dense ranks of presorted keys, where books with equal values share
+        # a rank, are cheaper to compare than the values themselves. Ranks are
+        # cached along with the order they were computed from.
+        order = self.orders[key]
+        order_ranks, ranks = self.ranks.get(key, (None, None))
+        if order_ranks is not order:
+            ranks = {}
+            rank, last = -1, object()
+            for value, id in order:
+                if value != last:
+                    rank, last = rank + 1, value
+                ranks[id] = rank
+            self.ranks[key] = (order, ranks)
+        return lambda r: ranks.get(r.id, -1)
+
+    def _max_last_modified(self, conn) -> str:
+        (value,) = conn.execute("SELECT max(last_modified) FROM books").fetchone()
+        return value or ""
@@ -0,0 +1,539 @@
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing
+
+from calibre_rest.lock import FileLock
+from calibre_rest.models import Book
+
+
+class JobQueue:
+    """Queue of library writes that run in the background.
+
+    Jobs are stored in a small SQLite journal and run one at a time by a
+    writer thread, in the order they were submitted. Because the queue lives
+    in the journal, queued jobs survive restarts and every process serving
+    the same journal, e.g. several gunicorn workers, can report on any job.
+    Each process starts its own writer thread, but only the thread holding
+    an exclusive lock on the journal's lock file runs jobs, for as long as it
+    lives. The others wait for the lock and take over when the process of the
+    writer exits, so jobs never run concurrently or out of order.
+
+    Files that belong to a job (uploads, exports) are kept in a directory per
+    job next to the journal, see job_dir(). Finished jobs and their files are
+    removed TTL seconds after they finished, see expire().
+
+    A claimed job records the pid of the process running it, so that a job
+    whose process was killed mid-run is failed by the other processes, see
+    reap(), instead of staying "running" until the next restart.
+    """
+
+    # Seconds the writer thread sleeps when the queue is empty, before it
+    # checks the journal for jobs submitted by other processes
+    POLL_INTERVAL = 1.0
+    # Seconds between two runs of expire() and reap() by an idle writer thread
+    CLEANUP_INTERVAL = 60.0
+    TTL = 7 * 24 * 60 * 60
+
+    KINDS = ("add", "update", "patch", "delete", "export")
+    # Kinds of jobs that are coalesced into a single calibredb command, the
+    # age of the oldest job before a batch is claimed, and the maximum number
+    # of jobs in a batch
+    BATCH_KINDS = ("add", "delete")
+    BATCH_WINDOW = 0.05
+    BATCH_SIZE = 50
+    STATUSES = ("queued", "running", "succeeded", "failed")
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS jobs ("
+        "id TEXT PRIMARY KEY, kind TEXT NOT NULL, params TEXT NOT NULL, "
+        "status TEXT NOT NULL, result TEXT, error TEXT, "
+        "created REAL NOT NULL, updated REAL NOT NULL, owner INTEGER)",
+        "CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)",
+    )
+
+    def __init__(self, path: str, calibredb, logger: logging.Logger = None) -> None:
+        """Initialize the job queue. Use start() to start the writer thread.
+
+        Args:
+            path (str): Path to the journal database file
+            calibredb (CalibreWrapper): Wrapper that runs the jobs
+            logger (logging.Logger): Custom logger object
+        """
+        if logger is None:
+            logger = logging.getLogger(__name__)
+        self.logger = logger
+
+        self.path = os.path.abspath(path)
+        self.files_dir = os.path.join(os.path.dirname(self.path), "jobs")
+        self.writer_lock = FileLock(f"{self.path}.lock")
+        self.calibredb = calibredb
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.pid = None
+        self.cleaned = 0.0
+
+    def connect(self) -> sqlite3.Connection:
+        """Open a new connection to the journal.
+
+        Connections are not cached, so that the journal can be used before
+        and after gunicorn forks its workers.
+        """
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode = WAL")
+        for statement in self.SCHEMA:
+            conn.execute(statement)
+
+        # journals created before jobs recorded their owner
+        columns = [row[1] for row in conn.execute("PRAGMA table_info(jobs)")]
+        if "owner" not in columns:
+            try:
+                conn.execute("ALTER TABLE jobs ADD COLUMN owner INTEGER")
+            except sqlite3.OperationalError:
+                # added by another process in the meantime
+                pass
+        return conn
+
+    def recover(self) -> None:
+        """Fail the jobs that were running when the server stopped.
+
+        They are not run again, as they may have partially changed the
+        library. Queued jobs are kept and run once the writer thread starts.
+        Call this once on startup, before any writer thread runs.
+        """
+        with closing(self.connect()) as conn:
+            cur = conn.execute(
+                "UPDATE jobs SET status = 'failed', error = ?, updated = ? "
+                "WHERE status = 'running'",
+                ("Job was interrupted by a restart", time.time()),
+            )
+            if cur.rowcount:
+                self.logger.warning(f"Failed {cur.rowcount} interrupted job(s)")
+
+    def reap(self) -> None:
+        """Fail the running jobs whose process exited before finishing them.
+
+        Like recover(), but safe to call while other processes run jobs, as
+        only jobs claimed by a process that no longer exists are failed.
+        """
+        with closing(self.connect()) as conn:
+            owners = [
+                owner
+                for (owner,) in conn.execute(
+                    "SELECT DISTINCT owner FROM jobs "
+                    "WHERE status = 'running' AND owner IS NOT NULL"
+                )
+                if not pid_exists(owner)
+            ]
+            for owner in owners:
+                cur = conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, updated = ? "
+                    "WHERE status = 'running' AND owner = ?",
+                    (
+                        f"Job was interrupted: process {owner} exited",
+                        time.time(),
+                        owner,
+                    ),
+                )
+                if cur.rowcount:
+                    self.logger.warning(
+                        f"Failed {cur.rowcount} job(s) of exited process {owner}"
+                    )
+
+    def expire(self) -> None:
+        """Remove the jobs that finished more than TTL seconds ago, and their
+        files.
+        """
+        cutoff = time.time() - self.TTL
+        with closing(self.connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                ids = [
+                    job_id
+                    for (job_id,) in conn.execute(
+                        "SELECT id FROM jobs "
+                        "WHERE status IN ('succeeded', 'failed') AND updated < ?",
+                        (cutoff,),
+                    )
+                ]
+                conn.executemany(
+                    "DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in ids]
+                )
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+        for job_id in ids:
+            shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+        if len(ids):
+            self.logger.debug(f"Removed {len(ids)} expired job(s)")
+
+    def start(self) -> None:
+        """Start this process' writer thread if it is not running.
+
+        Threads do not survive a fork, so this is also called from submit().
+        """
+        with self.lock:
+            if (
+                self.thread is not None
+                and self.thread.is_alive()
+                and self.pid == os.getpid()
+            ):
+                return
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self._loop, daemon=True)
+            self.thread.start()
+
+    def submit(self, kind: str, params: dict, job_id: str = None) -> dict:
+        """Queue a job.
+
+        Args:
+            kind (str): One of KINDS
+            params (dict): JSON serializable parameters of the job
+            job_id (str): Id of the job, if files were already placed in its
+                job_dir(). A new id is generated if None.
+
+        Returns:
+            dict: The queued job, see get()
+
+        Raises:
+            ValueError: kind is not supported
+        """
+        if kind not in self.KINDS:
+            raise ValueError(f'Job kind "{kind}" not supported')
+
+        if job_id is None:
+            job_id = self.new_id()
+        now = time.time()
+        with closing(self.connect()) as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, kind, params, status, created, updated) "
+                "VALUES (?, ?, ?, 'queued', ?, ?)",
+                (job_id, kind, json.dumps(params), now, now),
+            )
+
+        self.start()
+        self.wakeup.set()
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> dict:
+        """Get a job.
+
+        Returns:
+            dict: id, kind, status, result and error of the job, and its
+                created and updated times in seconds since the epoch. None if
+                the job does not exist.
+        """
+        with closing(self.connect()) as conn:
+            row = conn.execute(
+                "SELECT id, kind, status, result, error, created, updated "
+                "FROM jobs WHERE id = ?",
+                (job_id,),
+            ).fetchone()
+        if row is None:
+            return None
+
+        id, kind, status, result, error, created, updated = row
+        return {
+            "id": id,
+            "kind": kind,
+            "status": status,
+            "result": json.loads(result) if result is not None else None,
+            "error": error,
+            "created": created,
+            "updated": updated,
+        }
+
+    @staticmethod
+    def new_id() -> str:
+        return uuid.uuid4().hex
+
+    def job_dir(self, job_id: str) -> str:
+        """Get the directory that holds the files of a job."""
+        return os.path.join(self.files_dir, job_id)
+
+    def _loop(self) -> None:
+        # held until the process exits, so that this is the only writer
+        with self.writer_lock.write():
+            while True:
+                self.wakeup.clear()
+                try:
+                    ran = self.run_next()
+                except Exception:
+                    # never let the writer thread die, e.g. on a locked journal
+                    self.logger.exception("Failed to run job")
+                    ran = False
+
+                if not ran:
+                    self.cleanup()
+                    self.wakeup.wait(self.POLL_INTERVAL)
+
+    def cleanup(self) -> None:
+        """Run reap() and expire(), at most once every CLEANUP_INTERVAL
+        seconds.
+        """
+        now = time.monotonic()
+        if now - self.cleaned < self.CLEANUP_INTERVAL:
+            return
+        self.cleaned = now
+        try:
+            self.reap()
+            self.expire()
+        except Exception:
+            self.logger.exception("Failed to clean up jobs")
+
+    def run_next(self) -> bool:
+        """Claim and run the oldest queued job, coalesced with the queued jobs
+        right after it if possible, see batch_key().
+
+        Returns:
+            bool: Whether a job was run
+        """
+        with closing(self.connect()) as conn:
+            row = conn.execute(
+                "SELECT kind, created FROM jobs WHERE status = 'queued' "
+                "ORDER BY created, rowid LIMIT 1"
+            ).fetchone()
+        if row is None:
+            return False
+
+        # give concurrent requests a moment to queue jobs that can be
+        # coalesced with this one
+        kind, created = row
+        if kind in self.BATCH_KINDS:
+            time.sleep(max(0.0, created + self.BATCH_WINDOW - time.time()))
+
+        batch = self.claim()
+        if not len(batch):
+            return False
+
+        kind = batch[0][1]
+        if len(batch) == 1:
+            job_id, _, params = batch[0]
+            self.logger.debug(f"Running {kind} job {job_id}")
+            try:
+                outcomes = [("succeeded", self.run(job_id, kind, params), None)]
+            except Exception as exc:
+                outcomes = [("failed", None, error_message(exc))]
+        else:
+            self.logger.debug(f"Running {len(batch)} {kind} jobs in one batch")
+            try:
+                outcomes = self.run_batch(kind, [(j, p) for j, _, p in batch])
+            except Exception as exc:
+                outcomes = [("failed", None, error_message(exc))] * len(batch)
+
+        with closing(self.connect()) as conn:
+            for (job_id, _, _), (status, result, error) in zip(batch, outcomes):
+                if status == "failed":
+                    self.logger.warning(f"{kind} job {job_id} failed: {error}")
+                conn.execute(
+                    "UPDATE jobs SET status = ?, result = ?, error = ?, updated = ? "
+                    "WHERE id = ?",
+                    (status, json.dumps(result), error, time.time(), job_id),
+                )
+        return True
+
+    def claim(self) -> list[tuple[str, str, dict]]:
+        """Mark the oldest queued job, and the queued jobs right after it that
+        can be coalesced with it, as running.
+
+        Returns:
+            list[tuple[str, str, dict]]: id, kind and params of each claimed
+                job, oldest first
+        """
+        with closing(self.connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT id, kind, params FROM jobs WHERE status = 'queued' "
+                "ORDER BY created, rowid LIMIT ?",
+                (self.BATCH_SIZE,),
+            ).fetchall()
+
+            batch = []
+            for job_id, kind, params in rows:
+                params = json.loads(params)
+                if len(batch):
+                    # stop at the first job that cannot join, to keep the order
+                    key = self.batch_key(kind, params)
+                    if key is None or key != self.batch_key(batch[0][1], batch[0][2]):
+                        break
+                batch.append((job_id, kind, params))
+                if self.batch_key(kind, params) is None:
+                    break
+
+            now = time.time()
+            pid = os.getpid()
+            conn.executemany(
+                "UPDATE jobs SET status = 'running', updated = ?, owner = ? "
+                "WHERE id = ?",
+                [(now, pid, job_id) for job_id, _, _ in batch],
+            )
+            conn.execute("COMMIT")
+        return batch
+
+    def batch_key(self, kind: str, params: dict):
+        """Get the key of jobs that can run in one calibredb command.
+
+        Adds are coalesced if they share their metadata and automerge mode,
+        as calibredb applies both to every file. Books merged with
+        automerge=overwrite cannot be told apart, so these adds run alone, as
+        do the adds to a remote library, whose books cannot be matched to
+        their files. Deletes are always coalesced.
+
+        Returns:
+            Hashable key, or None if the job must run alone
+        """
+        if (
+            kind == "add"
+            and params["automerge"] in ("ignore", "new_record")
+            and self.calibredb.server is None
+        ):
+            return (
+                kind,
+                params["automerge"],
+                json.dumps(params["book"], sort_keys=True),
+            )
+        if kind == "delete":
+            return (kind,)
+        return None
+
+    def run_batch(self, kind: str, batch: list[tuple[str, dict]]) -> list[tuple]:
+        """Run jobs of the same batch_key() with a single calibredb command.
+
+        Returns:
+            list[tuple]: status, result and error of each job
+        """
+        if kind == "delete":
+            ids = list(dict.fromkeys(id for _, params in batch for id in params["ids"]))
+            self.calibredb.remove(ids)
+            existing = self.calibredb.existing_ids(ids)
+
+            outcomes = []
+            for _, params in batch:
+                remaining = [id for id in params["ids"] if id in existing]
+                if len(remaining):
+                    error = f"book {remaining[0]} was not deleted"
+                    outcomes.append(("failed", None, error))
+                else:
+                    outcomes.append(("succeeded", {"ids": params["ids"]}, None))
+            return outcomes
+
+        paths = [p for _, params in batch for p in params["paths"]]
+        # jobs journaled before uploads were hashed have no hashes
+        hashes = [
+            h
+            for _, params in batch
+            for h in params.get("hashes") or [None] * len(params["paths"])
+        ]
+        book = Book(**batch[0][1]["book"]) if batch[0][1]["book"] else Book()
+        try:
+            added, ignored = self.calibredb.add_batch(
+                paths, book, batch[0][1]["automerge"], hashes
+            )
+        finally:
+            for job_id, _ in batch:
+                shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+
+        outcomes = []
+        for _, params in batch:
+            job_ids = [added[p] for p in params["paths"] if p in added]
+            exists = [os.path.basename(p) for p in params["paths"] if p in ignored]
+            unmatched = [
+                os.path.basename(p)
+                for p in params["paths"]
+                if p not in added and p not in ignored
+            ]
+            if len(exists):
+                error = (
+                    f"Book {', '.join(exists)} already exists. "
+                    "Include automerge=overwrite to overwrite."
+                )
+                outcomes.append(("failed", {"ids": job_ids}, error))
+            elif len(unmatched):
+                error = (
+                    f"Book {', '.join(unmatched)} could not be matched to an "
+                    "added book"
+                )
+                outcomes.append(("failed", {"ids": job_ids}, error))
+            else:
+                outcomes.append(("succeeded", {"ids": job_ids}, None))
+        return outcomes
+
+    def run(self, job_id: str, kind: str, params: dict) -> dict:
+        """Run a job with the wrapper.
+
+        Returns:
+            dict: JSON serializable result of the job
+
+        Raises:
+            KeyError: A book does not exist
+            Exception: Any error raised by the wrapper
+        """
+        if kind == "add":
+            try:
+                book = Book(**params["book"]) if params["book"] else Book()
+                ids = self.calibredb.add_multiple(
+                    params["paths"], book, params["automerge"], params.get("hashes")
+                )
+            finally:
+                # the uploads are only needed until they are added
+                shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+            return {"ids": ids}
+
+        if kind == "update":
+            id = self.calibredb.set_metadata(params["id"], Book(**params["book"]))
+            if id == -1:
+                raise KeyError(f"book {params['id']} does not exist")
+            return {"ids": [id]}
+
+        if kind == "patch":
+            updates = [(id, Book(**fields)) for id, fields in params["updates"]]
+            return {"books": list(self.calibredb.update_books(updates))}
+
+        if kind == "delete":
+            self.calibredb.remove(params["ids"])
+            remaining = self.calibredb.existing_ids(params["ids"])
+            for id in params["ids"]:
+                if id in remaining:
+                    raise RuntimeError(f"book {id} was not deleted")
+            return {"ids": params["ids"]}
+
+        if kind == "export":
+            exports_dir = self.job_dir(job_id)
+            os.makedirs(exports_dir, exist_ok=True)
+            self.calibredb.export(params["ids"], exports_dir)
+            files = sorted(
+                f
+                for f in os.listdir(exports_dir)
+                if os.path.isfile(os.path.join(exports_dir, f))
+            )
+            return {"ids": params["ids"], "files": files}
+
+        raise ValueError(f'Job kind "{kind}" not supported')
+
+
+def pid_exists(pid: int) -> bool:
+    """Check if a process with the given pid is running on this host."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # the process exists, but belongs to another user
+        return True
+    return True
+
+
+def error_message(exc: Exception) -> str:
+    # str() of a KeyError is the repr of its message
+    if isinstance(exc, KeyError) and exc.args:
+        return exc.args[0]
+    return str(exc)
@@ -0,0 +1,150 @@
+import fcntl
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+
+class ReadWriteLock:
+    """Readers-writer lock with writer preference.
+
+    Any number of readers may hold the lock at once, while a writer holds it
+    alone. Once a writer is waiting, new readers wait behind it, so a steady
+    stream of reads cannot starve writes.
+
+    The time spent waiting for the lock is recorded for each mode, see
+    metrics().
+    """
+
+    MODES = ("read", "write")
+
+    def __init__(self) -> None:
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+        self.stats = {mode: LockStats() for mode in self.MODES}
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        """Hold the lock in shared mode."""
+        start = time.perf_counter()
+        with self.cond:
+            while self.writer or self.waiting_writers:
+                self.cond.wait()
+            self.readers += 1
+            self.stats["read"].record(time.perf_counter() - start)
+
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.readers -= 1
+                if not self.readers:
+                    self.cond.notify_all()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        """Hold the lock in exclusive mode."""
+        start = time.perf_counter()
+        with self.cond:
+            self.waiting_writers += 1
+            try:
+                while self.writer or self.readers:
+                    self.cond.wait()
+            finally:
+                self.waiting_writers -= 1
+            self.writer = True
+            self.stats["write"].record(time.perf_counter() - start)
+
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.writer = False
+                self.cond.notify_all()
+
+    def locked(self) -> bool:
+        """Check if the lock is held in any mode."""
+        with self.cond:
+            return self.writer or self.readers > 0
+
+    def metrics(self) -> dict:
+        """Get the lock wait metrics of each mode.
+
+        Returns:
+            dict: Map of mode to the number of acquisitions and the total and
+                maximum time spent waiting for the lock, in seconds
+        """
+        with self.cond:
+            return {mode: stats.todict() for mode, stats in self.stats.items()}
+
+
+class LockStats:
+    """Wait time statistics of one lock mode. Not thread-safe on its own."""
+
+    def __init__(self) -> None:
+        self.acquired = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record(self, wait: float) -> None:
+        self.acquired += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+
+    def todict(self) -> dict:
+        return {
+            "acquired": self.acquired,
+            "wait_total": self.wait_total,
+            "wait_max": self.wait_max,
+        }
+
+
+class FileLock:
+    """Readers-writer lock shared by every process that uses the same file.
+
+    The lock is an flock(2) on the file, which is created if it does not
+    exist. Each acquisition opens the file anew, so threads of one process
+    lock independently of each other, and the lock is released by the kernel
+    if the process dies while holding it.
+
+    Like ReadWriteLock, the time this process spends waiting for the lock is
+    recorded for each mode, see metrics().
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.stats_lock = threading.Lock()
+        self.stats = {mode: LockStats() for mode in ReadWriteLock.MODES}
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        """Hold the lock in shared mode."""
+        with self._flock(fcntl.LOCK_SH, "read"):
+            yield
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        """Hold the lock in exclusive mode."""
+        with self._flock(fcntl.LOCK_EX, "write"):
+            yield
+
+    @contextmanager
+    def _flock(self, operation: int, mode: str) -> Iterator[None]:
+        start = time.perf_counter()
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, operation)
+            with self.stats_lock:
+                self.stats[mode].record(time.perf_counter() - start)
+            yield
+        finally:
+            # closing the file releases the lock
+            os.close(fd)
+
+    def metrics(self) -> dict:
+        """Get the lock wait metrics of each mode. See ReadWriteLock.metrics()."""
+        with self.stats_lock:
+            return {mode: stats.todict() for mode, stats in self.stats.items()}
@@ -1,4 +1,8 @@
-from dataclasses import dataclass, field
+import base64
+import binascii
+import hashlib
+import json
+from dataclasses import dataclass, field, fields
 from urllib.parse import urlencode, urlsplit, urlunsplit
 
 from jsonschema import Draft202012Validator
@@ -88,24 +92,33 @@ class Book:
         return sorted(cls.v.iter_errors(instance), key=str)
 
 
+BOOK_FIELDS = tuple(f.name for f in fields(Book))
+
+
 class PaginatedResults:
     """Paginate list of books with offset and limit.
 
     Fields:
-        books (list[Book]): Full list of books
+        books (list[Book]): Books in the current page
+        count (int): Total number of books across all pages
         start (int): Start index
         limit (int): Number of books per page
         sort (list[str]): List of sort keys
         search (list[str]): List of search terms
+        q (str): Full-text query
+        fields (list[str]): Book fields to include. Defaults to all.
     """
 
     def __init__(
         self,
         books: list[Book],
+        count: int,
         start: int,
         limit: int,
         sort: list[str] = None,
         search: list[str] = None,
+        q: str = None,
+        fields: list[str] = None,
     ):
         self.base_url = urlsplit("/books")
         self.books = books
@@ -113,12 +126,14 @@ class PaginatedResults:
         self.limit = limit
         self.sort = sort
         self.search = search
+        self.q = q
+        self.fields = fields
 
-        if len(books) < self.start:
+        if count < self.start:
             raise Exception(
-                f"start {self.start} is larger than number of books ({len(books)})"
+                f"start {self.start} is larger than number of books ({count})"
             )
-        self.count = len(books)
+        self.count = count
 
     def build_query(self, start: int):
         params = {"start": start, "limit": self.limit}
@@ -129,6 +144,12 @@ class PaginatedResults:
         if self.search is not None:
             params["search"] = self.search
 
+        if self.q is not None:
+            params["q"] = self.q
+
+        if self.fields is not None:
+            params["fields"] = ",".join(self.fields)
+
         query = urlencode(params, doseq=True)
         return urlunsplit(self.base_url._replace(query=query))
 
@@ -156,9 +177,7 @@ class PaginatedResults:
 
     def todict(self):
         return {
-            "books": self.books[
-                (self.start - 1) : (self.start - 1 + self.limit)  # noqa
-            ],
+            "books": [project(b, self.fields) for b in self.books],
             "metadata": {
                 "start": self.start,
                 "limit": self.limit,
@@ -168,3 +187,155 @@ class PaginatedResults:
                 "next": self.next_page(),
             },
         }
+
+
+class CursorPaginatedResults:
+    """Paginate list of books with opaque cursors.
+
+    Fields:
+        books (list[Book]): Books in the current page
+        count (int): Total number of books across all pages
+        cursor (str): Cursor of the current page. Empty for the first page.
+        prev_cursor (str): Cursor of the previous page. Empty if none.
+        next_cursor (str): Cursor of the next page. Empty if none.
+        limit (int): Number of books per page
+        sort (list[str]): List of sort keys
+        search (list[str]): List of search terms
+        fields (list[str]): Book fields to include. Defaults to all.
+    """
+
+    def __init__(
+        self,
+        books: list[Book],
+        count: int,
+        cursor: str,
+        prev_cursor: str,
+        next_cursor: str,
+        limit: int,
+        sort: list[str] = None,
+        search: list[str] = None,
+        fields: list[str] = None,
+    ):
+        self.base_url = urlsplit("/books")
+        self.books = books
+        self.count = count
+        self.cursor = cursor
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+        self.limit = limit
+        self.sort = sort
+        self.search = search
+        self.fields = fields
+
+    def build_query(self, cursor: str):
+        params = {"cursor": cursor, "limit": self.limit}
+
+        if self.sort is not None:
+            params["sort"] = self.sort
+
+        if self.search is not None:
+            params["search"] = self.search
+
+        if self.fields is not None:
+            params["fields"] = ",".join(self.fields)
+
+        query = urlencode(params, doseq=True)
+        return urlunsplit(self.base_url._replace(query=query))
+
+    def current_page(self):
+        return self.build_query(self.cursor)
+
+    def prev_page(self):
+        if not self.prev_cursor:
+            return ""
+        return self.build_query(self.prev_cursor)
+
+    def next_page(self):
+        if not self.next_cursor:
+            return ""
+        return self.build_query(self.next_cursor)
+
+    def todict(self):
+        return {
+            "books": [project(b, self.fields) for b in self.books],
+            "metadata": {
+                "cursor": self.cursor,
+                "limit": self.limit,
+                "count": self.count,
+                "self": self.current_page(),
+                "prev": self.prev_page(),
+                "next": self.next_page(),
+            },
+        }
+
+
+def parse_fields(values: list[str]) -> list[str]:
+    """Parse a sparse fieldset from the fields query parameter.
+
+    Args:
+        values (list[str]): Comma-separated Book field names. The parameter
+            may also be repeated.
+
+    Returns:
+        list[str]: Unique field names in the order requested, or None if no
+            fields were requested
+
+    Raises:
+        ValueError: A field is not a Book field
+    """
+    names = []
+    for value in values or []:
+        for name in value.split(","):
+            name = name.strip()
+            if name and name not in names:
+                names.append(name)
+
+    if not len(names):
+        return None
+
+    invalid = [n for n in names if n not in BOOK_FIELDS]
+    if len(invalid):
+        raise ValueError(f"Invalid fields: {', '.join(invalid)}")
+    return names
+
+
+def project(book: Book, names: list[str] = None):
+    """Reduce a book to the given fields for serialization.
+
+    Returns:
+        dict | Book: Dict of the given fields, or book itself if names is None
+    """
+    if names is None:
+        return book
+    return {n: getattr(book, n) for n in names}
+
+
+def encode_cursor(data: dict) -> str:
+    """Encode cursor data as an opaque URL-safe string."""
+    raw = json.dumps(data, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def cursor_digest(sort: list[str] = None, search: list[str] = None) -> str:
+    """Digest of the sort keys and search a cursor pages through, so that a
+    cursor is not reused with another query.
+    """
+    raw = json.dumps([sort or [], search or []], separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def decode_cursor(cursor: str) -> dict:
+    """Decode a cursor created by encode_cursor.
+
+    Raises:
+        ValueError: Cursor is malformed
+    """
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except (binascii.Error, UnicodeError, json.JSONDecodeError) as exc:
+        raise ValueError(f"Invalid cursor {cursor}") from exc
+
+    if not isinstance(data, dict):
+        raise ValueError(f"Invalid cursor {cursor}")
+    return data
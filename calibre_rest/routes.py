@@ -1,43 +1,126 @@
+import hashlib
 import json
 import os
 import os.path as path
 import shutil
 import tempfile
+from datetime import datetime
 
-from flask import abort
+from flask import Response, abort
 from flask import current_app as app
-from flask import jsonify, make_response, request, send_from_directory
+from flask import (
+    jsonify,
+    make_response,
+    request,
+    send_from_directory,
+    stream_with_context,
+)
+from werkzeug.datastructures import FileStorage
 from werkzeug.exceptions import HTTPException
-from werkzeug.utils import secure_filename
+from werkzeug.http import http_date, parse_content_range_header, parse_date, quote_etag
 
 from calibre_rest import __version__
+from calibre_rest.calibre import validate_id
 from calibre_rest.errors import (
     CalibreRuntimeError,
+    ContentServerError,
     ExistingItemError,
     InvalidPayloadError,
+    UploadOffsetError,
+)
+from calibre_rest.hashes import hash_file
+from calibre_rest.idempotency import idempotent
+from calibre_rest.models import (
+    Book,
+    CursorPaginatedResults,
+    PaginatedResults,
+    parse_fields,
+    project,
 )
-from calibre_rest.models import Book, PaginatedResults
+from calibre_rest.signatures import valid_signature
+from calibre_rest.uploads import spooled_path
 
 calibredb = app.config["CALIBRE_WRAPPER"]
+jobs = app.config["JOB_QUEUE"]
+uploads = app.config["UPLOAD_STORE"]
 
 
 @app.route("/health")
 def version():
     return response(
         200,
-        jsonify(calibre_version=calibredb.version(), calibre_rest_version=__version__),
+        jsonify(
+            calibre_version=calibredb.version(),
+            calibre_rest_version=__version__,
+            lock=calibredb.lock_metrics(),
+        ),
     )
 
 
 @app.route("/books/<int:id>")
 def get_book(id):
-    """Get book from calibre library."""
+    """Get book from calibre library.
+
+    Responses carry an ETag and Last-Modified derived from the book's
+    last_modified time. A matching If-None-Match or If-Modified-Since returns
+    304 without fetching the book. The book's last_modified time is only
+    read up front for conditional requests.
+
+    Query Parameters:
+        fields (list): Comma-separated book fields to return. Defaults to all.
+    """
+
+    fields = parse_fields(request.args.getlist("fields"))
+
+    last_modified = None
+    if request.if_none_match or request.if_modified_since:
+        last_modified = calibredb.get_last_modified(id)
+    if last_modified is not None:
+        headers = book_cache_headers(id, last_modified, fields)
+        if not_modified(headers):
+            return response(304, "", headers)
 
-    book = calibredb.get_book(id)
+    book = calibredb.get_book(id, fields)
     if not book:
         abort(404, f"book {id} does not exist")
 
-    return response(200, jsonify(books=book))
+    # last_modified is not fetched if it is not one of the fields
+    if book.last_modified:
+        last_modified = book.last_modified
+    elif last_modified is None:
+        last_modified = calibredb.get_last_modified(id)
+    headers = book_cache_headers(id, last_modified, fields)
+    return response(200, jsonify(books=project(book, fields)), headers)
+
+
+@app.route("/books/stream")
+def stream_books():
+    """Stream every book as newline-delimited JSON, one book per line.
+
+    Books are read and sent as the client consumes them, so memory use does
+    not grow with the size of the library.
+
+    Query Parameters:
+        sort (list): Sort results by given field. Supports descending sort with hyphen `-`.
+        search (list): Search query string that supports Calibre's search
+            interface.
+        fields (list): Comma-separated book fields to return. Defaults to all.
+    """
+
+    sort = request.args.getlist("sort") or None
+    search = request.args.getlist("search") or None
+    fields = parse_fields(request.args.getlist("fields"))
+
+    # fail before the response starts, e.g. on invalid sort keys
+    books = calibredb.iter_books(sort, search, fields)
+
+    def generate():
+        for book in books:
+            yield app.json.dumps(project(book, fields)) + "\n"
+
+    return Response(
+        stream_with_context(generate()), 200, mimetype="application/x-ndjson"
+    )
 
 
 @app.route("/books")
@@ -46,38 +129,96 @@ def get_books():
 
     Query Parameters:
         start (int): Offset index.
+        cursor (str): Opaque cursor from a previous page's links. Takes
+            precedence over start. Pass an empty cursor for the first page.
         limit (int): Limit on number of results per page.
         sort (list): Sort results by given field. Supports descending sort with hyphen `-`.
         search (list): Search query string that supports Calibre's search
             interface.
+        q (str): Free-text query. Results are ranked by relevance and cannot
+            be sorted.
+        fields (list): Comma-separated book fields to return. Defaults to all.
+
+    Responses carry an ETag derived from the version of the library and the
+    query string. A matching If-None-Match (or If-Modified-Since) returns 304
+    without reading any books.
+
+    Clients that prefer "application/x-ndjson" in their Accept header get
+    every book streamed, see stream_books(). Streams are not paginated, so
+    start, limit, cursor and q are rejected.
     """
 
-    start = request.args.get("start") or 1
-    limit = request.args.get("limit") or 20
+    accept = request.accept_mimetypes.best_match(
+        ["application/json", "application/x-ndjson"]
+    )
+    if accept == "application/x-ndjson":
+        unsupported = [
+            a for a in ("start", "limit", "cursor", "q") if a in request.args
+        ]
+        if unsupported:
+            abort(
+                400,
+                f"{', '.join(unsupported)} cannot be used with "
+                "Accept: application/x-ndjson",
+            )
+        return stream_books()
+
+    version, modified = calibredb.library_version()
+    headers = cache_headers(f"{version}:{request.full_path}", modified)
+    if not_modified(headers):
+        return response(304, "", headers)
+
+    start = int(request.args.get("start") or 1)
+    cursor = request.args.get("cursor")
+    limit = int(request.args.get("limit") or 20)
     sort = request.args.getlist("sort") or None
     search = request.args.getlist("search") or None
+    q = request.args.get("q")
+    fields = parse_fields(request.args.getlist("fields"))
 
-    books = calibredb.get_books(sort, search, all=False)
-    if not len(books):
-        return response(204, jsonify(books=[]))
+    if q is not None:
+        if sort is not None or cursor is not None:
+            abort(400, "q cannot be combined with sort or cursor")
 
-    try:
-        res = PaginatedResults(books, int(start), int(limit), sort, search)
-    except Exception as exc:
-        abort(400, exc)
+        books, count = calibredb.search_text(q, search, start, limit, fields)
+        if not count:
+            return response(204, jsonify(books=[]), headers)
+        if start > count:
+            abort(400, f"start {start} is larger than number of books ({count})")
+
+        res = PaginatedResults(books, count, start, limit, sort, search, q, fields)
+        return response(200, jsonify(res.todict()), headers)
+
+    count = calibredb.count_books(search)
+    if not count:
+        return response(204, jsonify(books=[]), headers)
 
-    return response(200, jsonify(res.todict()))
+    if cursor is not None:
+        books, prev_cursor, next_cursor = calibredb.get_books_by_cursor(
+            sort, search, cursor, limit, fields
+        )
+        res = CursorPaginatedResults(
+            books, count, cursor, prev_cursor, next_cursor, limit, sort, search, fields
+        )
+        return response(200, jsonify(res.todict()), headers)
+
+    if start > count:
+        abort(400, f"start {start} is larger than number of books ({count})")
+
+    books = calibredb.get_books(sort, search, start, limit, fields)
+    res = PaginatedResults(books, count, start, limit, sort, search, fields=fields)
+
+    return response(200, jsonify(res.todict()), headers)
 
 
 @app.route("/books", methods=["POST"])
+@idempotent
 def add_book():
     """Add book to calibre library with book file and optional data."""
 
     if "multipart/form-data" not in request.content_type:
         abort(415, "Only multipart/form-data allowed")
 
-    filepaths = check_files(request)
-
     # Check if optional input data exists in form field "data".
     # If exists, check for "automerge" key to modify automerge behaviour.
     # If any book field keys are present, add them to the book dict.
@@ -85,25 +226,51 @@ def add_book():
     json_data = request.form.get("data")
     validate(json_data, Book)
     automerge = "ignore"
-    book = Book()
+    data = {}
 
     if json_data is not None:
         data = json.loads(json_data)
         automerge = data.pop("automerge", "ignore")
-        if len(data):
-            book = Book(**data)
 
-    id = calibredb.add_multiple(filepaths, book, automerge)
+    book = Book(**data) if len(data) else Book()
+    files = check_files(request)
+    hashes = [file.stream.hexdigest() for file in files]
+
+    # uploads of files that are already in the library never reach calibredb
+    id = calibredb.skip_duplicates(hashes, book, automerge)
+    if id is not None:
+        return response(201, jsonify(id=id))
+
+    if jobs is not None:
+        # the uploads are kept with the job until it runs
+        job_id = jobs.new_id()
+        filepaths = [spooled_path(f.stream, jobs.job_dir(job_id)) for f in files]
+        params = {
+            "paths": filepaths,
+            "book": data,
+            "automerge": automerge,
+            "hashes": hashes,
+        }
+        return accepted(jobs.submit("add", params, job_id))
+
+    filepaths = [spooled_path(f.stream) for f in files]
+    id = calibredb.add_multiple(filepaths, book, automerge, hashes)
     return response(201, jsonify(id=id))
 
 
-def check_files(request) -> list[str]:
+def check_files(request) -> list[FileStorage]:
+    """Check the uploaded files, which are spooled to disk by SpoolRequest.
+
+    Returns:
+        list[FileStorage]: Uploaded files
+
+    Raises:
+        InvalidPayloadError: No files were uploaded, a filename is invalid or
+            a file does not match the signature of its format
+    """
     if not len(request.files.keys()):
         raise InvalidPayloadError("No file(s) provided")
 
-    tempdir = tempfile.gettempdir()
-    filepaths = []
-
     # flatten list of lists
     files = [f for values in request.files.listvalues() for f in values]
 
@@ -114,19 +281,16 @@ def check_files(request) -> list[str]:
         if not allowed_file(file.filename):
             raise InvalidPayloadError(f"Invalid filename ({file.filename})")
 
-        # save file to a temporary location for upload
-        tempfilepath = path.join(tempdir, secure_filename(file.filename))
-        file.save(tempfilepath)
+        # reject corrupt or mislabeled files before calibredb is started
+        ext = path.splitext(file.filename)[1]
+        if not valid_signature(file.stream, ext):
+            raise InvalidPayloadError(f"{file.filename} is not a valid {ext} file")
 
-        if not path.isfile(tempfilepath):
-            raise FileNotFoundError(f"{tempfilepath} not found.")
-
-        filepaths.append(tempfilepath)
-
-    return filepaths
+    return files
 
 
 @app.route("/books/empty", methods=["POST"])
+@idempotent
 def add_empty_book():
     """Add empty book to calibre library with optional data."""
 
@@ -147,6 +311,162 @@ def add_empty_book():
     return response(201, jsonify(id=id))
 
 
+@app.route("/uploads", methods=["POST"])
+def create_upload():
+    """Create a resumable upload of a book file.
+
+    The file is then sent in chunks with PUT /uploads/<id> and added to the
+    library with POST /uploads/<id>/complete.
+    """
+
+    if request.content_type != "application/json":
+        abort(415, "Only application/json allowed")
+
+    data = request.get_json()
+    if not isinstance(data, dict) or not isinstance(data.get("filename"), str):
+        abort(400, "filename must be provided")
+
+    filename = data["filename"]
+    if filename == "" or not allowed_file(filename):
+        raise InvalidPayloadError(f"Invalid filename ({filename})")
+
+    size = data.get("size")
+    if size is not None and (not isinstance(size, int) or size < 0):
+        abort(400, "size must be a non-negative integer")
+
+    upload = uploads.create(filename, size)
+    headers = {"Content-Type": "application/json", "Location": upload_location(upload)}
+    return response(201, jsonify(upload=upload), headers)
+
+
+@app.route("/uploads/<upload_id>")
+def get_upload(upload_id):
+    """Get a resumable upload, with the offset to resume it from."""
+
+    upload = uploads.get(upload_id)
+    if upload is None:
+        abort(404, f"upload {upload_id} does not exist")
+    return response(200, jsonify(upload=upload))
+
+
+@app.route("/uploads/<upload_id>", methods=["PUT"])
+def append_upload(upload_id):
+    """Append a chunk, given by the Content-Range header, to an upload.
+
+    A chunk whose length does not match its Content-Range returns 409 with
+    the upload's offset, from which the client resumes.
+    """
+
+    content_range = parse_content_range_header(request.headers.get("Content-Range"))
+    if content_range is None or content_range.start is None:
+        abort(400, "Content-Range must be provided")
+
+    upload = uploads.get(upload_id)
+    if upload is None:
+        abort(404, f"upload {upload_id} does not exist")
+    if content_range.length is not None and upload["size"] not in (
+        None,
+        content_range.length,
+    ):
+        abort(400, f"Content-Range length does not match upload size {upload['size']}")
+
+    length = content_range.stop - content_range.start
+    if request.content_length is not None and request.content_length != length:
+        raise UploadOffsetError(
+            f"Content-Length {request.content_length} does not match the "
+            f"Content-Range of {length} bytes",
+            upload["offset"],
+        )
+
+    try:
+        upload = uploads.append(
+            upload_id, content_range.start, request.stream, content_range.stop
+        )
+    except KeyError:
+        abort(404, f"upload {upload_id} does not exist")
+    return response(200, jsonify(upload=upload))
+
+
+@app.route("/uploads/<upload_id>", methods=["DELETE"])
+def delete_upload(upload_id):
+    """Cancel an upload."""
+
+    if uploads.get(upload_id) is None:
+        abort(404, f"upload {upload_id} does not exist")
+
+    uploads.remove(upload_id)
+    return response(204, "")
+
+
+@app.route("/uploads/<upload_id>/complete", methods=["POST"])
+@idempotent
+def complete_upload(upload_id):
+    """Add the book file of a finished upload to the library.
+
+    Accepts the same optional data as POST /books/empty. The upload is removed
+    once the book is added or found to exist already. If adding it fails, the
+    upload is kept so that the request can be retried.
+    """
+
+    if request.content_type not in (None, "application/json"):
+        abort(415, "Only application/json allowed")
+
+    upload = uploads.get(upload_id)
+    if upload is None:
+        abort(404, f"upload {upload_id} does not exist")
+    if upload["size"] is not None and upload["offset"] != upload["size"]:
+        raise UploadOffsetError(
+            f"Upload is incomplete, {upload['offset']} of {upload['size']} bytes "
+            "received",
+            upload["offset"],
+        )
+
+    data = {}
+    if request.get_data() != bytes():
+        validate(request.data, Book)
+        data = request.get_json()
+    automerge = data.pop("automerge", "ignore")
+    book = Book(**data) if len(data) else Book()
+
+    filepath = uploads.file_path(upload_id)
+    ext = path.splitext(upload["filename"])[1]
+    with open(filepath, "rb") as f:
+        if not valid_signature(f, ext):
+            raise InvalidPayloadError(f"{upload['filename']} is not a valid {ext} file")
+    hashes = [hash_file(filepath)]
+    try:
+        id = calibredb.skip_duplicates(hashes, book, automerge)
+    except ExistingItemError:
+        uploads.remove(upload_id)
+        raise
+    if id is not None:
+        uploads.remove(upload_id)
+        return response(201, jsonify(id=id))
+
+    if jobs is not None:
+        job_id = jobs.new_id()
+        filepath = uploads.take(upload_id, jobs.job_dir(job_id))
+        params = {
+            "paths": [filepath],
+            "book": data,
+            "automerge": automerge,
+            "hashes": hashes,
+        }
+        return accepted(jobs.submit("add", params, job_id))
+
+    try:
+        id = calibredb.add_multiple([filepath], book, automerge, hashes)
+    except ExistingItemError:
+        uploads.remove(upload_id)
+        raise
+    uploads.remove(upload_id)
+    return response(201, jsonify(id=id))
+
+
+def upload_location(upload: dict) -> str:
+    return f"/uploads/{upload['id']}"
+
+
 @app.route("/books/<int:id>", methods=["PUT"])
 def update_book(id):
     """Update existing book in calibre library with JSON data."""
@@ -159,20 +479,111 @@ def update_book(id):
         abort(400, "No data provided")
 
     validate(request.data, Book)
-    book = Book(**book)
-
-    returned_id = calibredb.set_metadata(id, book, None)
-    if returned_id == -1:
+    if jobs is not None:
+        return accepted(jobs.submit("update", {"id": id, "book": book}))
+    book = calibredb.update_book(id, Book(**book))
+    if book is None:
         abort(404, f"book {id} does not exist")
 
-    book = calibredb.get_book(returned_id)
     return response(200, jsonify(books=book))
 
 
+@app.route("/books", methods=["PATCH"])
+def update_books():
+    """Update the metadata of many books in one request.
+
+    The JSON body holds either a list of updates, {"books": [{"id": 1,
+    "fields": {...}}, ...]}, or a search and the fields to set on every
+    matching book, {"search": "tags:foo", "fields": {...}}. Every payload is
+    validated before any book is changed.
+
+    The outcome of each book is streamed back as newline-delimited JSON as
+    soon as it is updated: {"id": 1, "status": "updated"}, with a status of
+    "updated", "not_found" or "failed". Books that do not exist are looked
+    up before the response starts.
+
+    Each book is updated with its own calibredb command. Without a job
+    queue, the updates run within the request and must finish before the
+    gunicorn timeout, so large patches should be made with
+    CALIBRE_REST_JOBS_PATH set, which returns 202 and runs them as a job.
+    """
+
+    if request.content_type != "application/json":
+        abort(415, "Only application/json allowed")
+
+    data = request.get_json()
+    if not isinstance(data, dict):
+        abort(400, "No data provided")
+
+    if "search" in data:
+        search = data["search"]
+        if isinstance(search, str):
+            search = [search]
+        if not isinstance(search, list) or not len(search):
+            abort(400, "search must be a string or a list of strings")
+        validate_fields(data.get("fields"), "fields")
+        ids = [book.id for book in calibredb.iter_books(None, search, ["id"])]
+        updates = [(id, data["fields"]) for id in ids]
+
+    elif isinstance(data.get("books"), list) and len(data["books"]):
+        updates = []
+        for i, update in enumerate(data["books"]):
+            if not isinstance(update, dict) or not isinstance(update.get("id"), int):
+                abort(400, f"books[{i}] must have an integer id")
+            validate_fields(update.get("fields"), f"books[{i}].fields")
+            updates.append((update["id"], update["fields"]))
+    else:
+        abort(400, "Either books or search must be provided")
+
+    for id, _ in updates:
+        validate_id(id)
+
+    if jobs is not None:
+        return accepted(jobs.submit("patch", {"updates": updates}))
+
+    # fail before the response starts, e.g. if the library cannot be read
+    results = calibredb.update_books([(id, Book(**f)) for id, f in updates])
+
+    def generate():
+        for result in results:
+            yield app.json.dumps(result) + "\n"
+
+    return Response(
+        stream_with_context(generate()), 200, mimetype="application/x-ndjson"
+    )
+
+
+def validate_fields(fields: dict, name: str):
+    """Validate the fields of a bulk update with Book.
+
+    Raises:
+        HTTPException: 400 if fields is not a non-empty object, 422 if it
+            fails validation
+    """
+    if not isinstance(fields, dict) or not len(fields):
+        abort(400, f"{name} must be a non-empty object")
+
+    errors = Book.validate(fields)
+    if "automerge" in fields:
+        abort(response(422, jsonify(errors=[{name: "automerge is not a field"}])))
+    if len(errors):
+        data = {"errors": []}
+        for e in errors:
+            key = f"{name}.{e.path.popleft()}" if len(e.path) else name
+            data["errors"].append({key: e.message})
+        abort(response(422, jsonify(data)))
+
+
 @app.route("/books", methods=["DELETE"])
 @app.route("/books/<int:id>", methods=["DELETE"])
 def delete_book(id=None):
-    """Remove existing book in calibre library."""
+    """Remove existing book(s) in calibre library.
+
+    Batch deletes take ids from the id query parameter, or from an "ids" list
+    in a JSON body for more ids than fit in a URL, and return the outcome of
+    each id: "deleted", "not_found" or "failed". The ids are verified in a
+    single query before and after calibredb remove.
+    """
 
     ids = request.args.getlist("id") or None
     if ids is not None:
@@ -180,20 +591,46 @@ def delete_book(id=None):
             ids = [int(i) for i in ids[0].split(",")]
         else:
             ids = [int(i) for i in ids]
+    elif id is None and request.content_type == "application/json":
+        body = request.get_json()
+        ids = body.get("ids") if isinstance(body, dict) else None
+        if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+            abort(400, "ids must be a list of integers")
     elif id is not None:
         ids = [id]
-    else:
+
+    if not ids:
         abort(400)
+    for i in ids:
+        validate_id(i)
+    ids = list(dict.fromkeys(ids))
 
-    calibredb.remove(ids)
+    if jobs is not None:
+        return accepted(jobs.submit("delete", {"ids": ids}))
 
-    for id in ids:
-        # check if book still exists
-        book = calibredb.get_book(id)
-        if book:
+    if id is not None:
+        calibredb.remove(ids)
+        if calibredb.existing_ids(ids):
             abort(500, f"book {id} was not deleted")
+        return response(200, "")
+
+    existing = calibredb.existing_ids(ids)
+    if len(existing):
+        calibredb.remove([i for i in ids if i in existing])
+    remaining = calibredb.existing_ids(list(existing)) if len(existing) else set()
+
+    results = []
+    for i in ids:
+        if i not in existing:
+            results.append({"id": i, "status": "not_found"})
+        elif i in remaining:
+            results.append({"id": i, "status": "failed"})
+        else:
+            results.append({"id": i, "status": "deleted"})
 
-    return response(200, "")
+    # 207 Multi-Status if any book was not deleted
+    status = 207 if len(remaining) else 200
+    return response(status, jsonify(books=results))
 
 
 @app.route("/export", methods=["GET"])
@@ -212,6 +649,10 @@ def export_book(id=None):
     else:
         abort(400)
 
+    if jobs is not None:
+        # the exported files are downloaded from /jobs/<id>/export
+        return accepted(jobs.submit("export", {"ids": ids}))
+
     with tempfile.TemporaryDirectory() as exports_dir:
         try:
             calibredb.export(ids, exports_dir)
@@ -223,18 +664,56 @@ def export_book(id=None):
             f for f in os.listdir(exports_dir) if path.isfile(path.join(exports_dir, f))
         ]
 
-        if len(files) <= 0:
-            abort(500)
-        elif len(files) == 1:
-            return send_from_directory(exports_dir, files[0], as_attachment=True)
-        else:
-            # zip exports_dir/* to /tmp/exports.zip
-            zipfile = path.join(tempfile.gettempdir(), "exports")
-            zipfile = shutil.make_archive(zipfile, "zip", exports_dir)
+        return send_exports(exports_dir, files)
 
-            return send_from_directory(
-                tempfile.gettempdir(), "exports.zip", as_attachment=True
-            )
+
+def send_exports(exports_dir: str, files: list[str]):
+    """Send a single exported file as is, or all of them in a zip archive."""
+    if len(files) <= 0:
+        abort(500)
+    elif len(files) == 1:
+        return send_from_directory(exports_dir, files[0], as_attachment=True)
+    else:
+        # zip exports_dir/* to /tmp/exports.zip
+        zipfile = path.join(tempfile.gettempdir(), "exports")
+        zipfile = shutil.make_archive(zipfile, "zip", exports_dir)
+
+        return send_from_directory(
+            tempfile.gettempdir(), "exports.zip", as_attachment=True
+        )
+
+
+@app.route("/jobs/<job_id>")
+def get_job(job_id):
+    """Get the status of a write job.
+
+    Only available if the job journal is configured. The job's result holds
+    the ids of the books it changed, and the exported files for export jobs.
+    """
+
+    if jobs is None:
+        abort(404, "jobs are not enabled")
+
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404, f"job {job_id} does not exist")
+    return response(200, jsonify(job=job))
+
+
+@app.route("/jobs/<job_id>/export")
+def get_job_export(job_id):
+    """Download the files of a succeeded export job."""
+
+    if jobs is None:
+        abort(404, "jobs are not enabled")
+
+    job = jobs.get(job_id)
+    if job is None or job["kind"] != "export":
+        abort(404, f"export job {job_id} does not exist")
+    if job["status"] != "succeeded":
+        abort(409, f"export job {job_id} is {job['status']}")
+
+    return send_exports(jobs.job_dir(job_id), job["result"]["files"])
 
 
 # export --all
@@ -253,6 +732,11 @@ def handle_existing_item_error(e):
     return jsonify(error=str(e)), 409
 
 
+@app.errorhandler(UploadOffsetError)
+def handle_upload_offset_error(e):
+    return jsonify(error=str(e), offset=e.offset), 409
+
+
 @app.errorhandler(json.JSONDecodeError)
 def handle_json_decode_error(e):
     return jsonify(error=f"Error decoding JSON: {str(e)}"), 500
@@ -273,6 +757,11 @@ def handle_calibre_runtime_error(e):
     return jsonify(error=str(e)), 500
 
 
+@app.errorhandler(ContentServerError)
+def handle_content_server_error(e):
+    return jsonify(error=str(e)), 502
+
+
 def response(status_code, data, headers={"Content-Type": "application/json"}):
     response = make_response(data, status_code)
 
@@ -282,6 +771,48 @@ def response(status_code, data, headers={"Content-Type": "application/json"}):
     return response
 
 
+def accepted(job: dict):
+    """Respond to a request that was queued as a job."""
+    headers = {"Content-Type": "application/json", "Location": f"/jobs/{job['id']}"}
+    return response(202, jsonify(job=job), headers)
+
+
+def cache_headers(version: str, last_modified: datetime = None) -> dict:
+    """Build response headers with a strong ETag for the given version."""
+    etag = hashlib.sha1(version.encode("utf-8")).hexdigest()
+    headers = {"Content-Type": "application/json", "ETag": quote_etag(etag)}
+    if last_modified is not None:
+        headers["Last-Modified"] = http_date(last_modified)
+    return headers
+
+
+def book_cache_headers(id: int, last_modified: str, fields: list[str] = None) -> dict:
+    try:
+        modified = datetime.fromisoformat(last_modified)
+    except ValueError:
+        modified = None
+
+    # each sparse fieldset is a different representation of the book
+    version = f"{id}:{last_modified}"
+    if fields is not None:
+        version += f":{','.join(fields)}"
+    return cache_headers(version, modified)
+
+
+def not_modified(headers: dict) -> bool:
+    """Check if the client's cached response is still current.
+
+    If-None-Match takes precedence over If-Modified-Since, see RFC 9110 13.2.2.
+    """
+    if request.if_none_match:
+        etag = headers["ETag"].strip('"')
+        return request.if_none_match.contains(etag)
+
+    if "Last-Modified" in headers and request.if_modified_since is not None:
+        return parse_date(headers["Last-Modified"]) <= request.if_modified_since
+    return False
+
+
 def validate(data: str, cls):
     """Validate JSON string with Book.
 
@@ -0,0 +1,389 @@
+import operator
+import re
+from functools import lru_cache
+from typing import Callable
+
+from calibre_rest.errors import UnsupportedSearchError
+
+# Search locations and their aliases, mapped to their field
+LOCATIONS = {
+    "author": "authors",
+    "authors": "authors",
+    "comment": "comments",
+    "comments": "comments",
+    "format": "formats",
+    "formats": "formats",
+    "id": "id",
+    "publisher": "publisher",
+    "rating": "rating",
+    "series": "series",
+    "series_index": "series_index",
+    "tag": "tags",
+    "tags": "tags",
+    "title": "title",
+    "uuid": "uuid",
+}
+NUMERIC_FIELDS = ("id", "rating", "series_index")
+
+# Lexer rules of calibre's SearchQueryParser
+LEX_RULES = (
+    (re.compile(r"[()]"), "opcode"),
+    (re.compile(r"@.+?:[^\")\s]+"), "word"),
+    (re.compile(r"[^\"()\s]+"), "word"),
+    (re.compile(r"\".*?((?<!\\)\")"), "quoted_word"),
+    (re.compile(r"\s+"), None),
+)
+RELATIONAL_REGEX = re.compile(r"^(<=|>=|!=|=|<|>)?\s*(-?[\d.]+)$")
+
+
+def parse(search: list[str]):
+    """Parse search terms written in calibre's search grammar.
+
+    Supports field:value (contains), field:=value (equals), field:~value
+    (regex), field:true and field:false, relational comparisons on numeric
+    fields, and, or, not and parentheses. Adjacent terms are joined with and.
+
+    Args:
+        search (list[str]): List of search terms, joined with and
+
+    Returns:
+        tuple: Parse tree of ("and", a, b), ("or", a, b), ("not", a) and
+            ("token", field, query) nodes, or None if there are no terms
+
+    Raises:
+        UnsupportedSearchError: Search uses constructs that are not supported,
+            such as searching all fields, or is invalid.
+    """
+    if search is None or not len(search):
+        return None
+
+    tokens = tokenize(" ".join(search))
+    if not len(tokens):
+        return None
+
+    parser = Parser(tokens)
+    tree = parser.or_expression()
+    if not parser.done():
+        raise UnsupportedSearchError(f"Unexpected token in search {search}")
+    return tree
+
+
+def tokenize(query: str) -> list[tuple[str, str]]:
+    tokens = []
+    i = 0
+    while i < len(query):
+        for regex, kind in LEX_RULES:
+            match = regex.match(query, i)
+            if match is not None:
+                break
+        else:
+            raise UnsupportedSearchError(f"Failed to parse search {query}")
+
+        if kind is not None:
+            value = match.group(0)
+            if kind == "quoted_word":
+                value = value[1:-1].replace('\\"', '"').replace("\\\\", "\\")
+            tokens.append((kind, value))
+        i = match.end()
+    return tokens
+
+
+class Parser:
+    """Recursive descent parser following calibre's search grammar:
+
+    or_expression := and_expression ["or" or_expression]
+    and_expression := not_expression [["and"] and_expression]
+    not_expression := ["not"] not_expression | location_expression
+    location_expression := "(" or_expression ")" | base_token
+    """
+
+    def __init__(self, tokens: list[tuple[str, str]]):
+        self.tokens = tokens
+        self.pos = 0
+
+    def done(self) -> bool:
+        return self.pos >= len(self.tokens)
+
+    def peek(self) -> tuple[str, str]:
+        if self.done():
+            return (None, None)
+        return self.tokens[self.pos]
+
+    def is_keyword(self, keyword: str) -> bool:
+        kind, value = self.peek()
+        return kind == "word" and value.lower() == keyword
+
+    def advance(self) -> tuple[str, str]:
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def or_expression(self):
+        lhs = self.and_expression()
+        if self.is_keyword("or"):
+            self.advance()
+            return ("or", lhs, self.or_expression())
+        return lhs
+
+    def and_expression(self):
+        lhs = self.not_expression()
+        if self.is_keyword("and"):
+            self.advance()
+            return ("and", lhs, self.and_expression())
+
+        kind, value = self.peek()
+        if kind is not None and not self.is_keyword("or") and value != ")":
+            return ("and", lhs, self.and_expression())
+        return lhs
+
+    def not_expression(self):
+        if self.is_keyword("not"):
+            self.advance()
+            return ("not", self.not_expression())
+        return self.location_expression()
+
+    def location_expression(self):
+        kind, value = self.peek()
+        if kind == "opcode" and value == "(":
+            self.advance()
+            tree = self.or_expression()
+            if self.advance() != ("opcode", ")"):
+                raise UnsupportedSearchError("Missing closing parenthesis in search")
+            return tree
+        return self.base_token()
+
+    def base_token(self):
+        kind, value = self.advance()
+        if kind == "quoted_word":
+            raise UnsupportedSearchError("Searching all fields is not supported")
+        if kind != "word":
+            raise UnsupportedSearchError(f"Unexpected token {value} in search")
+
+        words = value.split(":")
+        if len(words) > 1 and words[0].lower() in LOCATIONS:
+            field = LOCATIONS[words[0].lower()]
+            words = words[1:]
+            # field:"quoted value" and field:="quoted value"
+            if len(words) == 1 and self.peek()[0] == "quoted_word":
+                return ("token", field, words[0] + self.advance()[1])
+            return ("token", field, ":".join(words))
+
+        raise UnsupportedSearchError(f"Search location in {value} is not supported")
+
+
+def match_kind(field: str, query: str) -> tuple[str, object]:
+    """Determine how a query is matched against a field.
+
+    Returns:
+        tuple[str, object]: One of ("contains", str), ("equals", str),
+            ("regex", str), ("bool", bool) or (operator, float) for numeric
+            fields.
+
+    Raises:
+        UnsupportedSearchError: The query is not supported for the field.
+    """
+    if query.lower() in ("true", "false"):
+        return ("bool", query.lower() == "true")
+
+    if field in NUMERIC_FIELDS:
+        match = re.match(RELATIONAL_REGEX, query)
+        if match is None:
+            raise UnsupportedSearchError(f"Invalid numeric search {field}:{query}")
+        op, value = match.groups()
+        try:
+            return (op or "=", float(value))
+        except ValueError as exc:
+            raise UnsupportedSearchError(
+                f"Invalid numeric search {field}:{query}"
+            ) from exc
+
+    if query == "" or query in ("=", "~"):
+        raise UnsupportedSearchError(f"Empty search {field}:{query}")
+    if query.startswith("="):
+        # hierarchical matches (=.foo) are not supported
+        if query.startswith("=."):
+            raise UnsupportedSearchError(f"Unsupported search {field}:{query}")
+        return ("equals", query[1:])
+    if query.startswith("~"):
+        return ("regex", query[1:])
+    return ("contains", query)
+
+
+# SQL returning the values of each text field for the current book. Values
+# are matched with "EXISTS (<sql> AND <value> <comparison>)".
+TEXT_FIELDS_SQL = {
+    "authors": (
+        "SELECT a.name AS value FROM books_authors_link l "
+        "JOIN authors a ON a.id = l.author WHERE l.book = books.id"
+    ),
+    "comments": "SELECT text AS value FROM comments WHERE book = books.id",
+    "formats": "SELECT format AS value FROM data WHERE book = books.id",
+    "publisher": (
+        "SELECT p.name AS value FROM books_publishers_link l "
+        "JOIN publishers p ON p.id = l.publisher WHERE l.book = books.id"
+    ),
+    "series": (
+        "SELECT s.name AS value FROM books_series_link l "
+        "JOIN series s ON s.id = l.series WHERE l.book = books.id"
+    ),
+    "tags": (
+        "SELECT t.name AS value FROM books_tags_link l "
+        "JOIN tags t ON t.id = l.tag WHERE l.book = books.id"
+    ),
+    "title": "SELECT books.title AS value WHERE books.title != ''",
+    "uuid": "SELECT books.uuid AS value WHERE books.uuid != ''",
+}
+NUMERIC_FIELDS_SQL = {
+    "id": "books.id",
+    # ratings are stored as 0-10 but searched as 0-5 stars
+    "rating": (
+        "coalesce((SELECT r.rating FROM books_ratings_link l JOIN ratings r "
+        "ON r.id = l.rating WHERE l.book = books.id), 0) / 2.0"
+    ),
+    "series_index": "books.series_index",
+}
+
+
+def compile_sql(tree) -> tuple[str, list]:
+    """Compile a parse tree into a parameterized SQL condition on books.
+
+    Contains and equals matches are case-insensitive for ASCII characters.
+    Regex matches require a REGEXP function to be registered on the
+    connection, see regexp().
+
+    Returns:
+        str: SQL condition
+        list: Parameters for the condition
+    """
+    node = tree[0]
+    if node in ("and", "or"):
+        lhs, lparams = compile_sql(tree[1])
+        rhs, rparams = compile_sql(tree[2])
+        return f"({lhs} {node.upper()} {rhs})", lparams + rparams
+
+    if node == "not":
+        sql, params = compile_sql(tree[1])
+        return f"(NOT {sql})", params
+
+    _, field, query = tree
+    kind, value = match_kind(field, query)
+
+    if field in NUMERIC_FIELDS_SQL:
+        expr = NUMERIC_FIELDS_SQL[field]
+        if kind == "bool":
+            return f"({expr} {'!=' if value else '='} 0)", []
+        if field == "id" and kind == "=" and value.is_integer():
+            value = int(value)
+        return f"({expr} {kind} ?)", [value]
+
+    values = TEXT_FIELDS_SQL[field]
+    if kind == "bool":
+        return f"({'' if value else 'NOT '}EXISTS ({values}))", []
+    if kind == "contains":
+        return (
+            f"EXISTS ({values} AND value LIKE ? ESCAPE '\\')",
+            [f"%{escape_like(value)}%"],
+        )
+    if kind == "equals":
+        return f"EXISTS ({values} AND value = ? COLLATE NOCASE)", [value]
+    return f"EXISTS ({values} AND value REGEXP ?)", [value]
+
+
+RELATIONAL_OPERATORS = {
+    "=": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+def compile_predicate(tree, values: Callable) -> Callable:
+    """Compile a parse tree into a predicate on in-memory records.
+
+    Matches the same books as compile_sql(), except that contains and equals
+    matches are case-insensitive for all characters.
+
+    Args:
+        tree (tuple): Parse tree from parse()
+        values (Callable): Function of (record, field) returning a list of
+            strings for text fields, or a number for numeric fields
+
+    Returns:
+        Callable: Function of a record returning True if it matches
+    """
+    node = tree[0]
+    if node == "and":
+        lhs = compile_predicate(tree[1], values)
+        rhs = compile_predicate(tree[2], values)
+        return lambda r: lhs(r) and rhs(r)
+
+    if node == "or":
+        lhs = compile_predicate(tree[1], values)
+        rhs = compile_predicate(tree[2], values)
+        return lambda r: lhs(r) or rhs(r)
+
+    if node == "not":
+        pred = compile_predicate(tree[1], values)
+        return lambda r: not pred(r)
+
+    _, field, query = tree
+    kind, value = match_kind(field, query)
+
+    if field in NUMERIC_FIELDS:
+        if kind == "bool":
+            return lambda r: (values(r, field) != 0) == value
+        op = RELATIONAL_OPERATORS[kind]
+        return lambda r: op(values(r, field), value)
+
+    if kind == "bool":
+        return lambda r: any(v for v in values(r, field)) == value
+    if kind == "contains":
+        value = value.casefold()
+        return lambda r: any(value in v.casefold() for v in values(r, field) if v)
+    if kind == "equals":
+        value = value.casefold()
+        return lambda r: any(value == v.casefold() for v in values(r, field) if v)
+
+    regex = compile_regex(value)
+    return lambda r: any(regex.search(v) for v in values(r, field) if v)
+
+
+def escape_like(s: str) -> str:
+    return s.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+@lru_cache(maxsize=128)
+def compile_regex(pattern: str) -> re.Pattern:
+    return re.compile(pattern, re.IGNORECASE)
+
+
+def regexp(pattern: str, value: str) -> bool:
+    """SQLite REGEXP function with calibre's case-insensitive regex semantics."""
+    if value is None:
+        return False
+    try:
+        return compile_regex(pattern).search(value) is not None
+    except re.error:
+        return False
+
+
+def validate(tree) -> None:
+    """Check that every token in a parse tree can be matched.
+
+    Raises:
+        UnsupportedSearchError: A token's query is not supported.
+    """
+    if tree is None:
+        return
+    if tree[0] == "token":
+        kind, value = match_kind(tree[1], tree[2])
+        if kind == "regex":
+            try:
+                compile_regex(value)
+            except re.error as exc:
+                raise UnsupportedSearchError(f"Invalid regex {value}") from exc
+        return
+    for child in tree[1:]:
+        validate(child)
@@ -0,0 +1,79 @@
+import typing as t
+
+# Number of bytes read from the start of a file to check its signature
+SNIFF_SIZE = 4096
+
+ZIP = ((0, b"PK\x03\x04"), (0, b"PK\x05\x06"), (0, b"PK\x07\x08"))
+# Palm database header: the type and creator of the database start at
+# offset 60 of the 78 byte header
+PALM_HEADER_SIZE = 78
+MOBI = ((60, b"BOOKMOBI"), (60, b"TEXtREAd"))
+
+# Signatures of the binary formats in CalibreWrapper.ALLOWED_FILE_EXTENSIONS,
+# as (offset, bytes) pairs of which one must match. Text formats (txt, html,
+# fb2, pml) have no signature and are not checked.
+SIGNATURES = {
+    ".azw": MOBI + ((0, b"TPZ"),),
+    ".azw3": MOBI,
+    ".azw4": MOBI,
+    ".cb7": ((0, b"7z\xbc\xaf\x27\x1c"),),
+    ".cbc": ZIP,
+    ".cbr": ((0, b"Rar!\x1a\x07\x00"), (0, b"Rar!\x1a\x07\x01\x00")),
+    ".cbz": ZIP,
+    ".chm": ((0, b"ITSF"),),
+    ".djvu": ((0, b"AT&TFORM"),),
+    ".docx": ZIP,
+    ".epub": ZIP,
+    ".fbz": ZIP,
+    ".htmlz": ZIP,
+    ".lit": ((0, b"ITOLITLS"),),
+    ".lrf": ((0, b"L\x00R\x00F\x00\x00\x00"),),
+    ".mobi": MOBI,
+    ".odt": ZIP,
+    ".prc": MOBI,
+    ".rb": ((0, b"\xb0\x0c\xb0\x0c\x02\x00NUVO\x00\x00\x00\x00"),),
+    ".rtf": ((0, b"{\\rtf"),),
+    ".snb": ((0, b"SNBP000B"),),
+    ".tcr": ((0, b"!!8-Bit!!"),),
+    ".txtz": ZIP,
+}
+
+
+def valid_signature(stream: t.IO[bytes], ext: str) -> bool:
+    """Check that a file starts with the signature of its format.
+
+    Only the first SNIFF_SIZE bytes of the file are read, so this is a cheap
+    check that catches mislabeled, truncated and corrupt uploads before they
+    are handed to calibredb. It does not validate the rest of the file.
+
+    Args:
+        stream (IO[bytes]): Seekable stream of the file. Its position is
+            restored after reading.
+        ext (str): Extension of the file, e.g. ".epub"
+
+    Returns:
+        bool: True if the file matches its format's signature, or the format
+            has none
+    """
+    ext = ext.lower()
+    if ext not in SIGNATURES and ext not in (".pdf", ".pdb"):
+        return True
+
+    position = stream.tell()
+    stream.seek(0)
+    try:
+        head = stream.read(SNIFF_SIZE)
+    finally:
+        stream.seek(position)
+
+    if ext == ".pdf":
+        # readers accept a PDF header anywhere in the first KB
+        return b"%PDF-" in head[:1024]
+    if ext == ".pdb":
+        # Palm databases of many types share the .pdb extension, so only the
+        # header is checked
+        return len(head) >= PALM_HEADER_SIZE and all(
+            0x20 <= b < 0x7F for b in head[60:68]
+        )
+
+    return any(head[offset:].startswith(sig) for offset, sig in SIGNATURES[ext])
@@ -0,0 +1,637 @@
+import logging
+import os
+import sqlite3
+import threading
+import unicodedata
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from os import path
+from typing import Iterator
+
+from calibre_rest import search as search_parser
+from calibre_rest.models import Book
+
+
+class SQLiteReader:
+    """Read-only access to a calibre library's metadata.db.
+
+    Books are built directly from calibre's tables instead of forking a
+    calibredb process. The result is shaped exactly like the output of
+    "calibredb list --for-machine --fields=all" so that callers cannot tell
+    the two apart.
+
+    Each thread gets its own private read-only connection. Every read runs in a
+    single transaction so that a book is never built from two different
+    versions of the database. Shared-cache mode is deliberately not used as it
+    serializes readers on the same table locks we are trying to avoid.
+    """
+
+    # Number of ids bound in a single "IN (...)" clause. This stays well below
+    # SQLITE_MAX_VARIABLE_NUMBER on older SQLite builds (999).
+    CHUNK_SIZE = 500
+
+    # Map of sort keys to the SQL expression used to order books. Keys follow
+    # CalibreWrapper.SORT_BY_KEYS and sort the same values calibre does, e.g.
+    # title sorts by the title's sort value and series by the series' sort
+    # value and then the series index. Expressions never return NULL so that
+    # they can be compared directly in keyset (cursor) queries. Text is
+    # compared with the "folded" collation, see collation_key(), so that
+    # BookIndex orders books the same way.
+    SORT_COLUMNS = {
+        "author_sort": "coalesce(books.author_sort, '') COLLATE folded",
+        "authors": "coalesce(books.author_sort, '') COLLATE folded",
+        "comments": (
+            "coalesce((SELECT text FROM comments WHERE book = books.id), '') "
+            "COLLATE folded"
+        ),
+        "cover": "books.has_cover",
+        "formats": (
+            "coalesce((SELECT group_concat(format, ',') FROM "
+            "(SELECT format FROM data WHERE book = books.id ORDER BY format)), '')"
+        ),
+        "id": "books.id",
+        "identifiers": (
+            "coalesce((SELECT group_concat(type || ':' || val, ',') FROM identifiers "
+            "WHERE book = books.id), '')"
+        ),
+        "isbn": (
+            "coalesce((SELECT val FROM identifiers WHERE book = books.id "
+            "AND type = 'isbn'), '')"
+        ),
+        "languages": (
+            "coalesce((SELECT group_concat(languages.lang_code, ',') FROM "
+            "books_languages_link JOIN languages ON languages.id = "
+            "books_languages_link.lang_code WHERE book = books.id), '')"
+        ),
+        "last_modified": "books.last_modified",
+        "pubdate": "coalesce(books.pubdate, '')",
+        "publisher": (
+            "coalesce((SELECT name FROM books_publishers_link JOIN publishers "
+            "ON publishers.id = publisher WHERE book = books.id), '') COLLATE folded"
+        ),
+        "rating": (
+            "coalesce((SELECT rating FROM books_ratings_link JOIN ratings "
+            "ON ratings.id = books_ratings_link.rating WHERE book = books.id), 0)"
+        ),
+        "series": (
+            "coalesce((SELECT coalesce(series.sort, series.name) FROM "
+            "books_series_link JOIN series ON series.id = books_series_link.series "
+            "WHERE book = books.id), '') COLLATE folded",
+            "books.series_index",
+        ),
+        "series_index": "books.series_index",
+        "size": (
+            "coalesce((SELECT MAX(uncompressed_size) FROM data "
+            "WHERE book = books.id), 0)"
+        ),
+        "tags": (
+            "coalesce((SELECT group_concat(name, ',') FROM books_tags_link JOIN tags "
+            "ON tags.id = tag WHERE book = books.id), '') COLLATE folded"
+        ),
+        "timestamp": "coalesce(books.timestamp, '')",
+        "title": "coalesce(books.sort, books.title) COLLATE folded",
+        "uuid": "coalesce(books.uuid, '')",
+    }
+
+    BOOKS_QUERY = (
+        "SELECT id, title, sort, author_sort, timestamp, pubdate, series_index, "
+        "path, uuid, has_cover, last_modified FROM books WHERE id IN ({})"
+    )
+
+    # Queries for fields stored outside the books table. Multi-valued fields
+    # are ordered the same way calibre orders them.
+    LINK_QUERIES = {
+        "authors": (
+            "SELECT l.book, a.name FROM books_authors_link l "
+            "JOIN authors a ON a.id = l.author WHERE l.book IN ({}) ORDER BY l.id"
+        ),
+        "tags": (
+            "SELECT l.book, t.name FROM books_tags_link l "
+            "JOIN tags t ON t.id = l.tag WHERE l.book IN ({}) ORDER BY l.id"
+        ),
+        "languages": (
+            "SELECT l.book, g.lang_code FROM books_languages_link l "
+            "JOIN languages g ON g.id = l.lang_code WHERE l.book IN ({}) "
+            "ORDER BY l.item_order"
+        ),
+        "series": (
+            "SELECT l.book, s.name FROM books_series_link l "
+            "JOIN series s ON s.id = l.series WHERE l.book IN ({})"
+        ),
+        "publisher": (
+            "SELECT l.book, p.name FROM books_publishers_link l "
+            "JOIN publishers p ON p.id = l.publisher WHERE l.book IN ({})"
+        ),
+        "rating": (
+            "SELECT l.book, r.rating FROM books_ratings_link l "
+            "JOIN ratings r ON r.id = l.rating WHERE l.book IN ({})"
+        ),
+        "comments": "SELECT book, text FROM comments WHERE book IN ({})",
+        "identifiers": (
+            "SELECT book, type, val FROM identifiers WHERE book IN ({}) ORDER BY id"
+        ),
+        "formats": (
+            "SELECT book, format, uncompressed_size, name FROM data "
+            "WHERE book IN ({}) ORDER BY format"
+        ),
+    }
+
+    # Book fields read by a link query other than their own
+    LINK_FIELDS = {"isbn": "identifiers", "size": "formats"}
+
+    def __init__(self, lib: str, logger: logging.Logger = None) -> None:
+        """Initialize the read-only SQLite reader.
+
+        Args:
+            lib (str): Path to calibre library on the filesystem.
+            logger (logging.Logger): Custom logger object
+        """
+        if logger is None:
+            logger = logging.getLogger(__name__)
+        self.logger = logger
+
+        self.lib = path.abspath(lib)
+        self.db_path = path.join(self.lib, "metadata.db")
+        self.local = threading.local()
+
+    def connect(self) -> sqlite3.Connection:
+        """Return this thread's read-only connection, opening it if required.
+
+        The database is opened with mode=ro so that we can never write to it,
+        even by accident. A busy timeout allows reads to wait out calibredb's
+        short write transactions instead of failing immediately.
+        """
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            uri = f"file:{self.db_path}?mode=ro"
+            conn = sqlite3.connect(
+                uri, uri=True, timeout=10, isolation_level=None, check_same_thread=False
+            )
+            conn.execute("PRAGMA query_only = ON")
+            conn.create_function("regexp", 2, search_parser.regexp, deterministic=True)
+            conn.create_collation("folded", collate_folded)
+            self.local.conn = conn
+        return conn
+
+    def close(self) -> None:
+        conn = getattr(self.local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def get_book(self, id: int, fields: list[str] = None) -> Book:
+        """Get book from metadata.db.
+
+        Args:
+            id (int): Book ID
+            fields (list[str]): Book fields to read. Defaults to all.
+
+        Returns:
+            Book: Book object or None if the book does not exist
+        """
+        conn = self.connect()
+        with read_transaction(conn):
+            books = self._load(conn, [id], fields)
+
+        if len(books) == 1:
+            return books[0]
+
+    def get_last_modified(self, id: int) -> str:
+        """Get the last_modified time of a book without building it.
+
+        Returns:
+            str: ISO 8601 time or None if the book does not exist
+        """
+        query = "SELECT last_modified FROM books WHERE id = ?"
+        row = self.connect().execute(query, (id,)).fetchone()
+        if row is not None:
+            return isoformat(row[0])
+
+    def get_books(
+        self,
+        sort: list[str] = None,
+        search: list[str] = None,
+        start: int = 1,
+        limit: int = None,
+        fields: list[str] = None,
+    ) -> list[Book]:
+        """Get a page of sorted and filtered books from metadata.db.
+
+        Each sort key is sorted in its own direction: ascending, or descending
+        if a `-` is prepended to it. Unsupported sort keys are dropped with a
+        warning.
+
+        Args:
+            sort (list[str]): List of sort keys to sort results by
+            search (list[str]): List of search terms, see search.parse()
+            start (int): 1-based offset of the first book to return
+            limit (int): Maximum number of books to return. Defaults to all.
+            fields (list[str]): Book fields to read. Defaults to all.
+
+        Returns:
+            list[Book]: List of books
+
+        Raises:
+            UnsupportedSearchError: Search cannot be translated to SQL.
+        """
+        where, params = self._where(search)
+        query = (
+            f"SELECT books.id FROM books WHERE {where} "
+            f"ORDER BY {self._order_by(sort)} LIMIT ? OFFSET ?"
+        )
+        params += [-1 if limit is None else limit, start - 1]
+
+        conn = self.connect()
+        with read_transaction(conn):
+            ids = [row[0] for row in conn.execute(query, params)]
+            return self._load(conn, ids, fields)
+
+    def get_books_by_ids(self, ids: list[int], fields: list[str] = None) -> list[Book]:
+        """Get books with the given ids from metadata.db, in the order of ids.
+        Ids that do not exist are skipped.
+        """
+        conn = self.connect()
+        with read_transaction(conn):
+            return self._load(conn, ids, fields)
+
+    def search_ids(self, search: list[str] = None) -> list[int]:
+        """Get the ids of all books matching search, in ascending order.
+
+        Raises:
+            UnsupportedSearchError: Search cannot be translated to SQL.
+        """
+        where, params = self._where(search)
+        query = f"SELECT books.id FROM books WHERE {where} ORDER BY books.id"
+        return [row[0] for row in self.connect().execute(query, params)]
+
+    def iter_books(
+        self,
+        sort: list[str] = None,
+        search: list[str] = None,
+        batch_size: int = CHUNK_SIZE,
+        fields: list[str] = None,
+    ) -> Iterator[Book]:
+        """Iterate over every sorted and filtered book in metadata.db.
+
+        Books are read in batches of keyset queries, each in its own short
+        read transaction, so that calibre is not blocked from writing while
+        the books are consumed.
+
+        Raises:
+            UnsupportedSearchError: Search cannot be translated to SQL.
+        """
+        key = None
+        more = True
+        while more:
+            books, keys, more = self.get_books_by_keyset(
+                sort, search, key, False, batch_size, fields
+            )
+            yield from books
+            if len(keys):
+                key = keys[-1]
+
+    def count_books(self, search: list[str] = None) -> int:
+        """Count the number of (filtered) books in metadata.db.
+
+        Raises:
+            UnsupportedSearchError: Search cannot be translated to SQL.
+        """
+        where, params = self._where(search)
+        query = f"SELECT count(*) FROM books WHERE {where}"
+        (count,) = self.connect().execute(query, params).fetchone()
+        return count
+
+    def _where(self, search: list[str]) -> tuple[str, list]:
+        tree = search_parser.parse(search)
+        if tree is None:
+            return "1", []
+
+        search_parser.validate(tree)
+        return search_parser.compile_sql(tree)
+
+    def get_books_by_keyset(
+        self,
+        sort: list[str] = None,
+        search: list[str] = None,
+        key: list = None,
+        before: bool = False,
+        limit: int = 20,
+        fields: list[str] = None,
+    ) -> tuple[list[Book], list[list], bool]:
+        """Get a page of sorted books positioned by the sort key of a book.
+
+        Unlike offset pagination, the cost of a page does not depend on how
+        deep it is and books added or removed before the key do not shift the
+        page.
+
+        Args:
+            sort (list[str]): List of sort keys to sort results by
+            search (list[str]): List of search terms, see search.parse()
+            key (list): Sort key values followed by the id of the book to page
+                from, as returned by a previous call. Defaults to the first page.
+            before (bool): Return the books immediately before key instead of
+                after it. Books are still returned in sort order.
+            limit (int): Maximum number of books to return.
+            fields (list[str]): Book fields to read. Defaults to all.
+
+        Returns:
+            list[Book]: List of books
+            list[list]: Sort key of each book, in the same form as key
+            bool: Whether more books exist beyond this page in the direction
+                of travel
+        """
+        terms = self._sort_terms(sort)
+        if before:
+            terms = [(expr, not desc) for expr, desc in terms]
+
+        columns = ", ".join(expr for expr, _ in terms[:-1])
+        query = "SELECT books.id"
+        if columns:
+            query += f", {columns}"
+        where, params = self._where(search)
+        query += f" FROM books WHERE {where}"
+
+        if key is not None:
+            if len(key) != len(terms):
+                raise ValueError("cursor does not match sort keys")
+            keyset, keyset_params = keyset_condition(terms, key)
+            query += f" AND ({keyset})"
+            params += keyset_params
+
+        query += f" ORDER BY {order_by(terms)} LIMIT ?"
+        params.append(limit + 1)
+
+        conn = self.connect()
+        with read_transaction(conn):
+            rows = conn.execute(query, params).fetchall()
+            more = len(rows) > limit
+            rows = rows[:limit]
+            if before:
+                rows.reverse()
+            books = self._load(conn, [row[0] for row in rows], fields)
+
+        # sort key values come first, the id is always the last term
+        keys = [[*row[1:], row[0]] for row in rows]
+        return books, keys, more
+
+    def _order_by(self, sort: list[str]) -> str:
+        return order_by(self._sort_terms(sort))
+
+    def _sort_terms(self, sort: list[str]) -> list[tuple[str, bool]]:
+        """Build the SQL sort terms for the given sort keys.
+
+        Each key is sorted in ascending order, or descending order if it is
+        prefixed with `-`.
+
+        Returns:
+            list[tuple[str, bool]]: SQL expression and whether it is sorted in
+                descending order. The book id is always the final term so that
+                the order is total. It is sorted in the same direction as the
+                last sort key.
+        """
+        terms = []
+        for key, desc in sort_keys(sort, self.SORT_COLUMNS, self.logger):
+            exprs = self.SORT_COLUMNS[key]
+            if isinstance(exprs, str):
+                exprs = (exprs,)
+            terms.extend((expr, desc) for expr in exprs)
+
+        descending = terms[-1][1] if len(terms) else False
+        terms.append(("books.id", descending))
+        return terms
+
+    def _load(
+        self, conn: sqlite3.Connection, ids: list[int], fields: list[str] = None
+    ) -> list[Book]:
+        """Build books with the given ids, preserving the order of ids.
+
+        Each table is read once per chunk of ids rather than once per book.
+        Ids that do not exist are skipped.
+        """
+        books = self.load_rows(conn, ids, fields)
+        for b in books.values():
+            del b["sort"]
+
+        return [Book(**books[i]) for i in ids if i in books]
+
+    def load_rows(
+        self, conn: sqlite3.Connection, ids: list[int], fields: list[str] = None
+    ) -> dict:
+        """Read the raw fields of books with the given ids.
+
+        Args:
+            conn (sqlite3.Connection): Connection to read from
+            ids (list[int]): Book IDs
+            fields (list[str]): Book fields to read. Link tables that none of
+                the fields are stored in are not queried. Fields stored in the
+                books table are always read. Defaults to all.
+
+        Returns:
+            dict: Map of book ids to a dict of Book fields. The title's sort
+                value is included under the extra "sort" key.
+        """
+        queries = self.LINK_QUERIES
+        if fields is not None:
+            links = {self.LINK_FIELDS.get(f, f) for f in fields}
+            queries = {k: v for k, v in queries.items() if k in links}
+
+        rows = {}
+        for chunk in chunks(ids, self.CHUNK_SIZE):
+            rows.update(self._load_chunk(conn, chunk, queries))
+        return rows
+
+    def _load_chunk(
+        self, conn: sqlite3.Connection, ids: list[int], queries: dict
+    ) -> dict:
+        marks = ",".join("?" * len(ids))
+        data = {}
+        paths = {}
+
+        for row in conn.execute(self.BOOKS_QUERY.format(marks), ids):
+            (
+                id,
+                title,
+                sort,
+                author_sort,
+                timestamp,
+                pubdate,
+                series_index,
+                book_path,
+                uuid,
+                has_cover,
+                last_modified,
+            ) = row
+
+            paths[id] = book_path
+            data[id] = {
+                "id": id,
+                "title": title,
+                "sort": sort or title,
+                "author_sort": author_sort,
+                "timestamp": isoformat(timestamp),
+                "pubdate": isoformat(pubdate),
+                "series_index": series_index,
+                "uuid": uuid,
+                "last_modified": isoformat(last_modified),
+                "identifiers": {},
+                "isbn": "",
+            }
+            if has_cover:
+                data[id]["cover"] = path.join(self.lib, book_path, "cover.jpg")
+
+        if not len(data):
+            return data
+
+        for field, query in queries.items():
+            for row in conn.execute(query.format(marks), ids):
+                book = data.get(row[0])
+                if book is None:
+                    continue
+
+                if field in ("authors", "tags", "languages"):
+                    book.setdefault(field, []).append(row[1])
+
+                elif field == "identifiers":
+                    book["identifiers"][row[1]] = row[2]
+
+                elif field == "formats":
+                    _, fmt, size, name = row
+                    filename = f"{name}.{fmt.lower()}"
+                    book.setdefault("formats", []).append(
+                        path.join(self.lib, paths[row[0]], filename)
+                    )
+                    book["size"] = max(book.get("size", 0), size)
+
+                elif row[1] is not None:
+                    book[field] = row[1]
+
+        for book in data.values():
+            # calibredb returns authors as a single string
+            if "authors" in book:
+                book["authors"] = " & ".join(book["authors"])
+            book["isbn"] = book["identifiers"].get("isbn", "")
+
+        return data
+
+
+def sort_keys(
+    sort: list[str], supported, logger: logging.Logger
+) -> list[tuple[str, bool]]:
+    """Split sort keys into their name and direction.
+
+    Keys prefixed with `-` are sorted in descending order. Keys that are not
+    in supported are dropped with a warning.
+
+    Returns:
+        list[tuple[str, bool]]: Key and whether it is sorted in descending order
+    """
+    if sort is None or not len(sort):
+        return []
+
+    unsafe_sort = [x for x in sort if x.removeprefix("-") not in supported]
+    if len(unsafe_sort):
+        logger.warning(
+            f"The following sort keys are not supported and will be ignored: "
+            f"\"{', '.join(unsafe_sort)}\"."
+        )
+
+    return [
+        (x.removeprefix("-"), x.startswith("-"))
+        for x in sort
+        if x.removeprefix("-") in supported
+    ]
+
+
+def order_by(terms: list[tuple[str, bool]]) -> str:
+    return ", ".join(f"{expr} {'DESC' if desc else 'ASC'}" for expr, desc in terms)
+
+
+def keyset_condition(terms: list[tuple[str, bool]], key: list) -> tuple[str, list]:
+    """Build a WHERE clause selecting the rows that sort after key.
+
+    Terms may be sorted in different directions, so row value comparisons
+    cannot be used. The clause is expanded to
+
+        (t1 > k1) OR (t1 = k1 AND t2 > k2) OR ...
+
+    with > replaced by < for descending terms.
+
+    Returns:
+        str: SQL condition
+        list: Parameters for the condition
+    """
+    clauses = []
+    params = []
+    for i, (expr, desc) in enumerate(terms):
+        parts = [f"{e} = ?" for e, _ in terms[:i]]
+        parts.append(f"{expr} {'<' if desc else '>'} ?")
+        clauses.append(f"({' AND '.join(parts)})")
+        params.extend(key[: i + 1])
+
+    return " OR ".join(clauses), params
+
+
+def collation_key(s: str) -> str:
+    """Case and accent insensitive sort key of a string, e.g. "É" sorts as "e"."""
+    s = unicodedata.normalize("NFKD", s or "")
+    return "".join(c for c in s if not unicodedata.combining(c)).casefold()
+
+
+def collate_folded(a: str, b: str) -> int:
+    """SQLite collation that compares the collation_key() of two strings."""
+    a, b = collation_key(a), collation_key(b)
+    return (a > b) - (a < b)
+
+
+@contextmanager
+def read_transaction(conn: sqlite3.Connection):
+    """Run a group of reads against a single snapshot of the database."""
+    conn.execute("BEGIN")
+    try:
+        yield conn
+    finally:
+        conn.execute("COMMIT")
+
+
+def chunks(lst: list, size: int):
+    for i in range(0, len(lst), size):
+        yield lst[i : i + size]  # noqa: E203
+
+
+def db_version(db_path: str) -> tuple:
+    """Get a cheap version of a SQLite database that changes on every write.
+
+    Every commit changes the modification time or size of the database or its
+    WAL file, so the version is read from the filesystem without opening the
+    database. Unlike a counter kept in memory, it is shared by every process
+    that uses the library.
+
+    Returns:
+        tuple: Modification time (ns) and size of the database and WAL file
+    """
+    version = ()
+    for p in (db_path, db_path + "-wal"):
+        try:
+            st = os.stat(p)
+            version += (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            version += (0, 0)
+    return version
+
+
+def isoformat(value: str) -> str:
+    """Convert a timestamp stored by calibre into calibredb's ISO 8601 output.
+
+    Calibre stores timestamps as UTC text, e.g. "2023-05-16 06:19:44+00:00".
+    """
+    if not value:
+        return ""
+
+    try:
+        dt = datetime.fromisoformat(value)
+    except ValueError:
+        return value
+
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc).isoformat()
@@ -0,0 +1,304 @@
+import hashlib
+import json
+import os
+import os.path as path
+import re
+import shutil
+import tempfile
+import time
+import typing as t
+import uuid
+
+from flask import Request
+from flask import current_app as app
+from werkzeug.utils import secure_filename
+
+from calibre_rest.errors import UploadOffsetError
+from calibre_rest.lock import FileLock
+
+
+class SpoolRequest(Request):
+    """Request that streams uploaded files to a private spool directory.
+
+    Werkzeug's form parser writes each uploaded file to the stream returned
+    by _get_file_stream() in small chunks, so memory use is bounded no matter
+    the size of the upload. Each file is written to its own subdirectory of a
+    directory that is private to the request, under the spool directory
+    (spool_path, or the system temporary directory if it is empty). Uploads
+    of concurrent requests never share a path, and the files keep their
+    original (sanitized) names, which calibre uses as a fallback title.
+    The SHA-256 hash of each file is computed while it is written, see
+    HashingFile.
+
+    The request's spool directory is removed when the request is closed,
+    after the response has been sent, whether or not the request succeeded.
+    """
+
+    spool_dir: str = None
+
+    def _get_file_stream(
+        self,
+        total_content_length: int | None,
+        content_type: str | None,
+        filename: str | None = None,
+        content_length: int | None = None,
+    ) -> t.IO[bytes]:
+        if self.spool_dir is None:
+            spool_path = app.config.get("spool_path") or tempfile.gettempdir()
+            # mkdtemp creates the directory readable only by this user
+            self.spool_dir = tempfile.mkdtemp(prefix="upload-", dir=spool_path)
+
+        file_dir = tempfile.mkdtemp(dir=self.spool_dir)
+        name = secure_filename(filename or "") or "upload"
+        return HashingFile(open(path.join(file_dir, name), "w+b"))
+
+    def close(self) -> None:
+        try:
+            super().close()
+        finally:
+            if self.spool_dir is not None:
+                shutil.rmtree(self.spool_dir, ignore_errors=True)
+                self.spool_dir = None
+
+
+class HashingFile:
+    """File that computes the SHA-256 hash of the data written to it."""
+
+    def __init__(self, file: t.IO[bytes]) -> None:
+        self.file = file
+        self.hash = hashlib.sha256()
+
+    def write(self, data: bytes) -> int:
+        self.hash.update(data)
+        return self.file.write(data)
+
+    def hexdigest(self) -> str:
+        return self.hash.hexdigest()
+
+    def __getattr__(self, name: str):
+        return getattr(self.file, name)
+
+    def __iter__(self):
+        return iter(self.file)
+
+
+def spooled_path(stream: t.IO[bytes], directory: str = None) -> str:
+    """Get the path to an uploaded file spooled by SpoolRequest.
+
+    Args:
+        stream (IO[bytes]): Stream of the uploaded file
+        directory (str): Directory to move the file to, so it outlives the
+            request. The file stays in the request's spool directory if None.
+
+    Returns:
+        str: Path to the uploaded file
+    """
+    stream.flush()
+    filepath = stream.name
+    if directory is None:
+        return filepath
+
+    stream.close()
+    return move_file(filepath, directory)
+
+
+def move_file(filepath: str, directory: str) -> str:
+    """Move a spooled file to directory, keeping its name.
+
+    The file is moved into a subdirectory named after the directory the file
+    is in, so files with the same name do not overwrite each other.
+
+    Returns:
+        str: New path to the file
+    """
+    file_dir = path.join(directory, path.basename(path.dirname(filepath)))
+    os.makedirs(file_dir, exist_ok=True)
+    # a rename if the spool directory is on the same filesystem, a copy
+    # otherwise
+    return shutil.move(filepath, path.join(file_dir, path.basename(filepath)))
+
+
+class UploadStore:
+    """Resumable uploads, kept on the spool volume until they are added.
+
+    An upload is created with the name of its file and, optionally, its
+    size. The file is then sent in chunks of any size, each appended at the
+    upload's offset, which is the number of bytes written so far. The offset
+    is the size of the file on disk, so it survives restarts and is shared by
+    every worker process. A chunk that is cut off keeps the bytes that
+    arrived, and the client resumes from the offset it reads back.
+
+    Each upload is a directory named after its id, holding the upload's
+    metadata and its file. Uploads that are not written to for TTL seconds
+    are removed when the next upload is created.
+    """
+
+    TTL = 24 * 60 * 60
+    BUFFER_SIZE = 1 << 16
+    ID_REGEX = re.compile(r"^[0-9a-f]{32}$")
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def create(self, filename: str, size: int = None) -> dict:
+        """Create an upload.
+
+        Args:
+            filename (str): Name of the uploaded file
+            size (int): Size of the file in bytes, if known
+
+        Returns:
+            dict: The upload, see get()
+        """
+        self.expire()
+
+        upload_id = uuid.uuid4().hex
+        upload_dir = path.join(self.path, upload_id)
+        os.makedirs(upload_dir, mode=0o700)
+
+        meta = {"filename": filename, "size": size, "created": time.time()}
+        with open(path.join(upload_dir, "upload.json"), "w") as f:
+            json.dump(meta, f)
+
+        name = secure_filename(filename) or "upload"
+        open(path.join(upload_dir, name), "wb").close()
+        return self.get(upload_id)
+
+    def get(self, upload_id: str) -> dict | None:
+        """Get an upload, or None if it does not exist.
+
+        Returns:
+            dict: The id, filename, size (or None) and offset of the upload
+        """
+        if self.ID_REGEX.match(upload_id) is None:
+            return None
+
+        try:
+            with open(path.join(self.path, upload_id, "upload.json")) as f:
+                meta = json.load(f)
+            offset = path.getsize(self.file_path(upload_id, meta))
+        except FileNotFoundError:
+            return None
+
+        return {
+            "id": upload_id,
+            "filename": meta["filename"],
+            "size": meta["size"],
+            "offset": offset,
+        }
+
+    def append(
+        self, upload_id: str, start: int, stream: t.IO[bytes], end: int = None
+    ) -> dict:
+        """Append a chunk to an upload.
+
+        Bytes of the chunk before the upload's offset were already written,
+        for example by a request whose response was lost, and are skipped.
+        The bytes of a chunk that does not match its range are written up to
+        where the range or the chunk ends, whichever comes first, and the
+        client resumes from the offset of the error.
+
+        Args:
+            upload_id (str): Upload id
+            start (int): Position of the chunk in the file
+            stream (IO[bytes]): Stream of the chunk
+            end (int): Position right after the last byte of the chunk, if
+                known
+
+        Returns:
+            dict: The upload, see get()
+
+        Raises:
+            KeyError: The upload does not exist
+            UploadOffsetError: The chunk starts after the upload's offset, or
+                is shorter or longer than end - start bytes
+            ValueError: The chunk goes past the upload's size
+        """
+        upload = self.get(upload_id)
+        if upload is None:
+            raise KeyError(f"upload {upload_id} does not exist")
+
+        # chunks of the same upload are written one at a time, across
+        # processes
+        with FileLock(path.join(self.path, upload_id, ".lock")).write():
+            filepath = self.file_path(upload_id)
+            offset = path.getsize(filepath)
+            if start > offset:
+                raise UploadOffsetError(
+                    f"Chunk starts at {start}, after offset {offset}", offset
+                )
+
+            skip = offset - start
+            size = upload["size"]
+            length = None if end is None else end - start
+            received = 0
+            with open(filepath, "ab") as f:
+                try:
+                    while True:
+                        chunk = stream.read(self.BUFFER_SIZE)
+                        if not len(chunk):
+                            break
+                        received += len(chunk)
+                        if length is not None and received > length:
+                            chunk = chunk[: len(chunk) - (received - length)]
+                        if skip:
+                            skipped = min(skip, len(chunk))
+                            chunk = chunk[skipped:]
+                            skip -= skipped
+                        if size is not None and f.tell() + len(chunk) > size:
+                            f.write(chunk[: size - f.tell()])
+                            raise ValueError(f"Chunk goes past the upload size {size}")
+                        f.write(chunk)
+                        if length is not None and received > length:
+                            break
+                finally:
+                    f.flush()
+                    os.fsync(f.fileno())
+                    offset = f.tell()
+
+        if length is not None and received != length:
+            raise UploadOffsetError(
+                f"Chunk of {'more than ' if received > length else ''}{received} "
+                f"bytes does not match its range of {length} bytes",
+                offset,
+            )
+        return self.get(upload_id)
+
+    def file_path(self, upload_id: str, meta: dict = None) -> str:
+        """Get the path to an upload's file."""
+        if meta is None:
+            with open(path.join(self.path, upload_id, "upload.json")) as f:
+                meta = json.load(f)
+        name = secure_filename(meta["filename"]) or "upload"
+        return path.join(self.path, upload_id, name)
+
+    def take(self, upload_id: str, directory: str) -> str:
+        """Move an upload's file to directory and remove the upload.
+
+        Returns:
+            str: New path to the file
+        """
+        filepath = move_file(self.file_path(upload_id), directory)
+        self.remove(upload_id)
+        return filepath
+
+    def remove(self, upload_id: str) -> None:
+        if self.ID_REGEX.match(upload_id) is not None:
+            shutil.rmtree(path.join(self.path, upload_id), ignore_errors=True)
+
+    def expire(self) -> None:
+        """Remove the uploads that were not written to for TTL seconds."""
+        if not path.isdir(self.path):
+            return
+
+        now = time.time()
+        for entry in os.scandir(self.path):
+            if not entry.is_dir() or self.ID_REGEX.match(entry.name) is None:
+                continue
+            try:
+                mtime = path.getmtime(self.file_path(entry.name))
+            except (OSError, ValueError):
+                # an upload that was never completely created
+                mtime = entry.stat().st_mtime
+            if now - mtime > self.TTL:
+                self.remove(entry.name)
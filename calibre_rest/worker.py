@@ -0,0 +1,129 @@
+import json
+import logging
+import subprocess
+import threading
+from os import path
+
+SCRIPT = path.join(path.dirname(path.abspath(__file__)), "worker_script.py")
+
+
+class CalibreWorker:
+    """Client of a long-lived calibre process that runs calibredb commands.
+
+    Starting calibredb costs far more than most commands themselves, as every
+    run starts calibre's interpreter and loads the library from scratch. The
+    worker (see worker_script.py) keeps the library open and runs commands
+    in-process, one at a time, over a pipe.
+
+    The worker is started on first use and respawned if it exits. A command
+    that is running when the worker exits is not retried, as it may have
+    already changed the library.
+    """
+
+    def __init__(self, cmd: list[str], logger: logging.Logger = None) -> None:
+        """Initialize the worker client. The worker is not started yet.
+
+        Args:
+            cmd (list[str]): Command that runs worker_script.py with calibre's
+                Python, e.g. ["calibre-debug", "-e", SCRIPT]
+            logger (logging.Logger): Custom logger object
+        """
+        if logger is None:
+            logger = logging.getLogger(__name__)
+        self.logger = logger
+
+        self.cmd = cmd
+        self.process = None
+        self.lock = threading.Lock()
+
+    def start(self) -> None:
+        """Start the worker if it is not running.
+
+        Raises:
+            FileNotFoundError: The worker's executable is invalid.
+            RuntimeError: The worker exited before it was ready.
+        """
+        with self.lock:
+            self._start()
+
+    def _start(self) -> None:
+        if self.process is not None and self.process.poll() is None:
+            return
+
+        if self.process is not None:
+            self.logger.warning(
+                f"calibre worker exited with status {self.process.returncode}, "
+                "restarting"
+            )
+            for pipe in (self.process.stdin, self.process.stdout):
+                try:
+                    pipe.close()
+                except OSError:
+                    pass
+
+        try:
+            self.process = subprocess.Popen(
+                self.cmd,
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                text=True,
+                encoding="utf-8",
+            )
+        except FileNotFoundError as err:
+            raise FileNotFoundError(f"Executable could not be found.\n\n{err}") from err
+
+        line = self.process.stdout.readline()
+        if not line:
+            returncode = self.process.wait()
+            self.process = None
+            raise RuntimeError(f"calibre worker exited with status {returncode}")
+        self.logger.debug(f"Started calibre worker {self.process.pid}")
+
+    def run(self, args: list[str]) -> tuple[int, str, str]:
+        """Run a calibredb command in the worker.
+
+        Args:
+            args (list[str]): calibredb arguments, without the executable
+
+        Returns:
+            int: Exit code of the command. Negative if the worker was killed
+                by a signal while running it.
+            str: Stdout of command
+            str: Stderr of command
+
+        Raises:
+            FileNotFoundError: The worker's executable is invalid.
+            RuntimeError: The worker could not be started.
+        """
+        with self.lock:
+            self._start()
+            process = self.process
+
+            try:
+                process.stdin.write(json.dumps({"args": args}) + "\n")
+                process.stdin.flush()
+                line = process.stdout.readline()
+            except (BrokenPipeError, ValueError):
+                line = ""
+
+            if not line:
+                # the worker died, it is respawned on the next command
+                returncode = process.wait()
+                return (
+                    returncode or 1,
+                    "",
+                    f"calibre worker exited with status {returncode}",
+                )
+
+        res = json.loads(line)
+        return res["returncode"], res["stdout"], res["stderr"]
+
+    def close(self) -> None:
+        """Stop the worker, waiting for the current command to finish."""
+        with self.lock:
+            if self.process is None:
+                return
+            self.process.stdin.close()
+            self.process.wait()
+            self.process.stdout.close()
+            self.process = None
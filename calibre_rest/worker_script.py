@@ -0,0 +1,201 @@
+"""Long-lived calibredb worker, run with calibre's bundled Python:
+
+    calibre-debug -e worker_script.py
+
+Each line on stdin is a JSON request {"args": [...]} holding the arguments of
+a calibredb command, without the executable. The command is run in-process
+with calibredb's own command-line entry point and a JSON response
+{"returncode": int, "stdout": str, "stderr": str} is written as a single line.
+
+Libraries are kept open between commands, so a command does not pay for
+starting calibre and loading the library. Like calibredb, each command holds
+calibre's single instance lock only while it runs, so the calibre GUI and
+calibre-server can use the library in between. A library that another program
+changed since the last command is reopened before the next one runs.
+
+This file is executed by calibre, not imported by calibre-rest, and must only
+depend on the standard library and calibre itself.
+"""
+
+import io
+import json
+import os
+import sys
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+
+
+def serve(main, requests, responses) -> None:
+    """Run calibredb commands until requests is closed.
+
+    Args:
+        main (Callable): calibredb's entry point, taking the full argv
+        requests (TextIO): Stream of JSON requests, one per line
+        responses (TextIO): Stream that JSON responses are written to
+    """
+    responses.write(json.dumps({"ready": True}) + "\n")
+    responses.flush()
+
+    for line in requests:
+        if not line.strip():
+            continue
+        args = json.loads(line)["args"]
+        responses.write(json.dumps(run(main, args)) + "\n")
+        responses.flush()
+
+
+def run(main, args: list[str]) -> dict:
+    """Run a single calibredb command, capturing its output and exit code."""
+    stdout = io.TextIOWrapper(io.BytesIO(), encoding="utf-8")
+    stderr = io.TextIOWrapper(io.BytesIO(), encoding="utf-8")
+
+    returncode = 0
+    with redirect_stdout(stdout), redirect_stderr(stderr):
+        try:
+            returncode = main(["calibredb", *args]) or 0
+        except SystemExit as exc:
+            # calibredb reports most errors by exiting with a message
+            if isinstance(exc.code, int):
+                returncode = exc.code
+            elif exc.code is not None:
+                print(exc.code, file=sys.stderr)
+                returncode = 1
+        except Exception:
+            traceback.print_exc()
+            returncode = 1
+
+    return {
+        "returncode": returncode,
+        "stdout": read(stdout),
+        "stderr": read(stderr),
+    }
+
+
+def read(stream: io.TextIOWrapper) -> str:
+    stream.flush()
+    return stream.buffer.getvalue().decode("utf-8", errors="replace")
+
+
+CONCURRENCY_ERROR = (
+    "Another calibre program such as calibre-server or the main calibre program "
+    "is running."
+)
+
+
+def library_version(library_path: str) -> tuple:
+    """Get the modification time and size of a library's metadata.db and its
+    WAL file, which change whenever any program writes to the library.
+    """
+    version = []
+    for name in ("metadata.db", "metadata.db-wal"):
+        try:
+            stat = os.stat(os.path.join(library_path, name))
+            version.extend((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            version.extend((0, 0))
+    return tuple(version)
+
+
+class Libraries:
+    """Libraries opened by the worker, keyed by path.
+
+    Each library is stored with the version of metadata.db it was last seen
+    at. A library whose version changed was written to by another program,
+    so it is closed and reopened instead of serving stale data.
+    """
+
+    def __init__(self, open_library, version=library_version) -> None:
+        """Initialize the libraries. None is opened yet.
+
+        Args:
+            open_library (Callable): Opens the library at a path
+            version (Callable): Gets the version of the library at a path
+        """
+        self.open_library = open_library
+        self.version = version
+        self.opened = {}
+
+    def get(self, library_path: str):
+        db, version = self.opened.get(library_path, (None, None))
+        current = self.version(library_path)
+        if db is not None and version != current:
+            db.close()
+            db = None
+        if db is None:
+            db = self.open_library(library_path)
+        self.opened[library_path] = (db, current)
+        return db
+
+    def checkpoint(self) -> None:
+        """Record the current version of every open library, so that the
+        worker's own writes do not reopen them. Must be called while the
+        single instance lock is still held.
+        """
+        for library_path, (db, _) in self.opened.items():
+            self.opened[library_path] = (db, self.version(library_path))
+
+
+def locked(main, acquire, libraries: Libraries):
+    """Wrap calibredb's entry point to hold calibre's single instance lock
+    for the duration of each command.
+
+    Args:
+        main (Callable): calibredb's entry point
+        acquire (Callable): Takes the lock, returning a function that releases
+            it, or None if another calibre program holds it
+        libraries (Libraries): Libraries the commands use
+    """
+
+    def run(argv: list[str]):
+        release = acquire()
+        if release is None:
+            raise SystemExit(CONCURRENCY_ERROR)
+        try:
+            return main(argv)
+        finally:
+            libraries.checkpoint()
+            release()
+
+    return run
+
+
+def calibredb_main():
+    """Return calibredb's entry point, patched to keep libraries open."""
+    from calibre.db.cli import main as cli
+    from calibre.db.legacy import LibraryDatabase
+    from calibre.utils import lock
+
+    # calibredb takes the single instance lock itself, which fails while this
+    # process holds it for the command
+    def singleinstance(name):
+        return True
+
+    acquire = getattr(lock, "create_single_instance_mutex", None)
+    if acquire is None:
+        # calibre versions that cannot release the lock hold it for the
+        # lifetime of the worker, like the calibre GUI
+        if not lock.singleinstance("db"):
+            raise SystemExit(CONCURRENCY_ERROR)
+
+        def acquire(name):
+            return lambda: None
+
+    lock.singleinstance = singleinstance
+    if hasattr(cli, "singleinstance"):
+        cli.singleinstance = singleinstance
+
+    libraries = Libraries(lambda p: LibraryDatabase(p).new_api)
+    cli.DBCtx.db = property(lambda self: libraries.get(self.library_path))
+    return locked(cli.main, lambda: acquire("db"), libraries)
+
+
+if __name__ == "__main__":
+    main = calibredb_main()
+
+    # Responses go to a private copy of stdout. Anything calibre writes to
+    # stdout outside of a command, including from C code, goes to stderr
+    # instead of corrupting the responses.
+    responses = os.fdopen(os.dup(sys.stdout.fileno()), "w", encoding="utf-8")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    serve(main, sys.stdin, responses)
@@ -4,6 +4,8 @@ import os
 
 class Config:
     LOG_LEVELS = ["DEBUG", "INFO", "WARNING", "ERROR"]
+    READ_ENGINES = ["calibredb", "sqlite", "index"]
+    BACKENDS = ["subprocess", "sqlite", "worker"]
 
     __config = {
         "calibredb": os.environ.get("CALIBRE_REST_PATH", "/opt/calibre/calibredb"),
@@ -12,6 +14,15 @@ class Config:
         "username": os.environ.get("CALIBRE_REST_USERNAME", ""),
         "password": os.environ.get("CALIBRE_REST_PASSWORD", ""),
         "log_level": os.environ.get("CALIBRE_REST_LOG_LEVEL", "INFO"),
+        "read_engine": os.environ.get("CALIBRE_REST_READ_ENGINE", "calibredb"),
+        "fts_path": os.environ.get("CALIBRE_REST_FTS_PATH", ""),
+        "workers": int(os.environ.get("CALIBRE_REST_WORKERS", "1")),
+        "backend": os.environ.get("CALIBRE_REST_BACKEND", "subprocess"),
+        "lock_path": os.environ.get("CALIBRE_REST_LOCK_PATH", ""),
+        "jobs_path": os.environ.get("CALIBRE_REST_JOBS_PATH", ""),
+        "spool_path": os.environ.get("CALIBRE_REST_SPOOL_PATH", ""),
+        "hash_path": os.environ.get("CALIBRE_REST_HASH_PATH", ""),
+        "idempotency_path": os.environ.get("CALIBRE_REST_IDEMPOTENCY_PATH", ""),
         "debug": False,
         "testing": False,
     }
@@ -22,6 +33,15 @@ class Config:
         "username",
         "password",
         "log_level",
+        "read_engine",
+        "fts_path",
+        "workers",
+        "backend",
+        "lock_path",
+        "jobs_path",
+        "spool_path",
+        "hash_path",
+        "idempotency_path",
         "debug",
         "testing",
     ]
@@ -45,6 +65,22 @@ class Config:
                     Config.__config[key] = "INFO"
                     return
 
+            if key == "read_engine":
+                if value not in Config.READ_ENGINES:
+                    logging.warning(
+                        f'Read engine "{value}" not supported. Setting read engine to "calibredb"'
+                    )
+                    Config.__config[key] = "calibredb"
+                    return
+
+            if key == "backend":
+                if value not in Config.BACKENDS:
+                    logging.warning(
+                        f'Backend "{value}" not supported. Setting backend to "subprocess"'
+                    )
+                    Config.__config[key] = "subprocess"
+                    return
+
             Config.__config[key] = value
         else:
             raise NameError(f'Key "{key}" not accepted in Config')
@@ -0,0 +1,89 @@
+import pytest
+
+from benchmark import OPERATIONS, measure, report
+from calibre_rest.backend import BACKENDS, Backend, create_backend
+from config import Config
+
+
+def config(library, backend):
+    return {**Config.config(), "library": library, "backend": backend}
+
+
+@pytest.mark.parametrize(
+    "backend, reader, worker",
+    (
+        ("subprocess", False, False),
+        ("sqlite", True, False),
+        ("worker", False, True),
+    ),
+)
+def test_create_backend(library, backend, reader, worker):
+    cdb = create_backend(config(library, backend))
+
+    assert isinstance(cdb, Backend)
+    assert (cdb.reader is not None) == reader
+    assert (cdb.worker is not None) == worker
+
+
+def test_create_backend_sqlite_index(library):
+    cdb = create_backend({**config(library, "sqlite"), "read_engine": "index"})
+    assert cdb.index is not None
+
+
+def test_create_backend_invalid(library):
+    with pytest.raises(ValueError, match='Backend "foo" not supported'):
+        create_backend(config(library, "foo"))
+
+
+@pytest.mark.parametrize(
+    "library, lock_path, expected",
+    (
+        ("/library", "", "/library/.calibre-rest.lock"),
+        ("/library", "/run/calibre.lock", "/run/calibre.lock"),
+        ("http://localhost:8080/#lib", "", None),
+        ("http://localhost:8080/#lib", "/run/calibre.lock", "/run/calibre.lock"),
+    ),
+)
+def test_create_backend_lock_path(library, lock_path, expected):
+    cdb = create_backend({**config(library, "subprocess"), "lock_path": lock_path})
+
+    if expected is None:
+        assert cdb.file_lock is None
+    else:
+        assert cdb.file_lock.path == expected
+
+
+def test_create_backend_lock_dir_not_found(library):
+    cdb = create_backend({**config(library, "sqlite"), "lock_path": "/foo/bar.lock"})
+    cdb.cdb = "/bin/sh"
+    with pytest.raises(FileNotFoundError, match="Lock file directory /foo not found"):
+        cdb.check()
+
+
+def test_config_backend():
+    Config.set("backend", "foo")
+    assert Config.get("backend") == "subprocess"
+
+    Config.set("backend", "sqlite")
+    assert Config.get("backend") == "sqlite"
+    Config.set("backend", "subprocess")
+
+
+def test_benchmark_read_operations(library):
+    # the read operations run against the sqlite backend without calibredb
+    cdb = create_backend(config(library, "sqlite"))
+    ids = [b.id for b in cdb.get_books()]
+
+    for name in ("get_book", "get_books", "search", "count_books"):
+        latencies, throughput = measure(cdb, OPERATIONS[name], ids, 3, 2)
+        assert len(latencies) == 3
+        assert throughput > 0
+
+
+def test_benchmark_report():
+    results = {"get_book": {name: (1.25, 2.5, 800.0) for name in BACKENDS}}
+    lines = report(results, list(BACKENDS)).splitlines()
+
+    assert lines[0].startswith("operation")
+    assert "subprocess p50/p95 ms, op/s" in lines[0]
+    assert lines[1].split()[:3] == ["get_book", "1.2/2.5,", "800.0"]
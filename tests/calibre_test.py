@@ -1,6 +1,11 @@
+import json
+import re
+import shlex
+import sys
+
 import pytest
 
-from calibre_rest.calibre import CalibreWrapper
+from calibre_rest.calibre import CalibreWrapper, prime
 from calibre_rest.errors import CalibreRuntimeError
 from calibre_rest.models import Book
 
@@ -203,3 +208,292 @@ def test_handle_update_flags_invalid(book, expected):
     cmd = "calibredb set_metadata 1"
     got = dud_wrapper._handle_update_flags(cmd, book)
     assert got == expected
+
+
+@pytest.mark.parametrize(
+    "out, expected",
+    (
+        pytest.param("1,2,3\n", 3, id="multiple"),
+        pytest.param("4\n", 1, id="single"),
+        pytest.param("", 0, id="empty"),
+    ),
+)
+def test_count_books(monkeypatch, out, expected):
+    monkeypatch.setattr(dud_wrapper, "_run", lambda cmd: (out, ""))
+    assert dud_wrapper.count_books(["title:foo"]) == expected
+
+
+def test_count_books_no_match(monkeypatch):
+    def run(cmd):
+        raise CalibreRuntimeError(cmd, 1, "", "No books matching the search")
+
+    monkeypatch.setattr(dud_wrapper, "_run", run)
+    assert dud_wrapper.count_books() == 0
+
+
+def test_get_books_page(monkeypatch):
+    cmds = []
+
+    def run(cmd):
+        cmds.append(cmd)
+        if "--fields=id " in cmd:
+            return '[{"id": 5}, {"id": 3}, {"id": 4}, {"id": 1}]', ""
+        return '[{"id": 1}, {"id": 4}]', ""
+
+    monkeypatch.setattr(dud_wrapper, "_run", run)
+    books = dud_wrapper.get_books(["-title"], None, start=3, limit=2)
+
+    assert [b.id for b in books] == [4, 1]
+    assert "--limit=4" in cmds[0]
+    assert '--search "id:4 or id:1"' in cmds[1]
+
+
+def test_get_books_fields(monkeypatch):
+    cmds = []
+
+    def run(cmd):
+        cmds.append(cmd)
+        return '[{"id": 1, "title": "foo"}]', ""
+
+    monkeypatch.setattr(dud_wrapper, "_run", run)
+    books = dud_wrapper.get_books(None, None, limit=1, fields=["id", "title"])
+
+    assert books == [Book(id=1, title="foo")]
+    assert "--fields=id,title " in cmds[0]
+
+
+def test_existing_ids(monkeypatch):
+    cmds = []
+
+    def run(cmd):
+        cmds.append(cmd)
+        return '[{"id": 3}, {"id": 1}]', ""
+
+    monkeypatch.setattr(dud_wrapper, "_run", run)
+    monkeypatch.setattr(dud_wrapper, "SEARCH_IDS_CHUNK_SIZE", 2)
+
+    assert dud_wrapper.existing_ids([1, 2, 3]) == {1, 3}
+    # one calibredb list per chunk of ids
+    assert len(cmds) == 2
+    assert "--fields=id " in cmds[0]
+    assert '--search "id:1 or id:2"' in cmds[0]
+    assert '--search "id:3"' in cmds[1]
+
+
+def test_get_books_by_cursor_offset(monkeypatch):
+    monkeypatch.setattr(dud_wrapper, "count_books", lambda search: 5)
+    monkeypatch.setattr(
+        dud_wrapper,
+        "get_books",
+        lambda sort, search, start, limit, fields: [
+            Book(id=i) for i in range(start, min(start + limit, 6))
+        ],
+    )
+
+    books, prev, next = dud_wrapper.get_books_by_cursor(None, ["title:foo"], "", 2)
+    assert [b.id for b in books] == [1, 2]
+    assert prev == ""
+
+    books, prev, next = dud_wrapper.get_books_by_cursor(None, ["title:foo"], next, 2)
+    assert [b.id for b in books] == [3, 4]
+
+    books, prev, next = dud_wrapper.get_books_by_cursor(None, ["title:foo"], next, 2)
+    assert [b.id for b in books] == [5]
+    assert next == ""
+
+    books, _, _ = dud_wrapper.get_books_by_cursor(None, ["title:foo"], prev, 2)
+    assert [b.id for b in books] == [3, 4]
+
+
+def test_get_last_modified_cached(monkeypatch):
+    cmds = []
+    version = ["1"]
+
+    def run(cmd):
+        cmds.append(cmd)
+        return '[{"id": 1, "last_modified": "2023-05-16T06:19:44+00:00"}]', ""
+
+    monkeypatch.setattr(dud_wrapper, "_run", run)
+    monkeypatch.setattr(dud_wrapper, "library_version", lambda: (version[0], None))
+
+    assert dud_wrapper.get_last_modified(1) == "2023-05-16T06:19:44+00:00"
+    assert dud_wrapper.get_last_modified(1) == "2023-05-16T06:19:44+00:00"
+    assert len(cmds) == 1
+    assert "--fields=last_modified" in cmds[0]
+
+    # a change to the library drops the cache
+    version[0] = "2"
+    dud_wrapper.get_last_modified(1)
+    assert len(cmds) == 2
+
+
+def python_cmd(code: str) -> str:
+    return f"{shlex.quote(sys.executable)} -c {shlex.quote(code)}"
+
+
+def test_iter_json(monkeypatch):
+    books = [{"id": i, "title": f'foo [{i}], "bar"', "tags": ["a"]} for i in range(5)]
+    code = f"import json; print(json.dumps({books!r}, indent=2))"
+
+    # small reads split books across chunks
+    monkeypatch.setattr(dud_wrapper, "STREAM_CHUNK_SIZE", 7)
+    assert list(dud_wrapper._iter_json(python_cmd(code))) == books
+
+
+def test_iter_json_empty():
+    assert list(dud_wrapper._iter_json(python_cmd("print('[]')"))) == []
+
+
+def test_iter_json_nonzero_exitcode():
+    code = "import sys; print('['); sys.exit('Error: foo')"
+    with pytest.raises(CalibreRuntimeError, match="Error: foo"):
+        list(dud_wrapper._iter_json(python_cmd(code)))
+
+
+def test_iter_json_releases_lock():
+    code = 'print(\'[{"id": 1}, {"id": 2}]\')'
+    books = dud_wrapper._iter_json(python_cmd(code))
+
+    assert next(books) == {"id": 1}
+    # the output was spooled, so the mutex is released while it is read
+    assert not dud_wrapper.mutex.locked()
+    assert list(books) == [{"id": 2}]
+
+
+def test_prime():
+    def fail():
+        raise ValueError("foo")
+        yield
+
+    with pytest.raises(ValueError, match="foo"):
+        prime(fail())
+    assert list(prime(iter([1, 2]))) == [1, 2]
+    assert list(prime([])) == []
+
+
+@pytest.mark.parametrize(
+    "cmd, expected",
+    (
+        ("calibredb --version", "--version"),
+        ("calibredb --with-library lib list --fields=all", "list"),
+        ("calibredb --with-library lib --username u --password p add foo", "add"),
+        ("calibredb --library-path lib show_metadata 1", "show_metadata"),
+        ("calibredb --with-library lib", ""),
+    ),
+)
+def test_subcommand(cmd, expected):
+    assert CalibreWrapper.subcommand(cmd) == expected
+
+
+@pytest.mark.parametrize(
+    "lib, worker, cmd, mode",
+    (
+        ("bar", False, "calibredb --version", "read"),
+        ("bar", False, "calibredb --with-library bar list", "write"),
+        ("bar", False, "calibredb --with-library bar add foo", "write"),
+        ("bar", True, "calibredb --with-library bar list", "read"),
+        ("bar", True, "calibredb --with-library bar remove 1", "write"),
+        ("http://localhost:8080/#lib", False, "calibredb export 1", "read"),
+        ("http://localhost:8080/#lib", False, "calibredb set_metadata 1", "write"),
+    ),
+)
+def test_lock_mode(lib, worker, cmd, mode):
+    wrapper = CalibreWrapper("foo", lib, worker=worker)
+    with wrapper._lock(cmd):
+        pass
+
+    assert wrapper.mutex.metrics()[mode]["acquired"] == 1
+
+
+def test_update_book(monkeypatch):
+    cmds = []
+
+    def run(cmd):
+        cmds.append(cmd)
+        if " list " in cmd:
+            return '[{"id": 1, "title": "foo"}]', ""
+        return "", ""
+
+    monkeypatch.setattr(dud_wrapper, "_run", run)
+    book = dud_wrapper.update_book(1, Book(title="foo"))
+
+    assert book == Book(id=1, title="foo")
+    # no existence check before the update
+    assert " set_metadata 1 --field title:foo" in cmds[0]
+    assert len(cmds) == 2
+
+
+def test_update_book_not_exist(monkeypatch):
+    def run(cmd):
+        if " set_metadata " in cmd:
+            raise CalibreRuntimeError(cmd, 1, "", "No book with id: 1000")
+        return "[]", ""
+
+    monkeypatch.setattr(dud_wrapper, "_run", run)
+    assert dud_wrapper.update_book(1000, Book(title="foo")) is None
+
+
+def test_set_metadata_error(monkeypatch):
+    def run(cmd):
+        if " set_metadata " in cmd:
+            raise CalibreRuntimeError(cmd, 1, "", "Error: foo")
+        return '[{"id": 1}]', ""
+
+    monkeypatch.setattr(dud_wrapper, "_run", run)
+    # the book exists, so the error is not swallowed
+    with pytest.raises(CalibreRuntimeError, match="Error: foo"):
+        dud_wrapper.set_metadata(1, Book(title="foo"))
+
+
+def test_update_books(monkeypatch):
+    cmds = []
+
+    def run(cmd):
+        cmds.append(cmd)
+        if " list " in cmd:
+            ids = [int(i) for i in re.findall(r"id:(\d+)", cmd) if int(i) < 3]
+            return json.dumps([{"id": i} for i in ids]), ""
+        if " set_metadata 2 " in cmd:
+            raise CalibreRuntimeError(cmd, 1, "", "Error: foo\n")
+        return "", ""
+
+    monkeypatch.setattr(dud_wrapper, "_run", run)
+    updates = [(1, Book(tags=["a"])), (2, Book(tags=["b"])), (3, Book(tags=["c"]))]
+    results = list(dud_wrapper.update_books(updates))
+
+    assert results == [
+        {"id": 1, "status": "updated"},
+        {"id": 2, "status": "failed", "error": "Error: foo"},
+        {"id": 3, "status": "not_found"},
+    ]
+    # one existence check for every id, no set_metadata for missing books
+    assert '--search "id:1 or id:2 or id:3"' in cmds[0]
+    assert [cmd.split()[3] for cmd in cmds[1:3]] == ["set_metadata"] * 2
+
+
+def test_update_books_unexpected_error(monkeypatch):
+    def run(cmd):
+        if " list " in cmd:
+            return json.dumps([{"id": 1}, {"id": 2}, {"id": 3}]), ""
+        if " set_metadata 2 " in cmd:
+            raise OSError("No space left on device")
+        return "", ""
+
+    monkeypatch.setattr(dud_wrapper, "_run", run)
+    updates = [(1, Book(tags=["a"])), (2, Book(tags=["b"])), (3, Book(tags=["c"]))]
+
+    assert list(dud_wrapper.update_books(updates)) == [
+        {"id": 1, "status": "updated"},
+        {"id": 2, "status": "failed", "error": "No space left on device"},
+        {"id": 3, "status": "updated"},
+    ]
+
+
+def test_update_books_checks_ids_up_front(monkeypatch):
+    def run(cmd):
+        raise CalibreRuntimeError(cmd, 1, "", "Error: foo")
+
+    monkeypatch.setattr(dud_wrapper, "_run", run)
+    # raised when called, not when the first outcome is read
+    with pytest.raises(CalibreRuntimeError, match="Error: foo"):
+        dud_wrapper.update_books([(1, Book(tags=["a"]))])
@@ -1,10 +1,15 @@
 import os
+import shutil
+import sqlite3
+import uuid
 
 import pytest
 
 from calibre_rest.calibre import CalibreWrapper
 from config import TestConfig
 
+TESTDATA_PATH = os.path.join(os.path.dirname(__file__), "integration", "testdata")
+
 
 @pytest.fixture()
 def calibre():
@@ -16,3 +21,113 @@ def calibre():
         return CalibreWrapper(calibredb, library)
     else:
         pytest.skip("calibredb not installed")
+
+
+@pytest.fixture()
+def library(tmp_path):
+    """Copy of the empty test library seeded with books by writing directly
+    to metadata.db, for tests that do not need calibredb.
+    """
+    shutil.copy(os.path.join(TESTDATA_PATH, "metadata.db"), tmp_path)
+
+    conn = sqlite3.connect(tmp_path / "metadata.db")
+    # functions calibre registers on its own connections, used by triggers
+    conn.create_function("title_sort", 1, lambda x: x)
+    conn.create_function("uuid4", 0, lambda: str(uuid.uuid4()))
+
+    seed_book(
+        conn,
+        title="Children of Time",
+        authors=["Adrian Tchaikovsky"],
+        tags=["Science Fiction", "Aliens"],
+        series="Children of Time",
+        publisher="Tor Books",
+        rating=8,
+        languages=["eng"],
+        identifiers={"isbn": "9781447273288", "isbn10": "1447273281"},
+        comments="<p>Spiders</p>",
+        formats={"EPUB": 518137},
+        timestamp="2022-10-28 07:43:27+00:00",
+        last_modified="2023-05-16 06:19:44.123456+00:00",
+    )
+    seed_book(
+        conn,
+        title="Good Omens",
+        authors=["Terry Pratchett", "Neil Gaiman"],
+        tags=["Fantasy"],
+        languages=["eng", "fra"],
+        formats={"EPUB": 1000, "PDF": 2000},
+        has_cover=True,
+        timestamp="2022-10-29 07:43:27+00:00",
+        last_modified="2023-05-17 06:19:44+00:00",
+    )
+    seed_book(
+        conn,
+        title="Anathem",
+        authors=["Neal Stephenson"],
+        tags=["Science Fiction"],
+        series="Anathem",
+        timestamp="2022-10-30 07:43:27+00:00",
+        last_modified="2023-05-18 06:19:44+00:00",
+    )
+    conn.commit()
+    conn.close()
+    return tmp_path
+
+
+def seed_book(conn, title, authors, **kwargs):
+    """Insert a book and its linked metadata into metadata.db."""
+
+    author_sort = " & ".join(a.split(" ")[-1] for a in authors)
+    book_path = f"{authors[0]}/{title}"
+    cur = conn.execute(
+        "INSERT INTO books (title, author_sort, timestamp, pubdate, path, "
+        "has_cover, last_modified) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (
+            title,
+            author_sort,
+            kwargs.get("timestamp"),
+            kwargs.get("timestamp"),
+            book_path,
+            kwargs.get("has_cover", False),
+            kwargs.get("last_modified"),
+        ),
+    )
+    id = cur.lastrowid
+
+    def link(table, link_table, column, value, name_col="name"):
+        conn.execute(f"INSERT OR IGNORE INTO {table} ({name_col}) VALUES (?)", (value,))
+        (item_id,) = conn.execute(
+            f"SELECT id FROM {table} WHERE {name_col} = ?", (value,)
+        ).fetchone()
+        conn.execute(
+            f"INSERT INTO {link_table} (book, {column}) VALUES (?, ?)", (id, item_id)
+        )
+
+    for author in authors:
+        link("authors", "books_authors_link", "author", author)
+    for tag in kwargs.get("tags", []):
+        link("tags", "books_tags_link", "tag", tag)
+    for lang in kwargs.get("languages", []):
+        link("languages", "books_languages_link", "lang_code", lang, "lang_code")
+    if "series" in kwargs:
+        link("series", "books_series_link", "series", kwargs["series"])
+    if "publisher" in kwargs:
+        link("publishers", "books_publishers_link", "publisher", kwargs["publisher"])
+    if "rating" in kwargs:
+        link("ratings", "books_ratings_link", "rating", kwargs["rating"], "rating")
+    for k, v in kwargs.get("identifiers", {}).items():
+        conn.execute(
+            "INSERT INTO identifiers (book, type, val) VALUES (?, ?, ?)", (id, k, v)
+        )
+    if "comments" in kwargs:
+        conn.execute(
+            "INSERT INTO comments (book, text) VALUES (?, ?)", (id, kwargs["comments"])
+        )
+    for fmt, size in kwargs.get("formats", {}).items():
+        conn.execute(
+            "INSERT INTO data (book, format, uncompressed_size, name) "
+            "VALUES (?, ?, ?, ?)",
+            (id, fmt, size, f"{title} - {authors[0]}"),
+        )
+    return id
@@ -0,0 +1,212 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pytest
+
+from calibre_rest.calibre import CalibreWrapper
+from calibre_rest.content_server import ContentServerClient
+from calibre_rest.errors import ContentServerError
+
+# Metadata in the shape returned by calibre-server's /ajax/books endpoint
+BOOKS = {
+    1: {
+        "application_id": 1,
+        "title": "Children of Time",
+        "authors": ["Adrian Tchaikovsky"],
+        "author_sort": "Tchaikovsky, Adrian",
+        "tags": ["Science Fiction"],
+        "rating": 4.0,
+        "identifiers": {"isbn": "9781447273288"},
+        "format_metadata": {"epub": {"path": "/library/1.epub", "size": 1000}},
+        "cover": "/get/cover/1/lib",
+        "last_modified": "2023-05-16T06:19:44+00:00",
+    },
+    2: {
+        "application_id": 2,
+        "title": "Good Omens",
+        "authors": ["Terry Pratchett", "Neil Gaiman"],
+        "last_modified": "2023-05-17T06:19:44+00:00",
+    },
+    3: {
+        "application_id": 3,
+        "title": "Anathem",
+        "authors": ["Neal Stephenson"],
+        "last_modified": "2023-05-15T06:19:44+00:00",
+    },
+}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = parse_qs(url.query, keep_blank_values=True)
+        query = {k: v[0] for k, v in params.items()}
+        self.server.requests.append((url.path, query, self.client_address))
+
+        if url.path == "/ajax/library-info":
+            self.send_json({"library_map": {"lib": "Library"}})
+        elif url.path == "/ajax/search/lib":
+            self.send_json(search(query))
+        elif url.path == "/ajax/books/lib":
+            ids = [int(i) for i in query["ids"].split(",")]
+            self.send_json({str(i): BOOKS.get(i) for i in ids})
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+        if self.server.drop:
+            # close the keep-alive connection without telling the client
+            self.server.drop = False
+            self.close_connection = True
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def search(query):
+    ids = sorted(BOOKS)
+    if query["query"].startswith("id:"):
+        ids = [int(query["query"][3:])]
+
+    # sort by the first key only
+    key = query["sort"].split(",")[0]
+    reverse = query["sort_order"].split(",")[0] == "desc"
+    ids.sort(key=lambda i: BOOKS[i].get(key, i), reverse=reverse)
+
+    offset, num = int(query["offset"]), int(query["num"])
+    page = ids[offset : offset + num]  # noqa: E203
+    return {"book_ids": page, "total_num": len(ids)}
+
+
+@pytest.fixture()
+def server():
+    server = ThreadingHTTPServer(("localhost", 0), Handler)
+    server.requests = []
+    server.drop = False
+    thread = threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+
+
+@pytest.fixture()
+def client(server):
+    client = ContentServerClient(f"http://localhost:{server.server_port}/#lib")
+    yield client
+    client.close()
+
+
+def test_get_book(client):
+    book = client.get_book(1)
+
+    assert book.title == "Children of Time"
+    assert book.authors == "Adrian Tchaikovsky"
+    assert book.rating == 8
+    assert book.isbn == "9781447273288"
+    assert book.formats == ["/library/1.epub"]
+    assert book.size == 1000
+    assert book.cover == f"http://{client.netloc}/get/cover/1/lib"
+
+    assert client.get_book(1000) is None
+
+
+def test_get_books(client, server):
+    books = client.get_books(["-title"], None, 2, 1)
+    assert [b.id for b in books] == [1]
+
+    _, query, _ = server.requests[0]
+    assert query["sort"] == "title,id"
+    assert query["sort_order"] == "desc,desc"
+    assert query["offset"] == "1"
+    assert query["num"] == "1"
+
+
+def test_get_books_search(client):
+    assert [b.id for b in client.get_books(None, ["id:3"])] == [3]
+    assert client.count_books(["id:3"]) == 1
+    assert client.count_books() == 3
+
+
+def test_iter_books(client):
+    books = client.iter_books(["title"], batch_size=2)
+    assert [b.id for b in books] == [3, 1, 2]
+
+
+def test_keep_alive(client, server):
+    client.get_book(1)
+    client.get_book(2)
+
+    # both requests were made on the same connection
+    assert server.requests[0][2] == server.requests[1][2]
+
+
+def test_reconnect(client, server):
+    server.drop = True
+    client.get_book(1)
+    assert client.get_book(2).id == 2
+
+
+def test_server_error(client):
+    with pytest.raises(ContentServerError, match="404"):
+        client.request("ajax/foo")
+
+
+def test_check(client, server):
+    client.check()
+
+    client = ContentServerClient(f"http://localhost:{server.server_port}/#foo")
+    with pytest.raises(FileNotFoundError, match="Library foo not found"):
+        client.check()
+
+
+@pytest.mark.parametrize("url", ("localhost:8080", "ftp://localhost/"))
+def test_invalid_url(url):
+    with pytest.raises(ValueError, match="Invalid calibre-server URL"):
+        ContentServerClient(url)
+
+
+def test_wrapper_content_server(server):
+    wrapper = CalibreWrapper("foo", f"http://localhost:{server.server_port}/#lib")
+
+    assert [b.id for b in wrapper.get_books(["title"], None, 1, 2)] == [3, 1]
+    assert wrapper.count_books() == 3
+    assert wrapper.get_last_modified(1) == "2023-05-16T06:19:44+00:00"
+
+    version, modified = wrapper.library_version()
+    assert version.startswith("3-2-")
+    assert modified.isoformat() == "2023-05-17T06:19:44+00:00"
+
+
+def test_version_cached(server, monkeypatch):
+    client = ContentServerClient(f"http://localhost:{server.server_port}/#lib")
+    version = client.version()
+    requests = len(server.requests)
+
+    assert client.version() == version
+    assert len(server.requests) == requests
+
+    client.invalidate()
+    assert client.version() == version
+    assert len(server.requests) > requests
+
+    requests = len(server.requests)
+    monkeypatch.setattr(client, "VERSION_TTL", 0)
+    client.version()
+    assert len(server.requests) > requests
+
+
+def test_wrapper_content_server_engine():
+    with pytest.raises(ValueError, match="require a library on the filesystem"):
+        CalibreWrapper("foo", "http://localhost:8080/#lib", read_engine="sqlite")
@@ -0,0 +1,125 @@
+import sqlite3
+
+import pytest
+
+from calibre_rest.calibre import CalibreWrapper
+from calibre_rest.fts import FullTextIndex, match_expression
+from calibre_rest.sqlite import SQLiteReader
+
+
+@pytest.fixture()
+def fts(library, tmp_path):
+    fts = FullTextIndex(SQLiteReader(library), tmp_path / "fts.db")
+    fts.refresh(force=True)
+    return fts
+
+
+def write(library, sql, params=()):
+    conn = sqlite3.connect(library / "metadata.db")
+    conn.create_function("title_sort", 1, lambda x: x)
+    conn.execute(sql, params)
+    conn.commit()
+    conn.close()
+
+
+@pytest.mark.parametrize(
+    "q, expected",
+    (
+        pytest.param("anathem", [3], id="title"),
+        pytest.param("GAIMAN", [2], id="authors"),
+        pytest.param("science fiction", [1, 3], id="tags"),
+        pytest.param("tor", [1], id="publisher"),
+        pytest.param("spiders", [1], id="comments"),
+        pytest.param("children tchaik", [1], id="prefix"),
+        pytest.param('omens" OR "time', [], id="operators"),
+        pytest.param("unknown", [], id="none"),
+    ),
+)
+def test_search(fts, q, expected):
+    assert sorted(fts.search(q)) == expected
+
+
+def test_search_ranked(fts, library):
+    write(library, "UPDATE comments SET text = 'Anathem, anathem' WHERE book = 1")
+    fts.invalidate([1])
+
+    # a title match ranks above a match in the comments
+    assert fts.search("anathem") == [3, 1]
+
+
+def test_search_empty(fts):
+    with pytest.raises(ValueError, match="at least one word"):
+        fts.search(" -- ")
+
+
+def test_match_expression():
+    assert match_expression('foo "bar" baz') == '"foo" "bar" "baz"*'
+
+
+def test_side_car(fts, library):
+    conn = sqlite3.connect(library / "metadata.db")
+    tables = [row[0] for row in conn.execute("SELECT name FROM sqlite_master")]
+    assert "books_fts" not in tables
+
+    with pytest.raises(ValueError, match="metadata.db"):
+        FullTextIndex(fts.reader, library / "metadata.db")
+
+
+def test_refresh_incremental(fts, library, monkeypatch):
+    write(
+        library,
+        "UPDATE books SET title = 'Changed', last_modified = ? WHERE id = 2",
+        ("2030-01-01 00:00:00+00:00",),
+    )
+    write(library, "DELETE FROM books WHERE id = 3")
+
+    loaded = []
+    load_rows = fts.reader.load_rows
+    monkeypatch.setattr(
+        fts.reader,
+        "load_rows",
+        lambda conn, ids, fields: loaded.extend(ids) or load_rows(conn, ids, fields),
+    )
+    fts.refresh(force=True)
+
+    assert loaded == [2]
+    assert fts.search("changed") == [2]
+    assert fts.search("anathem") == []
+
+
+def test_refresh_persists(fts, library, monkeypatch):
+    # a new process picks up the side-car database and only re-reads the
+    # books at the last_modified watermark
+    fts = FullTextIndex(SQLiteReader(library), fts.path)
+    loaded = []
+    load_rows = fts.reader.load_rows
+    monkeypatch.setattr(
+        fts.reader,
+        "load_rows",
+        lambda conn, ids, fields: loaded.extend(ids) or load_rows(conn, ids, fields),
+    )
+
+    fts.refresh(force=True)
+    assert loaded == [3]
+    assert fts.search("anathem") == [3]
+
+
+def test_wrapper_search_text(library, tmp_path):
+    wrapper = CalibreWrapper(
+        "foo", library, read_engine="sqlite", fts_path=tmp_path / "fts.db"
+    )
+    wrapper.fts.refresh(force=True)
+
+    books, count = wrapper.search_text("science", None, 2, 1)
+    assert count == 2
+    assert len(books) == 1
+
+    books, count = wrapper.search_text("science", ["series:=anathem"])
+    assert [b.id for b in books] == [3]
+    assert count == 1
+
+
+def test_wrapper_search_text_disabled(library):
+    wrapper = CalibreWrapper("foo", library)
+    with pytest.raises(ValueError, match="not enabled"):
+        wrapper.search_text("foo")
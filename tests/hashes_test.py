@@ -0,0 +1,268 @@
+import hashlib
+import os
+import sqlite3
+
+import pytest
+
+from calibre_rest.calibre import CalibreWrapper
+from calibre_rest.errors import ExistingItemError
+from calibre_rest.hashes import HashIndex, hash_file
+from calibre_rest.models import Book
+from calibre_rest.sqlite import SQLiteReader
+
+FILES = {
+    "Adrian Tchaikovsky/Children of Time/Children of Time - Adrian Tchaikovsky.epub": b"spiders",
+    "Terry Pratchett/Good Omens/Good Omens - Terry Pratchett.epub": b"omens",
+    "Terry Pratchett/Good Omens/Good Omens - Terry Pratchett.pdf": b"spiders",
+}
+
+
+def sha256(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+@pytest.fixture()
+def files(library):
+    for relpath, data in FILES.items():
+        os.makedirs(library / os.path.dirname(relpath), exist_ok=True)
+        (library / relpath).write_bytes(data)
+    return library
+
+
+@pytest.fixture()
+def hashes(files, tmp_path):
+    hashes = HashIndex(SQLiteReader(files), tmp_path / "hashes.db")
+    hashes.build(workers=2)
+    return hashes
+
+
+def test_hash_file(tmp_path):
+    (tmp_path / "foo").write_bytes(b"foo")
+    assert hash_file(tmp_path / "foo") == sha256(b"foo")
+
+
+def test_build(hashes):
+    assert hashes.lookup(sha256(b"spiders")) == [1, 2]
+    assert hashes.lookup(sha256(b"omens")) == [2]
+    assert hashes.lookup(sha256(b"unknown")) == []
+
+
+def test_load(hashes, monkeypatch):
+    built = []
+    monkeypatch.setattr(hashes, "build", lambda workers=None: built.append(True))
+
+    # already built for this library
+    hashes.load()
+    assert built == []
+
+
+def test_lookup_changed_file(hashes, files):
+    relpath = "Terry Pratchett/Good Omens/Good Omens - Terry Pratchett.pdf"
+    (files / relpath).write_bytes(b"not spiders")
+
+    assert hashes.lookup(sha256(b"spiders")) == [1]
+    (count,) = hashes.connect().execute("SELECT count(*) FROM hashes").fetchone()
+    assert count == 2
+
+
+def test_record(hashes):
+    hashes.record(sha256(b"upload"), 1, ".EPUB")
+    # no format file of that extension
+    hashes.record(sha256(b"other"), 1, ".pdf")
+
+    assert hashes.lookup(sha256(b"upload")) == [1]
+    assert hashes.lookup(sha256(b"other")) == []
+
+
+def test_remove(hashes):
+    hashes.remove([2])
+    assert hashes.lookup(sha256(b"spiders")) == [1]
+    assert hashes.lookup(sha256(b"omens")) == []
+
+
+@pytest.fixture()
+def wrapper(files, tmp_path):
+    wrapper = CalibreWrapper("foo", files, hash_path=tmp_path / "hashes.db")
+    wrapper.hashes.load()
+    return wrapper
+
+
+def test_skip_duplicates(wrapper):
+    with pytest.raises(ExistingItemError, match="Book 2 already exists"):
+        wrapper.skip_duplicates([sha256(b"omens")])
+
+    ids = wrapper.skip_duplicates(
+        [sha256(b"omens"), sha256(b"spiders")], Book(), "overwrite"
+    )
+    # the same type as the ids of books added with calibredb
+    assert ids == ["2", "1"]
+
+
+@pytest.mark.parametrize(
+    "hashes, book, automerge",
+    (
+        pytest.param([sha256(b"omens"), sha256(b"new")], None, "ignore", id="new"),
+        pytest.param([sha256(b"omens")], None, "new_record", id="new_record"),
+        pytest.param([sha256(b"omens")], Book(title="Foo"), "ignore", id="title"),
+        pytest.param([sha256(b"omens")], Book(authors=["Foo"]), "ignore", id="authors"),
+        pytest.param([], None, "ignore", id="empty"),
+    ),
+)
+def test_skip_duplicates_add(wrapper, hashes, book, automerge):
+    assert wrapper.skip_duplicates(hashes, book, automerge) is None
+
+
+def test_skip_duplicates_disabled(files):
+    wrapper = CalibreWrapper("foo", files)
+    assert wrapper.skip_duplicates([sha256(b"omens")]) is None
+
+
+def test_add_multiple_records_hashes(wrapper, files, monkeypatch):
+    monkeypatch.setattr(wrapper, "_run", lambda cmd: ("Added book ids: 3", ""))
+    # the file calibredb would have copied into the library
+    relpath = "Neal Stephenson/Anathem/Anathem - Neal Stephenson.epub"
+    os.makedirs(files / os.path.dirname(relpath))
+    (files / relpath).write_bytes(b"anathem")
+    conn = sqlite3.connect(files / "metadata.db")
+    conn.execute(
+        "INSERT INTO data (book, format, uncompressed_size, name) "
+        "VALUES (3, 'EPUB', 7, 'Anathem - Neal Stephenson')"
+    )
+    conn.commit()
+    conn.close()
+
+    upload = files / "upload.epub"
+    upload.write_bytes(b"anathem")
+    ids = wrapper.add_multiple([str(upload)], None, "ignore", [sha256(b"anathem")])
+
+    assert ids == ["3"]
+    assert wrapper.hashes.lookup(sha256(b"anathem")) == [3]
+
+
+def test_remove_drops_hashes(wrapper, monkeypatch):
+    monkeypatch.setattr(wrapper, "_run", lambda cmd: ("", ""))
+    wrapper.remove([2])
+    assert wrapper.hashes.lookup(sha256(b"omens")) == []
+
+
+def add_format(files, id, relpath, data):
+    """Store a format file as calibredb would have after adding it."""
+    os.makedirs(files / os.path.dirname(relpath), exist_ok=True)
+    (files / relpath).write_bytes(data)
+    name, ext = os.path.splitext(os.path.basename(relpath))
+    conn = sqlite3.connect(files / "metadata.db")
+    conn.execute(
+        "DELETE FROM data WHERE book = ? AND format = ?", (id, ext[1:].upper())
+    )
+    conn.execute(
+        "INSERT INTO data (book, format, uncompressed_size, name) "
+        "VALUES (?, ?, ?, ?)",
+        (id, ext[1:].upper(), len(data), name),
+    )
+    conn.commit()
+    conn.close()
+
+
+@pytest.fixture()
+def sqlite_wrapper(files, tmp_path):
+    wrapper = CalibreWrapper(
+        "foo", files, read_engine="sqlite", hash_path=tmp_path / "hashes.db"
+    )
+    wrapper.hashes.load()
+    return wrapper
+
+
+def test_add_batch_matches_files(sqlite_wrapper, files, monkeypatch):
+    add_format(
+        files, 3, "Neal Stephenson/Anathem/Anathem - Neal Stephenson.epub", b"anathem"
+    )
+    uploads = []
+    for name, data in (
+        ("a.epub", b"anathem"),
+        ("dup.epub", b"dup"),
+        ("b.epub", b"omens"),
+    ):
+        (files / name).write_bytes(data)
+        uploads.append(str(files / name))
+
+    # calibredb prints the ids of added books in no particular order
+    out = f"Added book ids: 2, 3\n  Dup\n    {uploads[1]}\n"
+    stderr = "The following books were not added as they already exist in the database"
+    monkeypatch.setattr(sqlite_wrapper, "_run", lambda cmd: (out, stderr))
+    # the digest of b.epub is unknown and computed to match it
+    hashes = [sha256(b"anathem"), sha256(b"dup"), None]
+    added, ignored = sqlite_wrapper.add_batch(uploads, hashes=hashes)
+
+    assert added == {uploads[0]: "3", uploads[2]: "2"}
+    assert ignored == [uploads[1]]
+    assert sqlite_wrapper.hashes.lookup(sha256(b"anathem")) == [3]
+
+
+def test_add_batch_identical_files(sqlite_wrapper, files, monkeypatch):
+    # the same file added twice with automerge=new_record
+    uploads = []
+    for name in ("a.epub", "b.epub"):
+        (files / name).write_bytes(b"omens")
+        uploads.append(str(files / name))
+    add_format(
+        files, 3, "Neal Stephenson/Anathem/Anathem - Neal Stephenson.epub", b"omens"
+    )
+
+    monkeypatch.setattr(
+        sqlite_wrapper, "_run", lambda cmd: ("Added book ids: 3, 2", "")
+    )
+    added, ignored = sqlite_wrapper.add_batch(uploads, automerge="new_record")
+
+    assert sorted(added.values()) == ["2", "3"]
+    assert ignored == []
+
+
+def test_add_batch_unmatched(sqlite_wrapper, files, monkeypatch):
+    uploads = []
+    for name in ("a.epub", "b.epub"):
+        (files / name).write_bytes(name.encode())
+        uploads.append(str(files / name))
+
+    monkeypatch.setattr(
+        sqlite_wrapper, "_run", lambda cmd: ("Added book ids: 3, 2", "")
+    )
+    added, _ = sqlite_wrapper.add_batch(uploads)
+
+    # neither file was stored as is
+    assert added == {}
+
+
+def test_add_multiple_records_matched_hashes(sqlite_wrapper, files, monkeypatch):
+    add_format(
+        files, 3, "Neal Stephenson/Anathem/Anathem - Neal Stephenson.epub", b"anathem"
+    )
+    uploads = []
+    for name, data in (("a.epub", b"anathem"), ("b.epub", b"changed on import")):
+        (files / name).write_bytes(data)
+        uploads.append(str(files / name))
+
+    monkeypatch.setattr(
+        sqlite_wrapper, "_run", lambda cmd: ("Added book ids: 3, 2", "")
+    )
+    hashes = [sha256(b"anathem"), sha256(b"changed on import")]
+    assert sqlite_wrapper.add_multiple(uploads, None, "ignore", hashes) == ["3", "2"]
+
+    assert sqlite_wrapper.hashes.lookup(sha256(b"anathem")) == [3]
+    # calibre stored other bytes for b.epub
+    assert sqlite_wrapper.hashes.lookup(sha256(b"changed on import")) == []
+
+
+def test_add_multiple_skips_unmatched_hashes(sqlite_wrapper, files, monkeypatch):
+    uploads = []
+    for name in ("a.epub", "b.epub"):
+        (files / name).write_bytes(name.encode())
+        uploads.append(str(files / name))
+
+    monkeypatch.setattr(
+        sqlite_wrapper, "_run", lambda cmd: ("Added book ids: 3, 2", "")
+    )
+    hashes = [sha256(b"a.epub"), sha256(b"b.epub")]
+    sqlite_wrapper.add_multiple(uploads, None, "ignore", hashes)
+
+    assert sqlite_wrapper.hashes.lookup(sha256(b"a.epub")) == []
+    assert sqlite_wrapper.hashes.lookup(sha256(b"b.epub")) == []
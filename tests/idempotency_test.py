@@ -0,0 +1,157 @@
+import hashlib
+import io
+import time
+
+import pytest
+from flask import Flask, jsonify
+
+from calibre_rest.idempotency import IdempotencyStore, idempotent
+from calibre_rest.uploads import SpoolRequest
+
+
+@pytest.fixture()
+def store(tmp_path):
+    return IdempotencyStore(tmp_path / "idempotency.db")
+
+
+def test_claim(store):
+    assert store.claim("foo", "POST /books") is None
+    # claimed until the request completes
+    assert store.claim("foo", "POST /books") == {
+        "fingerprint": "POST /books",
+        "status": None,
+        "headers": None,
+        "body": None,
+    }
+
+    store.complete("foo", 201, {"Content-Type": "application/json"}, '{"id": [1]}')
+    assert store.claim("foo", "POST /books") == {
+        "fingerprint": "POST /books",
+        "status": 201,
+        "headers": {"Content-Type": "application/json"},
+        "body": '{"id": [1]}',
+    }
+
+
+def test_release(store):
+    store.claim("foo", "POST /books")
+    store.release("foo")
+    assert store.claim("foo", "POST /books") is None
+
+
+def test_expire(store, monkeypatch):
+    store.claim("pending", "POST /books")
+    store.claim("complete", "POST /books")
+    store.complete("complete", 201, {}, "")
+
+    monkeypatch.setattr(time, "time", lambda: 1e12)
+    assert store.claim("pending", "POST /books") is None
+    assert store.claim("complete", "POST /books") is None
+
+
+@pytest.fixture()
+def app(store):
+    app = Flask(__name__)
+    app.request_class = SpoolRequest
+    app.config["IDEMPOTENCY_STORE"] = store
+    app.config["calls"] = 0
+
+    @app.route("/books", methods=["POST"])
+    @idempotent
+    def add():
+        app.config["calls"] += 1
+        if app.config.get("fail"):
+            return jsonify(error="failed"), 500
+        return jsonify(id=[app.config["calls"]]), 201, {"Location": "/books/1"}
+
+    @app.route("/books/empty", methods=["POST"])
+    @idempotent
+    def add_empty():
+        return jsonify(id=[0]), 201
+
+    return app
+
+
+def test_idempotent(app):
+    client = app.test_client()
+    headers = {"Idempotency-Key": "foo"}
+
+    first = client.post("/books", headers=headers)
+    second = client.post("/books", headers=headers)
+
+    assert app.config["calls"] == 1
+    assert second.status_code == 201
+    assert second.json == first.json == {"id": [1]}
+    assert second.headers["Location"] == "/books/1"
+    assert second.headers["Idempotent-Replayed"] == "true"
+    assert "Idempotent-Replayed" not in first.headers
+
+    # requests without a key always run
+    assert client.post("/books").json == {"id": [2]}
+
+
+def test_idempotent_failed(app):
+    client = app.test_client()
+    app.config["fail"] = True
+    assert client.post("/books", headers={"Idempotency-Key": "foo"}).status_code == 500
+
+    app.config["fail"] = False
+    res = client.post("/books", headers={"Idempotency-Key": "foo"})
+    assert res.status_code == 201
+    assert app.config["calls"] == 2
+
+
+def test_idempotent_running(app, store):
+    store.claim("foo", f"POST /books {hashlib.sha256(b'').hexdigest()}")
+    res = app.test_client().post("/books", headers={"Idempotency-Key": "foo"})
+
+    assert res.status_code == 409
+    assert app.config["calls"] == 0
+
+
+def test_idempotent_other_endpoint(app):
+    client = app.test_client()
+    client.post("/books", headers={"Idempotency-Key": "foo"})
+    res = client.post("/books/empty", headers={"Idempotency-Key": "foo"})
+
+    assert res.status_code == 422
+
+
+@pytest.mark.parametrize(
+    "first, second, status",
+    (
+        pytest.param({"json": {"title": "Foo"}}, {"json": {"title": "Foo"}}, 201),
+        pytest.param({"json": {"title": "Foo"}}, {"json": {"title": "Bar"}}, 422),
+        pytest.param({"data": {"data": "{}"}}, {"data": {"data": '{"a": 1}'}}, 422),
+    ),
+)
+def test_idempotent_body(app, first, second, status):
+    client = app.test_client()
+    headers = {"Idempotency-Key": "foo"}
+    client.post("/books", headers=headers, **first)
+    res = client.post("/books", headers=headers, **second)
+
+    assert res.status_code == status
+    assert app.config["calls"] == 1
+
+
+def test_idempotent_uploads(app):
+    client = app.test_client()
+    headers = {"Idempotency-Key": "foo"}
+
+    def upload(data):
+        files = {"file": (io.BytesIO(data), "foo.epub"), "data": "{}"}
+        return client.post("/books", headers=headers, data=files)
+
+    upload(b"foo")
+    assert upload(b"foo").headers["Idempotent-Replayed"] == "true"
+
+    res = upload(b"bar")
+    assert res.status_code == 422
+    assert "another request body" in res.get_data(as_text=True)
+    assert app.config["calls"] == 1
+
+
+def test_idempotent_invalid_key(app):
+    res = app.test_client().post("/books", headers={"Idempotency-Key": "a" * 256})
+    assert res.status_code == 400
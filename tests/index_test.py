@@ -0,0 +1,220 @@
+import sqlite3
+
+import pytest
+
+from calibre_rest.calibre import CalibreWrapper
+from calibre_rest.index import BookIndex
+from calibre_rest.sqlite import SQLiteReader
+
+
+@pytest.fixture()
+def index(library):
+    index = BookIndex(SQLiteReader(library))
+    index.load()
+    return index
+
+
+def write(library, sql, params=()):
+    conn = sqlite3.connect(library / "metadata.db")
+    conn.create_function("title_sort", 1, lambda x: x)
+    conn.execute(sql, params)
+    conn.commit()
+    conn.close()
+
+
+def test_load(index):
+    assert len(index.records) == 3
+    assert index.records[1].tags == ("Science Fiction", "Aliens")
+
+
+def test_get_book_matches_reader(index, library):
+    reader = SQLiteReader(library)
+    for id in (1, 2, 3):
+        assert index.get_book(id) == reader.get_book(id)
+
+
+def test_get_book_not_exist(index):
+    assert index.get_book(1000) is None
+
+
+@pytest.mark.parametrize(
+    "sort",
+    (
+        pytest.param(None, id="default"),
+        pytest.param(["title"], id="title"),
+        pytest.param(["-title"], id="descending"),
+        pytest.param(["tags", "title"], id="multiple"),
+        pytest.param(["series", "-id"], id="series"),
+        pytest.param(["-timestamp"], id="presorted descending"),
+        pytest.param(["languages", "-title"], id="mixed directions"),
+        pytest.param(["-authors", "pubdate"], id="mixed presorted"),
+    ),
+)
+def test_get_books_sort_matches_reader(index, library, sort):
+    reader = SQLiteReader(library)
+    assert [b.id for b in index.get_books(sort)] == [
+        b.id for b in reader.get_books(sort)
+    ]
+
+
+@pytest.mark.parametrize(
+    "search, expected",
+    (
+        pytest.param(["tags:science"], [1, 3], id="contains"),
+        pytest.param(["tags:=science"], [], id="equals"),
+        pytest.param(['tags:="science fiction"'], [1, 3], id="quoted"),
+        pytest.param(["authors:gaiman"], [2], id="authors"),
+        pytest.param(["tags:science", "title:anathem"], [3], id="and"),
+        pytest.param(["id:2"], [2], id="id"),
+        pytest.param(["title:~^a"], [3], id="regex"),
+        pytest.param(["format:pdf"], [2], id="format"),
+        pytest.param(["tags:fantasy or series:anathem"], [2, 3], id="or"),
+        pytest.param(["not tags:science"], [2], id="not"),
+        pytest.param(["rating:>3"], [1], id="rating"),
+    ),
+)
+def test_get_books_filter(index, search, expected):
+    assert [b.id for b in index.get_books(None, search)] == expected
+
+
+@pytest.mark.parametrize(
+    "search",
+    (
+        pytest.param(["title:foo or bar"], id="boolean"),
+        pytest.param(["foo"], id="bare"),
+        pytest.param(['"foo"'], id="quoted"),
+        pytest.param(["isbn:123"], id="field"),
+        pytest.param(["title:~("], id="invalid regex"),
+    ),
+)
+def test_unsupported_search(index, search):
+    assert not index.supports(search)
+    with pytest.raises(ValueError, match="not supported by the index"):
+        index.get_books(None, search)
+
+
+@pytest.mark.parametrize("sort", (["title"], ["-title"], ["authors"], None))
+def test_get_books_presorted_pages(index, sort):
+    books = [b.id for b in index.get_books(sort)]
+    pages = [b.id for start in (1, 3) for b in index.get_books(sort, None, start, 2)]
+    assert pages == books
+
+
+@pytest.mark.parametrize("sort", (["id"], ["-id"]))
+def test_get_books_past_end(index, sort):
+    assert index.get_books(sort, None, 4, 2) == []
+    assert index.get_books(sort, None, 5, 2) == []
+    assert index.get_books(sort, None, 5) == []
+
+
+def test_sort_collation(index, library):
+    write(library, "UPDATE books SET sort = 'Ébène' WHERE id = 2")
+    index.invalidate([2])
+
+    assert [b.id for b in index.get_books(["title"])] == [3, 1, 2]
+    write(library, "UPDATE books SET sort = 'Ábaco' WHERE id = 2")
+    index.invalidate([2])
+
+    # presorted orders are updated in place of a full rebuild
+    assert [b.id for b in index.get_books(["title"])] == [2, 3, 1]
+    assert [b.id for b in index.get_books(["title"], ["id:<3"])] == [2, 1]
+
+
+@pytest.mark.parametrize(
+    "sort, search",
+    (
+        (None, None),
+        (["-title"], None),
+        (["tags", "-id"], None),
+        (["title"], ["tags:science"]),
+    ),
+)
+def test_iter_books(index, sort, search):
+    assert list(index.iter_books(sort, search)) == index.get_books(sort, search)
+
+
+def test_count_and_page(index):
+    assert index.count_books() == 3
+    assert index.count_books(["tags:science"]) == 2
+    assert [b.id for b in index.get_books(["title"], None, 2, 1)] == [1]
+
+
+def test_invalidate(index, library):
+    write(library, "UPDATE books SET title = 'Changed' WHERE id = 1")
+    index.invalidate([1])
+    assert index.get_book(1).title == "Changed"
+
+
+def test_refresh_polls_changes(index, library):
+    write(
+        library,
+        "UPDATE books SET title = 'Changed', last_modified = ? WHERE id = 2",
+        ("2030-01-01 00:00:00+00:00",),
+    )
+    write(library, "DELETE FROM books WHERE id = 3")
+
+    # the refresh interval has not elapsed yet
+    assert index.get_book(3) is not None
+
+    index.checked = 0.0
+    assert index.get_book(2).title == "Changed"
+    assert index.get_book(3) is None
+    assert index.count_books() == 2
+
+
+def test_refresh_skips_unchanged(index, monkeypatch):
+    index.checked = 0.0
+    monkeypatch.setattr(
+        index.reader, "load_rows", lambda conn, ids: pytest.fail("reloaded")
+    )
+    index.refresh()
+
+
+def test_wrapper_index_engine(library, monkeypatch):
+    wrapper = CalibreWrapper("foo", library, read_engine="index")
+    wrapper.index.load()
+
+    assert wrapper.get_book(3).title == "Anathem"
+    assert wrapper.count_books(["tags:science"]) == 2
+    assert [b.id for b in wrapper.get_books(["title"], ["tags:science"])] == [3, 1]
+
+    monkeypatch.setattr(wrapper, "_run", lambda cmd: ("", ""))
+    write(library, "DELETE FROM books WHERE id = 3")
+    wrapper.remove([3])
+    assert wrapper.get_book(3) is None
+
+
+def test_wrapper_library_version(library, monkeypatch):
+    wrapper = CalibreWrapper("foo", library, read_engine="index")
+    wrapper.index.load()
+    version, _ = wrapper.library_version()
+
+    # metadata.db is not checked again within REFRESH_INTERVAL
+    write(library, "UPDATE books SET title = 'Changed' WHERE id = 1")
+    assert wrapper.library_version()[0] == version
+    assert wrapper.get_book(1).title != "Changed"
+
+    monkeypatch.setattr(wrapper.index, "REFRESH_INTERVAL", 0)
+    write(
+        library,
+        "UPDATE books SET title = 'Changed', last_modified = ? WHERE id = 2",
+        ("2030-01-01 00:00:00+00:00",),
+    )
+
+    # the version is that of the refreshed index, which already has the change
+    assert wrapper.library_version()[0] != version
+    assert wrapper.get_last_modified(2) == "2030-01-01T00:00:00+00:00"
+    assert wrapper.get_book(2).title == "Changed"
+
+
+def test_wrapper_cursor_collation(library):
+    write(library, "UPDATE books SET sort = 'Ábaco' WHERE id = 2")
+    wrapper = CalibreWrapper("foo", library, read_engine="index")
+    wrapper.index.load()
+
+    # cursor pages are read with SQL, offset pages from the index
+    pages, cursor = [], ""
+    for _ in range(3):
+        books, _, cursor = wrapper.get_books_by_cursor(["title"], None, cursor, 1)
+        pages += [b.id for b in books]
+    assert pages == [b.id for b in wrapper.get_books(["title"])] == [2, 3, 1]
@@ -0,0 +1,142 @@
+import os
+
+import pytest
+from conftest import TEST_CALIBREDB_PATH, TEST_LIBRARY_PATH, calibredb_clone
+
+from calibre_rest.backend import BACKENDS, Backend, create_backend
+from calibre_rest.models import Book
+from config import TestConfig
+
+# Conformance tests run against every backend. Each backend must return the
+# same results for the same operations.
+
+
+@pytest.fixture(scope="module", params=list(BACKENDS))
+def backend(request, tmp_path_factory):
+    library = tmp_path_factory.mktemp(f"{request.param}_library")
+    calibredb_clone(TEST_LIBRARY_PATH, library)
+
+    config = {
+        **TestConfig().config(),
+        "calibredb": TEST_CALIBREDB_PATH,
+        "library": str(library),
+        "backend": request.param,
+    }
+    backend = create_backend(config)
+    backend.check()
+    yield backend
+
+    if backend.worker is not None:
+        backend.worker.close()
+
+
+@pytest.fixture()
+def seed(backend):
+    """Add books to the library and remove them on cleanup."""
+    ids = []
+
+    def _seed(book: Book):
+        ids.extend(backend.add_one_empty(book))
+        return ids[-1]
+
+    yield _seed
+    backend.remove(ids)
+
+
+def test_protocol(backend):
+    assert isinstance(backend, Backend)
+    assert backend.version() is not None
+
+
+def test_add_get(backend, seed):
+    id = seed(Book(title="Foo", authors=["John Doe"], tags=["a", "b"]))
+    book = backend.get_book(id)
+
+    assert book.id == id
+    assert book.title == "Foo"
+    assert book.authors == "John Doe"
+    assert sorted(book.tags) == ["a", "b"]
+
+
+def test_add_file(backend):
+    ids = backend.add_one(os.path.join(TEST_LIBRARY_PATH, "test.txt"))
+    book = backend.get_book(ids[0])
+
+    assert len(book.formats) == 1
+    assert book.formats[0].endswith(".txt")
+    backend.remove(ids)
+
+
+def test_get_books(backend, seed):
+    for title in ("Beta", "Alpha", "Gamma"):
+        seed(Book(title=title, tags=["conformance"]))
+
+    search = ["tags:=conformance"]
+    assert backend.count_books(search) == 3
+    assert [b.title for b in backend.get_books(["title"], search)] == [
+        "Alpha",
+        "Beta",
+        "Gamma",
+    ]
+    assert [b.title for b in backend.get_books(["-title"], search, 2, 1)] == ["Beta"]
+    assert [b.title for b in backend.iter_books(["title"], search)] == [
+        "Alpha",
+        "Beta",
+        "Gamma",
+    ]
+
+
+def test_get_book_fields(backend, seed):
+    id = seed(Book(title="Foo", tags=["a"]))
+    book = backend.get_book(id, ["id", "title"])
+
+    assert book.id == id
+    assert book.title == "Foo"
+
+
+def test_set_metadata(backend, seed):
+    id = seed(Book(title="Foo"))
+
+    assert backend.set_metadata(id, Book(title="Bar", tags=["c"])) == id
+    book = backend.get_book(id)
+    assert book.title == "Bar"
+    assert book.tags == ["c"]
+
+
+def test_set_metadata_not_exist(backend):
+    assert backend.set_metadata(1000, Book(title="Bar")) == -1
+
+
+def test_update_book(backend, seed):
+    id = seed(Book(title="Foo"))
+
+    book = backend.update_book(id, Book(title="Bar", tags=["c"]))
+    assert book.id == id
+    assert book.title == "Bar"
+    assert book.tags == ["c"]
+    assert backend.update_book(1000, Book(title="Bar")) is None
+
+
+def test_show_metadata(backend, seed):
+    id = seed(Book(title="Foo"))
+    assert "<dc:title>Foo</dc:title>" in backend.show_metadata(id)
+
+
+def test_export(backend, tmp_path):
+    ids = backend.add_one(os.path.join(TEST_LIBRARY_PATH, "test.txt"))
+    backend.export(ids, str(tmp_path))
+
+    assert len(os.listdir(tmp_path)) == 1
+    backend.remove(ids)
+
+
+def test_export_not_exist(backend, tmp_path):
+    with pytest.raises(KeyError):
+        backend.export([1000], str(tmp_path))
+
+
+def test_remove(backend):
+    ids = backend.add_one_empty(Book(title="Foo"))
+    backend.remove(ids)
+
+    assert backend.get_book(ids[0]) is None
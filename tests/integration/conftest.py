@@ -31,6 +31,7 @@ class MockServer:
 
     def __init__(self, library):
         self.thread = None
+        self.library = library
 
         # urlsplit only recognizes netloc if prepended with "//"
         self.bind_addr = TEST_BIND_ADDR
@@ -0,0 +1,113 @@
+import os
+import shutil
+import time
+
+import pytest
+from conftest import TEST_CALIBREDB_PATH, TEST_LIBRARY_PATH, calibredb_clone
+
+from calibre_rest.calibre import CalibreWrapper
+from calibre_rest.jobs import JobQueue
+
+
+@pytest.fixture()
+def queue(tmp_path):
+    library = tmp_path / "library"
+    calibredb_clone(TEST_LIBRARY_PATH, library)
+    calibredb = CalibreWrapper(TEST_CALIBREDB_PATH, str(library))
+    return JobQueue(str(tmp_path / "jobs.db"), calibredb)
+
+
+def wait(queue, job_id, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = queue.get(job_id)
+        if job["status"] in ("succeeded", "failed"):
+            return job
+        time.sleep(0.1)
+    raise TimeoutError(f"job {job_id} did not finish")
+
+
+def test_add_update_export_delete(queue):
+    job_id = queue.new_id()
+    os.makedirs(queue.job_dir(job_id))
+    upload = shutil.copy(
+        os.path.join(TEST_LIBRARY_PATH, "test.txt"), queue.job_dir(job_id)
+    )
+    params = {"paths": [upload], "book": {"title": "Foo"}, "automerge": "ignore"}
+
+    job = wait(queue, queue.submit("add", params, job_id)["id"])
+    assert job["status"] == "succeeded"
+    (id,) = job["result"]["ids"]
+    assert queue.calibredb.get_book(id).title == "Foo"
+
+    job = wait(
+        queue, queue.submit("update", {"id": id, "book": {"title": "Bar"}})["id"]
+    )
+    assert job["result"] == {"ids": [id]}
+    assert queue.calibredb.get_book(id).title == "Bar"
+
+    job = wait(queue, queue.submit("export", {"ids": [id]})["id"])
+    assert len(job["result"]["files"]) == 1
+
+    job = wait(queue, queue.submit("delete", {"ids": [id]})["id"])
+    assert job["status"] == "succeeded"
+    assert queue.calibredb.get_book(id) is None
+
+
+def test_coalesce_adds(queue, monkeypatch):
+    monkeypatch.setattr(queue, "start", lambda: None)
+    monkeypatch.setattr(queue, "BATCH_WINDOW", 0)
+
+    job_ids = []
+    for name in ("first.txt", "second.txt"):
+        job_id = queue.new_id()
+        os.makedirs(queue.job_dir(job_id))
+        upload = os.path.join(queue.job_dir(job_id), name)
+        with open(upload, "w") as f:
+            f.write(name)
+        params = {"paths": [upload], "book": {}, "automerge": "new_record"}
+        job_ids.append(queue.submit("add", params, job_id)["id"])
+
+    # both adds run in one calibredb add
+    assert queue.run_next()
+    assert not queue.run_next()
+
+    for job_id, title in zip(job_ids, ("first", "second")):
+        (id,) = queue.get(job_id)["result"]["ids"]
+        assert queue.calibredb.get_book(id).title == title
+
+
+def test_coalesce_adds_duplicate(queue, monkeypatch):
+    monkeypatch.setattr(queue, "start", lambda: None)
+    monkeypatch.setattr(queue, "BATCH_WINDOW", 0)
+
+    # the second third.txt duplicates the first one in the same calibredb add
+    job_ids = []
+    for names in (
+        ["first.txt", "second.txt"],
+        ["third.txt"],
+        ["third.txt", "fourth.txt"],
+    ):
+        job_id = queue.new_id()
+        os.makedirs(queue.job_dir(job_id))
+        paths = []
+        for name in names:
+            paths.append(os.path.join(queue.job_dir(job_id), name))
+            with open(paths[-1], "w") as f:
+                f.write(f"{job_id} {name}")
+        params = {"paths": paths, "book": {}, "automerge": "ignore"}
+        job_ids.append(queue.submit("add", params, job_id)["id"])
+
+    assert queue.run_next()
+    assert not queue.run_next()
+
+    first, second, third = (queue.get(job_id) for job_id in job_ids)
+    titles = [queue.calibredb.get_book(id).title for id in first["result"]["ids"]]
+    assert titles == ["first", "second"]
+    (id,) = second["result"]["ids"]
+    assert queue.calibredb.get_book(id).title == "third"
+
+    assert third["status"] == "failed"
+    assert third["error"].startswith("Book third.txt already exists")
+    (id,) = third["result"]["ids"]
+    assert queue.calibredb.get_book(id).title == "fourth"
@@ -0,0 +1,40 @@
+from concurrent.futures import ProcessPoolExecutor
+
+from conftest import TEST_CALIBREDB_PATH, TEST_LIBRARY_PATH, calibredb_clone
+
+from calibre_rest.calibre import CalibreWrapper
+from calibre_rest.errors import CalibreConcurrencyError
+from calibre_rest.models import Book
+
+
+def add_remove(library: str, lock_path: str, count: int) -> int:
+    """Add and remove count books from one process and return the number of
+    CalibreConcurrencyErrors."""
+    wrapper = CalibreWrapper(TEST_CALIBREDB_PATH, library, lock_path=lock_path)
+    errors = 0
+    for i in range(count):
+        try:
+            wrapper.remove(wrapper.add_one_empty(Book(title=f"Stress {i}")))
+            wrapper.get_books(search=["title:Stress"])
+        except CalibreConcurrencyError:
+            errors += 1
+    return errors
+
+
+def test_stress_writes(tmp_path):
+    # calibredb refuses to run next to another calibredb on the same library.
+    # The lock file serializes them across processes.
+    library = tmp_path / "library"
+    calibredb_clone(TEST_LIBRARY_PATH, library)
+    lock_path = str(library / ".calibre-rest.lock")
+
+    processes, count = 4, 5
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [
+            executor.submit(add_remove, str(library), lock_path, count)
+            for _ in range(processes)
+        ]
+        assert sum(f.result() for f in futures) == 0
+
+    wrapper = CalibreWrapper(TEST_CALIBREDB_PATH, str(library))
+    assert wrapper.get_books(search=["title:Stress"]) == []
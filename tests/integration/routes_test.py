@@ -4,6 +4,7 @@ import zipfile
 from enum import IntEnum
 from http import HTTPStatus
 from io import BytesIO
+from urllib.parse import parse_qs, urlsplit
 
 import pytest
 import requests
@@ -81,6 +82,119 @@ def test_get_book(url, seed_book):
     )
 
 
+def test_get_book_fields(url, seed_book):
+    resp = requests.get(f"{url}/books/{seed_book}?fields=id,title")
+    assert resp.status_code == HTTPStatus.OK
+    assert resp.json()["books"] == {"id": int(seed_book), "title": "test"}
+
+    # each fieldset has its own ETag
+    etag = resp.headers["ETag"]
+    resp = requests.get(f"{url}/books/{seed_book}", headers={"If-None-Match": etag})
+    assert resp.status_code == HTTPStatus.OK
+
+
+def test_get_book_invalid_fields(url, seed_book):
+    resp = requests.get(f"{url}/books/{seed_book}?fields=title,foo")
+    assert resp.status_code == HTTPStatus.BAD_REQUEST
+    assert "Invalid fields: foo" in resp.json()["error"]
+
+
+def test_get_book_not_modified(url, seed_book):
+    resp = requests.get(f"{url}/books/{seed_book}")
+    assert resp.status_code == HTTPStatus.OK
+    etag = resp.headers["ETag"]
+    last_modified = resp.headers["Last-Modified"]
+
+    resp = requests.get(f"{url}/books/{seed_book}", headers={"If-None-Match": etag})
+    assert resp.status_code == HTTPStatus.NOT_MODIFIED
+    assert resp.headers["ETag"] == etag
+    assert resp.content == bytes()
+
+    resp = requests.get(
+        f"{url}/books/{seed_book}", headers={"If-Modified-Since": last_modified}
+    )
+    assert resp.status_code == HTTPStatus.NOT_MODIFIED
+
+    resp = requests.put(f"{url}/books/{seed_book}", json={"title": "changed"})
+    assert resp.status_code == HTTPStatus.OK
+
+    resp = requests.get(f"{url}/books/{seed_book}", headers={"If-None-Match": etag})
+    assert resp.status_code == HTTPStatus.OK
+    assert resp.headers["ETag"] != etag
+
+
+def test_get_books_not_modified(url, seed_books, test_txt):
+    resp = requests.get(f"{url}/books?limit=2")
+    assert resp.status_code == HTTPStatus.OK
+    etag = resp.headers["ETag"]
+
+    resp = requests.get(f"{url}/books?limit=2", headers={"If-None-Match": etag})
+    assert resp.status_code == HTTPStatus.NOT_MODIFIED
+
+    # the ETag depends on the query
+    resp = requests.get(f"{url}/books?limit=3", headers={"If-None-Match": etag})
+    assert resp.status_code == HTTPStatus.OK
+
+    # and on the library
+    id = post(f"{url}/books", HTTPStatus.CREATED, files=test_txt("test.txt"))
+    resp = requests.get(f"{url}/books?limit=2", headers={"If-None-Match": etag})
+    assert resp.status_code == HTTPStatus.OK
+    delete(url, id[0])
+
+
+def test_patch_books(url, seed_books):
+    ids = [int(id) for id in seed_books]
+    payload = {
+        "books": [{"id": id, "fields": {"tags": [f"tag{id}"]}} for id in ids]
+        + [{"id": 1000, "fields": {"title": "foo"}}]
+    }
+    resp = requests.patch(f"{url}/books", json=payload, stream=True)
+    assert resp.status_code == HTTPStatus.OK
+    assert resp.headers["Content-Type"] == "application/x-ndjson"
+
+    results = [json.loads(line) for line in resp.iter_lines()]
+    assert results == [{"id": id, "status": "updated"} for id in ids] + [
+        {"id": 1000, "status": "not_found"}
+    ]
+    for id in ids:
+        assert requests.get(f"{url}/books/{id}").json()["books"]["tags"] == [f"tag{id}"]
+
+
+def test_patch_books_search(url, seed_books):
+    payload = {"search": "title:foo", "fields": {"publisher": "bar"}}
+    resp = requests.patch(f"{url}/books", json=payload)
+    assert resp.status_code == HTTPStatus.OK
+
+    results = [json.loads(line) for line in resp.text.splitlines()]
+    assert sorted(r["id"] for r in results) == sorted(int(id) for id in seed_books)
+    assert all(r["status"] == "updated" for r in results)
+
+
+@pytest.mark.parametrize(
+    "payload, status",
+    (
+        pytest.param({}, HTTPStatus.BAD_REQUEST, id="empty"),
+        pytest.param({"books": [{"fields": {}}]}, HTTPStatus.BAD_REQUEST, id="no id"),
+        pytest.param(
+            {"books": [{"id": 1, "fields": {}}]}, HTTPStatus.BAD_REQUEST, id="no fields"
+        ),
+        pytest.param(
+            {"books": [{"id": 1, "fields": {"title": 1}}]},
+            HTTPStatus.UNPROCESSABLE_ENTITY,
+            id="invalid field",
+        ),
+        pytest.param(
+            {"search": "title:foo", "fields": {"automerge": "ignore"}},
+            HTTPStatus.UNPROCESSABLE_ENTITY,
+            id="automerge",
+        ),
+    ),
+)
+def test_patch_books_invalid(url, payload, status):
+    resp = requests.patch(f"{url}/books", json=payload)
+    assert resp.status_code == status
+
+
 def test_delete_invalid_id(url):
     check_error(
         "DELETE",
@@ -104,11 +218,34 @@ def test_delete(url, seed_book):
 def test_delete_multiple(url, seed_books):
     resp = requests.delete(f"{url}/books", params={"id": ",".join(seed_books)})
     assert resp.status_code == HTTPStatus.OK
+    assert resp.json()["books"] == [
+        {"id": int(id), "status": "deleted"} for id in seed_books
+    ]
+
+    get_resp = requests.get(f"{url}/books")
+    assert get_resp.status_code == HTTPStatus.NO_CONTENT
+
+
+def test_delete_multiple_json(url, seed_books):
+    ids = [int(id) for id in seed_books] + list(range(1000, 3000))
+    resp = requests.delete(f"{url}/books", json={"ids": ids})
+    assert resp.status_code == HTTPStatus.OK
+
+    statuses = {r["id"]: r["status"] for r in resp.json()["books"]}
+    assert all(statuses[int(id)] == "deleted" for id in seed_books)
+    assert statuses[1000] == "not_found"
+    assert len(statuses) == len(ids)
 
     get_resp = requests.get(f"{url}/books")
     assert get_resp.status_code == HTTPStatus.NO_CONTENT
 
 
+@pytest.mark.parametrize("body", ({"ids": "1,2"}, {"ids": [1, "a"]}, [1, 2]))
+def test_delete_multiple_json_invalid(url, body):
+    resp = requests.delete(f"{url}/books", json=body)
+    assert resp.status_code == HTTPStatus.BAD_REQUEST
+
+
 def test_get_books_empty(url):
     resp = requests.get(f"{url}/books")
 
@@ -130,6 +267,15 @@ def test_get_books_basic(url, seed_books):
     assert metadata["self"] == "/books?start=1&limit=20"
 
 
+def test_get_books_fields(url, seed_books):
+    resp = requests.get(f"{url}/books?limit=2&fields=title,authors")
+    assert resp.status_code == HTTPStatus.OK
+
+    for book in resp.json()["books"]:
+        assert sorted(book.keys()) == ["authors", "title"]
+    assert "fields=title%2Cauthors" in resp.json()["metadata"]["next"]
+
+
 def test_get_books_high_start(url, seed_book):
     """Tests that 400 error is returned if start query param is larger than
     number of returned books.
@@ -156,6 +302,70 @@ def test_get_books_pagination(url, seed_books):
     assert metadata["next"] == "/books?start=4&limit=2"
 
 
+def test_get_books_cursor(url, seed_books):
+    resp = requests.get(f"{url}/books?cursor=&limit=2")
+    assert resp.status_code == HTTPStatus.OK
+
+    books = resp.json()["books"]
+    assert books[0]["title"] == "foo1"
+    assert books[1]["title"] == "foo2"
+
+    metadata = resp.json()["metadata"]
+    assert metadata["prev"] == ""
+    assert metadata["count"] == 5
+
+    resp = requests.get(f"{url}{metadata['next']}")
+    assert resp.status_code == HTTPStatus.OK
+
+    books = resp.json()["books"]
+    assert books[0]["title"] == "foo3"
+    assert books[1]["title"] == "foo4"
+    assert resp.json()["metadata"]["prev"] != ""
+
+
+def test_get_books_invalid_cursor(url, seed_books):
+    check_error(
+        "GET",
+        f"{url}/books?cursor=foobar!",
+        HTTPStatus.BAD_REQUEST,
+        "Invalid cursor",
+    )
+
+
+def test_get_books_cursor_other_search(url, seed_books):
+    resp = requests.get(f"{url}/books?cursor=&limit=1&search=title:foo")
+    next_page = urlsplit(resp.json()["metadata"]["next"])
+    cursor = parse_qs(next_page.query)["cursor"][0]
+    check_error(
+        "GET",
+        f"{url}/books?cursor={cursor}&limit=1&search=title:foo1",
+        HTTPStatus.BAD_REQUEST,
+        "cursor does not match",
+    )
+
+
+def test_stream_books(url, seed_books):
+    resp = requests.get(f"{url}/books/stream?sort=-title", stream=True)
+    assert resp.status_code == HTTPStatus.OK
+    assert resp.headers["Content-Type"] == "application/x-ndjson"
+
+    books = [json.loads(line) for line in resp.iter_lines()]
+    assert [b["title"] for b in books] == [f"foo{i}" for i in range(5, 0, -1)]
+
+
+def test_get_books_accept_ndjson(url, seed_books):
+    resp = requests.get(
+        f"{url}/books",
+        params={"search": "title:foo1"},
+        headers={"Accept": "application/x-ndjson"},
+    )
+    assert resp.status_code == HTTPStatus.OK
+
+    lines = resp.text.splitlines()
+    assert len(lines) == 1
+    assert json.loads(lines[0])["title"] == "foo1"
+
+
 def test_get_books_sort(url, seed_books):
     resp = requests.get(f"{url}/books?limit=2&sort=title")
     assert resp.status_code == HTTPStatus.OK
@@ -269,6 +479,21 @@ def test_add_empty_valid(url, payload, key, expected):
     )
 
 
+def test_add_empty_idempotent(url):
+    payload = {"title": "foo", "automerge": "new_record"}
+    headers = {"Idempotency-Key": "test_add_empty_idempotent"}
+    first = requests.post(f"{url}/books/empty", json=payload, headers=headers)
+    retry = requests.post(f"{url}/books/empty", json=payload, headers=headers)
+
+    assert retry.status_code == HTTPStatus.CREATED
+    assert retry.json() == first.json()
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    # no second record was created
+    resp = requests.get(f"{url}/books?search=title:=foo")
+    delete(url, first.json()["id"][0])
+    assert resp.json()["metadata"]["count"] == 1
+
+
 def test_add_book_no_file(url):
     check_error(
         "POST",
@@ -306,6 +531,17 @@ def test_add_book_invalid_filename(url, test_txt, filename):
     )
 
 
+@pytest.mark.parametrize("filename", ("test.epub", "test.pdf", "test.mobi"))
+def test_add_book_invalid_signature(url, test_txt, filename):
+    check_error(
+        "POST",
+        f"{url}/books",
+        HTTPStatus.UNPROCESSABLE_ENTITY,
+        f"{filename} is not a valid",
+        files=test_txt(filename),
+    )
+
+
 def test_add_book_invalid_data(url, test_txt):
     payload = {"title": 1}
     resp = requests.post(
@@ -531,6 +767,75 @@ def test_add_book_existing_with_diff_name(url, seed_book, test_txt):
     delete(url, added_id2)
 
 
+def test_resumable_upload(url):
+    with open(os.path.join(TEST_LIBRARY_PATH, "test.txt"), "rb") as f:
+        content = f.read()
+
+    resp = requests.post(
+        f"{url}/uploads", json={"filename": "resumable.txt", "size": len(content)}
+    )
+    assert resp.status_code == HTTPStatus.CREATED
+    location = f"{url}{resp.headers['Location']}"
+    assert resp.json()["upload"]["offset"] == 0
+
+    half = len(content) // 2
+    resp = requests.put(
+        location,
+        data=content[:half],
+        headers={"Content-Range": f"bytes 0-{half - 1}/{len(content)}"},
+    )
+    assert resp.json()["upload"]["offset"] == half
+
+    # the upload must be complete before it is added
+    resp = requests.post(f"{location}/complete")
+    assert resp.status_code == HTTPStatus.CONFLICT
+    assert resp.json()["offset"] == half
+
+    # a chunk after the offset is rejected
+    rest = half + 1
+    resp = requests.put(
+        location,
+        data=content[rest:],
+        headers={"Content-Range": f"bytes {rest}-{len(content) - 1}/*"},
+    )
+    assert resp.status_code == HTTPStatus.CONFLICT
+
+    # a chunk that does not match its range is rejected before it is written
+    resp = requests.put(
+        location,
+        data=content[half:],
+        headers={"Content-Range": f"bytes {half}-{half}/*"},
+    )
+    assert resp.status_code == HTTPStatus.CONFLICT
+    assert resp.json()["offset"] == half
+
+    resp = requests.put(
+        location,
+        data=content[half:],
+        headers={"Content-Range": f"bytes {half}-{len(content) - 1}/*"},
+    )
+    assert resp.json()["upload"]["offset"] == len(content)
+
+    id = post(f"{location}/complete", HTTPStatus.CREATED, json={"title": "Resumed"})
+    resp = requests.get(f"{url}/books/{id[0]}")
+    assert resp.json()["books"]["title"] == "Resumed"
+    assert requests.get(location).status_code == HTTPStatus.NOT_FOUND
+    delete(url, id[0])
+
+
+@pytest.mark.parametrize(
+    "payload, status",
+    (
+        pytest.param({}, HTTPStatus.BAD_REQUEST, id="no filename"),
+        pytest.param({"filename": "foo.exe"}, 422, id="invalid filename"),
+        pytest.param({"filename": "foo.txt", "size": -1}, 400, id="invalid size"),
+    ),
+)
+def test_resumable_upload_invalid(url, payload, status):
+    resp = requests.post(f"{url}/uploads", json=payload)
+    assert resp.status_code == status
+
+
 def test_update_book_wrong_media_type(url):
     headers = {"Content-Type": "application/xml"}
     check_error(
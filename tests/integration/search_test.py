@@ -0,0 +1,94 @@
+from http import HTTPStatus
+
+import pytest
+import requests
+
+from calibre_rest.index import BookIndex
+from calibre_rest.models import Book
+from calibre_rest.sqlite import SQLiteReader
+
+# Searches that must match the same books with calibredb and with the searches
+# translated to SQL by SQLiteReader and evaluated in memory by BookIndex.
+SEARCH_CORPUS = (
+    "title:omens",
+    "title:=anathem",
+    'title:"children of"',
+    'title:="good omens"',
+    "title:~^a",
+    "title:~time$",
+    "authors:gaiman",
+    "author:=neil gaiman",
+    "tags:science",
+    "tags:=fantasy",
+    "tag:~fict",
+    "series:true",
+    "series:false",
+    "publisher:tor",
+    "publisher:=gollancz",
+    "publisher:false",
+    "rating:4",
+    "rating:3",
+    "rating:>3",
+    "rating:false",
+    "series_index:>=2",
+    "tags:science and not series:anathem",
+    "tags:fantasy or series:anathem",
+    "(tags:fantasy or tags:aliens) authors:tchaikovsky",
+    "not tags:science",
+)
+
+
+@pytest.fixture(scope="module")
+def corpus_books(setup):
+    url = setup.bind_addr
+    books = (
+        {
+            "title": "Children of Time",
+            "authors": ["Adrian Tchaikovsky"],
+            "tags": ["Science Fiction", "Aliens"],
+            "series": "Children of Time",
+            "series_index": 1,
+        },
+        {
+            "title": "Good Omens",
+            "authors": ["Terry Pratchett", "Neil Gaiman"],
+            "tags": ["Fantasy"],
+        },
+        {
+            "title": "Anathem",
+            "authors": ["Neal Stephenson"],
+            "tags": ["Science Fiction"],
+            "series": "Anathem",
+            "series_index": 2,
+        },
+    )
+    ids = []
+    for book in books:
+        resp = requests.post(f"{url}/books/empty", json=book)
+        assert resp.status_code == HTTPStatus.CREATED
+        ids.extend(int(id) for id in resp.json()["id"])
+
+    # calibredb add cannot set the publisher or rating of a book
+    calibredb = setup.app.config["CALIBRE_WRAPPER"]
+    calibredb.set_metadata(ids[0], Book(publisher="Tor Books", rating=8))
+    calibredb.set_metadata(ids[1], Book(publisher="Gollancz", rating=6))
+    seeded = calibredb.get_books_by_ids(ids[:2])
+    assert [(b.publisher, b.rating) for b in seeded] == [
+        ("Tor Books", 8),
+        ("Gollancz", 6),
+    ]
+    yield ids
+    resp = requests.delete(f"{url}/books", params={"id": ",".join(map(str, ids))})
+    assert resp.status_code == HTTPStatus.OK
+
+
+@pytest.mark.parametrize("query", SEARCH_CORPUS)
+def test_search_parity(setup, corpus_books, query):
+    calibredb = setup.app.config["CALIBRE_WRAPPER"]
+    reader = SQLiteReader(setup.library)
+    index = BookIndex(reader)
+    index.load()
+
+    expected = sorted(b.id for b in calibredb.get_books(None, [query]))
+    assert sorted(b.id for b in reader.get_books(None, [query])) == expected
+    assert sorted(b.id for b in index.get_books(None, [query])) == expected
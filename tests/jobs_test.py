@@ -0,0 +1,383 @@
+import os
+import sqlite3
+import time
+
+import pytest
+
+from calibre_rest import jobs
+from calibre_rest.jobs import JobQueue
+
+
+class FakeWrapper:
+    """Records the calls made by jobs instead of running calibredb."""
+
+    def __init__(self):
+        self.books = {1, 2, 3}
+        self.calls = []
+        self.server = None
+
+    def add_multiple(self, paths, book, automerge, hashes=None):
+        self.calls.append(("add", [os.path.basename(p) for p in paths], book.title))
+        return [4]
+
+    def add_batch(self, paths, book, automerge, hashes=None):
+        names = [os.path.basename(p) for p in paths]
+        self.calls.append(("add_batch", names, book.title, automerge))
+        ignored = [p for p in paths if os.path.basename(p).startswith("dup")]
+        added = [p for p in paths if p not in ignored]
+        # files that could not be matched to their books are missing
+        added = [p for p in added if not os.path.basename(p).startswith("lost")]
+        return dict(zip(added, range(10, 10 + len(added)))), ignored
+
+    def set_metadata(self, id, book):
+        self.calls.append(("update", id, book.title))
+        return id if id in self.books else -1
+
+    def update_books(self, updates):
+        for id, book in updates:
+            self.calls.append(("update", id, book.title))
+            yield {"id": id, "status": "updated" if id in self.books else "not_found"}
+
+    def remove(self, ids):
+        self.calls.append(("remove", ids))
+        self.books -= set(ids)
+
+    def existing_ids(self, ids):
+        return self.books & set(ids)
+
+    def export(self, ids, exports_dir):
+        for id in ids:
+            if id not in self.books:
+                raise KeyError(f"book {id} does not exist")
+            with open(os.path.join(exports_dir, f"{id}.txt"), "w") as f:
+                f.write(str(id))
+
+
+@pytest.fixture()
+def queue(tmp_path):
+    return JobQueue(str(tmp_path / "jobs.db"), FakeWrapper())
+
+
+@pytest.fixture()
+def stopped(queue, monkeypatch):
+    """Queue without a writer thread. Jobs are run with run_next()."""
+    monkeypatch.setattr(queue, "start", lambda: None)
+    monkeypatch.setattr(queue, "BATCH_WINDOW", 0)
+    return queue
+
+
+def submit_add(queue, names, book=None, automerge="ignore"):
+    job_id = queue.new_id()
+    os.makedirs(queue.job_dir(job_id))
+    paths = []
+    for name in names:
+        paths.append(os.path.join(queue.job_dir(job_id), name))
+        open(paths[-1], "w").close()
+
+    params = {"paths": paths, "book": book or {}, "automerge": automerge}
+    return queue.submit("add", params, job_id)["id"]
+
+
+def wait(queue, job_id, timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = queue.get(job_id)
+        if job["status"] in ("succeeded", "failed"):
+            return job
+        time.sleep(0.01)
+    raise TimeoutError(f"job {job_id} did not finish")
+
+
+def test_submit(queue):
+    job = queue.submit("update", {"id": 1, "book": {"title": "Foo"}})
+    assert job["status"] in ("queued", "running")
+    assert job["kind"] == "update"
+
+    job = wait(queue, job["id"])
+    assert job["status"] == "succeeded"
+    assert job["result"] == {"ids": [1]}
+    assert job["error"] is None
+    assert queue.calibredb.calls == [("update", 1, "Foo")]
+
+
+def test_patch(queue):
+    updates = [[1, {"title": "Foo"}], [1000, {"title": "Bar"}]]
+    job = wait(queue, queue.submit("patch", {"updates": updates})["id"])
+
+    assert job["result"] == {
+        "books": [
+            {"id": 1, "status": "updated"},
+            {"id": 1000, "status": "not_found"},
+        ]
+    }
+
+
+def test_submit_invalid_kind(queue):
+    with pytest.raises(ValueError, match='Job kind "foo" not supported'):
+        queue.submit("foo", {})
+
+
+def test_get_not_exist(queue):
+    assert queue.get("foo") is None
+
+
+def test_jobs_run_in_order(queue):
+    ids = [
+        queue.submit("update", {"id": i, "book": {"title": f"Book {i}"}})["id"]
+        for i in (3, 1, 2)
+    ]
+    for job_id in ids:
+        wait(queue, job_id)
+
+    assert [call[1] for call in queue.calibredb.calls] == [3, 1, 2]
+
+
+def test_add_removes_uploads(queue):
+    job_id = queue.new_id()
+    os.makedirs(queue.job_dir(job_id))
+    upload = os.path.join(queue.job_dir(job_id), "foo.txt")
+    open(upload, "w").close()
+
+    params = {"paths": [upload], "book": {"title": "Foo"}, "automerge": "ignore"}
+    job = wait(queue, queue.submit("add", params, job_id)["id"])
+
+    assert job["result"] == {"ids": [4]}
+    assert queue.calibredb.calls == [("add", ["foo.txt"], "Foo")]
+    assert not os.path.exists(queue.job_dir(job_id))
+
+
+def test_delete(queue):
+    job = wait(queue, queue.submit("delete", {"ids": [1, 2]})["id"])
+
+    assert job["result"] == {"ids": [1, 2]}
+    assert queue.calibredb.books == {3}
+
+
+def test_export(queue):
+    job = wait(queue, queue.submit("export", {"ids": [2, 1]})["id"])
+
+    assert job["result"] == {"ids": [2, 1], "files": ["1.txt", "2.txt"]}
+    assert sorted(os.listdir(queue.job_dir(job["id"]))) == ["1.txt", "2.txt"]
+
+
+@pytest.mark.parametrize(
+    "kind, params",
+    (
+        ("update", {"id": 1000, "book": {"title": "Foo"}}),
+        ("export", {"ids": [1000]}),
+    ),
+)
+def test_failed(queue, kind, params):
+    job = wait(queue, queue.submit(kind, params)["id"])
+
+    assert job["status"] == "failed"
+    assert job["error"] == "book 1000 does not exist"
+    assert job["result"] is None
+
+
+def test_survives_restart(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    queue = JobQueue(path, FakeWrapper())
+    # queue jobs without a writer thread, as if the server stopped
+    queue.start = lambda: None
+    queued = queue.submit("update", {"id": 1, "book": {"title": "Foo"}})
+    running = queue.submit("update", {"id": 2, "book": {"title": "Bar"}})
+    with queue.connect() as conn:
+        conn.execute(
+            "UPDATE jobs SET status = 'running' WHERE id = ?", (running["id"],)
+        )
+
+    restarted = JobQueue(path, FakeWrapper())
+    restarted.recover()
+    restarted.start()
+
+    assert wait(restarted, queued["id"])["status"] == "succeeded"
+    job = restarted.get(running["id"])
+    assert job["status"] == "failed"
+    assert "interrupted" in job["error"]
+    assert restarted.calibredb.calls == [("update", 1, "Foo")]
+
+
+def test_single_writer(queue):
+    first = queue.submit("update", {"id": 1, "book": {"title": "Foo"}})
+    assert wait(queue, first["id"])["status"] == "succeeded"
+
+    # another process serving the same journal
+    other = JobQueue(queue.path, FakeWrapper())
+    jobs = [
+        other.submit("update", {"id": id, "book": {"title": str(id)}})
+        for id in (2, 3, 1)
+    ]
+    for job in jobs:
+        assert wait(other, job["id"])["status"] == "succeeded"
+
+    assert other.thread.is_alive()
+    assert other.calibredb.calls == []
+    assert queue.calibredb.calls == [
+        ("update", 1, "Foo"),
+        ("update", 2, "2"),
+        ("update", 3, "3"),
+        ("update", 1, "1"),
+    ]
+
+
+def test_coalesce_adds(stopped):
+    first = submit_add(stopped, ["a.txt", "b.txt"])
+    second = submit_add(stopped, ["c.txt"])
+
+    assert stopped.run_next()
+    assert not stopped.run_next()
+    assert stopped.calibredb.calls == [
+        ("add_batch", ["a.txt", "b.txt", "c.txt"], "", "ignore")
+    ]
+    assert stopped.get(first)["result"] == {"ids": [10, 11]}
+    assert stopped.get(second)["result"] == {"ids": [12]}
+    assert not os.path.exists(stopped.job_dir(first))
+
+
+def test_coalesce_adds_ignored(stopped):
+    first = submit_add(stopped, ["a.txt"])
+    second = submit_add(stopped, ["dup.txt", "b.txt"])
+    third = submit_add(stopped, ["c.txt"])
+    stopped.run_next()
+
+    assert stopped.get(first)["result"] == {"ids": [10]}
+    job = stopped.get(second)
+    assert job["status"] == "failed"
+    assert job["result"] == {"ids": [11]}
+    assert job["error"].startswith("Book dup.txt already exists")
+    assert stopped.get(third)["result"] == {"ids": [12]}
+
+
+def test_coalesce_adds_unmatched(stopped):
+    first = submit_add(stopped, ["a.txt"])
+    second = submit_add(stopped, ["lost.txt", "b.txt"])
+    stopped.run_next()
+
+    assert stopped.get(first)["result"] == {"ids": [10]}
+    job = stopped.get(second)
+    assert job["status"] == "failed"
+    assert job["result"] == {"ids": [11]}
+    assert job["error"] == "Book lost.txt could not be matched to an added book"
+
+
+def test_coalesce_adds_remote(stopped):
+    stopped.calibredb.server = object()
+    submit_add(stopped, ["a.txt"])
+    submit_add(stopped, ["b.txt"])
+
+    stopped.run_next()
+    assert stopped.calibredb.calls == [("add", ["a.txt"], "")]
+
+
+@pytest.mark.parametrize(
+    "second",
+    (
+        pytest.param({"book": {"title": "Foo"}}, id="metadata"),
+        pytest.param({"automerge": "new_record"}, id="automerge"),
+    ),
+)
+def test_coalesce_adds_incompatible(stopped, second):
+    submit_add(stopped, ["a.txt"])
+    submit_add(stopped, ["b.txt"], **second)
+    submit_add(stopped, ["c.txt"], **second)
+
+    # the first add runs alone, the next two together
+    stopped.run_next()
+    assert stopped.calibredb.calls == [("add", ["a.txt"], "")]
+    stopped.run_next()
+    assert stopped.calibredb.calls[1][1] == ["b.txt", "c.txt"]
+
+
+def test_coalesce_adds_overwrite(stopped):
+    submit_add(stopped, ["a.txt"], automerge="overwrite")
+    submit_add(stopped, ["b.txt"], automerge="overwrite")
+
+    stopped.run_next()
+    assert len(stopped.calibredb.calls) == 1
+    stopped.run_next()
+    assert len(stopped.calibredb.calls) == 2
+
+
+def test_coalesce_keeps_order(stopped):
+    submit_add(stopped, ["a.txt"])
+    stopped.submit("update", {"id": 1, "book": {"title": "Foo"}})
+    submit_add(stopped, ["b.txt"])
+
+    while stopped.run_next():
+        pass
+    assert [call[0] for call in stopped.calibredb.calls] == ["add", "update", "add"]
+
+
+def test_coalesce_deletes(stopped):
+    first = stopped.submit("delete", {"ids": [1, 2]})["id"]
+    second = stopped.submit("delete", {"ids": [2, 3]})["id"]
+
+    stopped.run_next()
+    assert stopped.calibredb.calls == [("remove", [1, 2, 3])]
+    assert stopped.get(first)["result"] == {"ids": [1, 2]}
+    assert stopped.get(second)["status"] == "succeeded"
+
+
+def test_reap(stopped, monkeypatch):
+    dead = stopped.submit("update", {"id": 1, "book": {"title": "Foo"}})
+    alive = stopped.submit("update", {"id": 2, "book": {"title": "Bar"}})
+    with stopped.connect() as conn:
+        conn.execute(
+            "UPDATE jobs SET status = 'running', owner = ? WHERE id = ?",
+            (2**22 + 1, dead["id"]),
+        )
+        conn.execute(
+            "UPDATE jobs SET status = 'running', owner = ? WHERE id = ?",
+            (os.getpid(), alive["id"]),
+        )
+
+    monkeypatch.setattr(jobs, "pid_exists", lambda pid: pid == os.getpid())
+    stopped.reap()
+
+    job = stopped.get(dead["id"])
+    assert job["status"] == "failed"
+    assert "interrupted" in job["error"]
+    assert stopped.get(alive["id"])["status"] == "running"
+
+
+def test_claim_owner(stopped):
+    job = stopped.submit("update", {"id": 1, "book": {"title": "Foo"}})
+    stopped.claim()
+    with stopped.connect() as conn:
+        (owner,) = conn.execute(
+            "SELECT owner FROM jobs WHERE id = ?", (job["id"],)
+        ).fetchone()
+    assert owner == os.getpid()
+
+
+def test_expire(stopped, monkeypatch):
+    old = stopped.submit("export", {"ids": [1]})["id"]
+    stopped.run_next()
+    queued = stopped.submit("export", {"ids": [2]})["id"]
+    assert os.path.isdir(stopped.job_dir(old))
+
+    monkeypatch.setattr(time, "time", lambda: 1e12)
+    stopped.expire()
+
+    assert stopped.get(old) is None
+    assert not os.path.exists(stopped.job_dir(old))
+    # jobs that did not finish are kept
+    assert stopped.get(queued)["status"] == "queued"
+
+
+def test_migrate_owner(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE jobs (id TEXT PRIMARY KEY, kind TEXT NOT NULL, "
+        "params TEXT NOT NULL, status TEXT NOT NULL, result TEXT, error TEXT, "
+        "created REAL NOT NULL, updated REAL NOT NULL)"
+    )
+    conn.close()
+
+    queue = JobQueue(path, FakeWrapper())
+    queue.start = lambda: None
+    job = queue.submit("update", {"id": 1, "book": {"title": "Foo"}})
+    assert queue.run_next()
+    assert queue.get(job["id"])["status"] == "succeeded"
@@ -0,0 +1,191 @@
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pytest
+
+from calibre_rest.calibre import CalibreWrapper
+from calibre_rest.errors import CalibreConcurrencyError
+from calibre_rest.lock import FileLock, ReadWriteLock
+from calibre_rest.models import Book
+
+
+def test_readers_share_lock():
+    lock = ReadWriteLock()
+    inside = threading.Barrier(3, timeout=5)
+
+    def read():
+        with lock.read():
+            # all three readers hold the lock at once
+            inside.wait()
+
+    threads = [threading.Thread(target=read) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert not lock.locked()
+    assert lock.metrics()["read"]["acquired"] == 3
+
+
+def test_writer_excludes_readers():
+    lock = ReadWriteLock()
+
+    def read():
+        with lock.read():
+            pass
+
+    with lock.write():
+        reader = threading.Thread(target=read)
+        reader.start()
+        reader.join(0.1)
+        # the reader waits for the writer
+        assert reader.is_alive()
+
+    reader.join(5)
+    assert not reader.is_alive()
+    assert lock.metrics()["read"]["wait_max"] >= 0.1
+
+
+def test_writer_preference():
+    lock = ReadWriteLock()
+    order = []
+    reading = lock.read()
+    reading.__enter__()
+
+    def write():
+        with lock.write():
+            order.append("write")
+
+    def read():
+        with lock.read():
+            order.append("read")
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    while not lock.waiting_writers:
+        time.sleep(0.01)
+
+    # a new reader queues behind the waiting writer instead of joining the
+    # current reader
+    reader = threading.Thread(target=read)
+    reader.start()
+    reader.join(0.1)
+    assert reader.is_alive()
+
+    reading.__exit__(None, None, None)
+    writer.join(5)
+    reader.join(5)
+    assert order == ["write", "read"]
+
+
+def test_release_on_error():
+    lock = ReadWriteLock()
+    try:
+        with lock.write():
+            raise ValueError
+    except ValueError:
+        pass
+
+    assert not lock.locked()
+    with lock.read():
+        assert lock.locked()
+
+
+def test_metrics():
+    lock = ReadWriteLock()
+    with lock.write():
+        pass
+
+    metrics = lock.metrics()
+    assert metrics["write"]["acquired"] == 1
+    assert metrics["write"]["wait_total"] == metrics["write"]["wait_max"]
+    assert metrics["read"] == {"acquired": 0, "wait_total": 0.0, "wait_max": 0.0}
+
+
+# Stands in for calibredb. Like calibredb, it refuses to run while another
+# instance has the library open.
+FAKE_CALIBREDB = """
+import fcntl, os, sys, time
+
+lib = sys.argv[sys.argv.index("--with-library") + 1]
+fd = os.open(os.path.join(lib, "singleinstance"), os.O_RDWR | os.O_CREAT)
+try:
+    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+except BlockingIOError:
+    sys.exit("Another calibre program such as calibre-server is running.")
+
+time.sleep(0.01)
+with open(os.path.join(lib, "added"), "a") as f:
+    f.write("1\\n")
+print("Added book ids: 1")
+"""
+
+
+@pytest.fixture()
+def calibredb(tmp_path):
+    cdb = tmp_path / "calibredb"
+    cdb.write_text(f"#!{sys.executable}\n{FAKE_CALIBREDB}")
+    cdb.chmod(0o755)
+    return str(cdb)
+
+
+def test_file_lock_exclusive(tmp_path):
+    lock = FileLock(str(tmp_path / "lock"))
+    other = FileLock(str(tmp_path / "lock"))
+
+    def read():
+        with other.read():
+            pass
+
+    with lock.write():
+        reader = threading.Thread(target=read)
+        reader.start()
+        reader.join(0.1)
+        # the reader waits for the writer
+        assert reader.is_alive()
+
+    reader.join(5)
+    assert not reader.is_alive()
+    assert other.metrics()["read"]["wait_max"] >= 0.1
+
+
+def test_file_lock_shared(tmp_path):
+    lock = FileLock(str(tmp_path / "lock"))
+    with lock.read(), lock.read():
+        pass
+
+    assert lock.metrics()["read"]["acquired"] == 2
+
+
+def add_books(calibredb: str, lib: str, lock_path: str, count: int) -> int:
+    """Add count books from one process and return the number of
+    CalibreConcurrencyErrors."""
+    wrapper = CalibreWrapper(calibredb, lib, lock_path=lock_path)
+
+    def add(_):
+        try:
+            wrapper.add_one_empty(Book(title="Foo"))
+        except CalibreConcurrencyError:
+            return 1
+        return 0
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        return sum(executor.map(add, range(count)))
+
+
+def test_stress_writes(calibredb, tmp_path):
+    lock_path = str(tmp_path / ".calibre-rest.lock")
+    processes, count = 4, 10
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [
+            executor.submit(add_books, calibredb, str(tmp_path), lock_path, count)
+            for _ in range(processes)
+        ]
+        errors = sum(f.result() for f in futures)
+
+    assert errors == 0
+    assert len((tmp_path / "added").read_text().splitlines()) == processes * count
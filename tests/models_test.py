@@ -1,6 +1,15 @@
 import pytest
 
-from calibre_rest.models import Book, PaginatedResults
+from calibre_rest.models import (
+    Book,
+    CursorPaginatedResults,
+    PaginatedResults,
+    cursor_digest,
+    decode_cursor,
+    encode_cursor,
+    parse_fields,
+    project,
+)
 
 
 @pytest.fixture(scope="module")
@@ -16,7 +25,7 @@ def books():
 
 def test_pagination_init(books):
     with pytest.raises(Exception) as exc:
-        PaginatedResults(books, 10, 2)
+        PaginatedResults(books, len(books), 10, 2)
 
     assert exc.value.args[0] == "start 10 is larger than number of books (5)"
 
@@ -33,7 +42,8 @@ def test_pagination_init(books):
     ),
 )
 def test_pagination_paging(books, start, limit, count, prev, next):
-    res = PaginatedResults(books, start, limit)
+    page = books[(start - 1) : (start - 1 + limit)]  # noqa: E203
+    res = PaginatedResults(page, len(books), start, limit)
     assert res.current_page() == f"/books?start={start}&limit={limit}"
     assert res.prev_page() == prev
     assert res.next_page() == next
@@ -58,7 +68,7 @@ def test_pagination_paging(books, start, limit, count, prev, next):
     ),
 )
 def test_build_query_sort(books, sort, expected):
-    res = PaginatedResults(books, 1, 2, sort=sort)
+    res = PaginatedResults(books[:2], len(books), 1, 2, sort=sort)
     assert res.build_query(1) == expected
 
 
@@ -75,12 +85,86 @@ def test_build_query_sort(books, sort, expected):
     ),
 )
 def test_build_query_search(books, search, expected):
-    res = PaginatedResults(books, 1, 2, search=search)
+    res = PaginatedResults(books[:2], len(books), 1, 2, search=search)
     assert res.build_query(1) == expected
 
 
 def test_pagination(books):
-    res = PaginatedResults(books, 1, 2, sort=["authors"], search="foobar")
+    res = PaginatedResults(
+        books[:2], len(books), 1, 2, sort=["authors"], search="foobar"
+    )
     assert res.current_page() == "/books?start=1&limit=2&sort=authors&search=foobar"
     assert res.prev_page() == ""
     assert res.next_page() == "/books?start=3&limit=2&sort=authors&search=foobar"
+
+
+def test_pagination_full_text(books):
+    res = PaginatedResults(books[:2], len(books), 1, 2, q="foo bar")
+    assert res.next_page() == "/books?start=3&limit=2&q=foo+bar"
+
+
+def test_pagination_fields(books):
+    res = PaginatedResults(books[:2], len(books), 1, 2, fields=["id", "title"])
+    assert res.next_page() == "/books?start=3&limit=2&fields=id%2Ctitle"
+    assert res.todict()["books"] == [
+        {"id": 0, "title": "foo"},
+        {"id": 0, "title": "bar"},
+    ]
+
+
+@pytest.mark.parametrize(
+    "values, expected",
+    (
+        pytest.param(None, None, id="none"),
+        pytest.param([""], None, id="empty"),
+        pytest.param(["title,authors,id"], ["title", "authors", "id"], id="comma"),
+        pytest.param(["title", "id, title"], ["title", "id"], id="repeated"),
+    ),
+)
+def test_parse_fields(values, expected):
+    assert parse_fields(values) == expected
+
+
+def test_parse_fields_invalid():
+    with pytest.raises(ValueError, match="Invalid fields: foo, bar"):
+        parse_fields(["title,foo,bar"])
+
+
+def test_project():
+    book = Book(id=1, title="foo", tags=["bar"])
+    assert project(book, ["tags", "id"]) == {"tags": ["bar"], "id": 1}
+    assert project(book) is book
+
+
+def test_cursor_roundtrip():
+    data = {"s": ["title"], "d": "after", "o": 2, "k": ["foo", 3]}
+    cursor = encode_cursor(data)
+
+    assert "=" not in cursor
+    assert decode_cursor(cursor) == data
+
+
+def test_cursor_digest():
+    digest = cursor_digest(["title"], ["tags:foo"])
+    assert cursor_digest(["title"], ["tags:foo"]) == digest
+    assert cursor_digest(None, None) == cursor_digest([], [])
+    assert cursor_digest(["title"], None) != digest
+    # the sort keys cannot be confused with the search
+    assert cursor_digest(["tags:foo"], ["title"]) != digest
+
+
+@pytest.mark.parametrize("cursor", ("foobar!", "bm90IGpzb24", "WzFd"))
+def test_cursor_invalid(cursor):
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        decode_cursor(cursor)
+
+
+def test_cursor_pagination(books):
+    res = CursorPaginatedResults(books[:2], len(books), "", "", "abc", 2, ["title"])
+    assert res.current_page() == "/books?cursor=&limit=2&sort=title"
+    assert res.prev_page() == ""
+    assert res.next_page() == "/books?cursor=abc&limit=2&sort=title"
+
+    d = res.todict()
+    assert len(d["books"]) == 2
+    assert d["metadata"]["count"] == len(books)
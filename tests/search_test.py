@@ -0,0 +1,95 @@
+import pytest
+
+from calibre_rest import search
+from calibre_rest.errors import UnsupportedSearchError
+from calibre_rest.sqlite import SQLiteReader
+
+
+@pytest.fixture()
+def reader(library):
+    return SQLiteReader(library)
+
+
+@pytest.mark.parametrize(
+    "terms, expected",
+    (
+        pytest.param(None, None, id="none"),
+        pytest.param([" "], None, id="empty"),
+        pytest.param(["title:foo"], ("token", "title", "foo"), id="token"),
+        pytest.param(["Author:foo"], ("token", "authors", "foo"), id="alias"),
+        pytest.param(['title:"foo bar"'], ("token", "title", "foo bar"), id="quoted"),
+        pytest.param(
+            ['title:="foo bar"'], ("token", "title", "=foo bar"), id="quoted equals"
+        ),
+        pytest.param(["title:foo:bar"], ("token", "title", "foo:bar"), id="colon"),
+        pytest.param(
+            ["title:foo", "tags:bar"],
+            ("and", ("token", "title", "foo"), ("token", "tags", "bar")),
+            id="implicit and",
+        ),
+        pytest.param(
+            ["title:a or title:b and title:c"],
+            (
+                "or",
+                ("token", "title", "a"),
+                ("and", ("token", "title", "b"), ("token", "title", "c")),
+            ),
+            id="precedence",
+        ),
+        pytest.param(
+            ["not (title:a OR title:b)"],
+            ("not", ("or", ("token", "title", "a"), ("token", "title", "b"))),
+            id="not",
+        ),
+    ),
+)
+def test_parse(terms, expected):
+    assert search.parse(terms) == expected
+
+
+@pytest.mark.parametrize(
+    "terms",
+    (
+        pytest.param(["foo"], id="bare"),
+        pytest.param(['"foo"'], id="all fields"),
+        pytest.param(["title:foo1 or foo2"], id="bare in boolean"),
+        pytest.param(["isbn:123"], id="location"),
+        pytest.param(["(title:foo"], id="unbalanced"),
+        pytest.param(["title:foo)"], id="unexpected"),
+        pytest.param(["tags:=.fiction"], id="hierarchical"),
+        pytest.param(["rating:good"], id="numeric"),
+        pytest.param(["title:"], id="empty"),
+        pytest.param(["title:~("], id="regex"),
+    ),
+)
+def test_parse_unsupported(terms):
+    with pytest.raises(UnsupportedSearchError):
+        search.validate(search.parse(terms))
+
+
+@pytest.mark.parametrize(
+    "terms, expected",
+    (
+        pytest.param(["title:OMENS"], [2], id="contains"),
+        pytest.param(["title:%"], [], id="escaped"),
+        pytest.param(["tags:=fantasy"], [2], id="equals"),
+        pytest.param(["tags:=science"], [], id="equals partial"),
+        pytest.param(["authors:~^neal"], [3], id="regex"),
+        pytest.param(["series:true"], [1, 3], id="true"),
+        pytest.param(["publisher:false"], [2, 3], id="false"),
+        pytest.param(["formats:pdf"], [2], id="formats"),
+        pytest.param(["rating:4"], [1], id="rating"),
+        pytest.param(["rating:<1"], [2, 3], id="no rating"),
+        pytest.param(["id:>=2"], [2, 3], id="id"),
+        pytest.param(["tags:science not series:anathem"], [1], id="not"),
+        pytest.param(["(id:1 or id:2) and tags:fantasy"], [2], id="parens"),
+    ),
+)
+def test_search(reader, terms, expected):
+    assert [b.id for b in reader.get_books(None, terms)] == expected
+    assert reader.count_books(terms) == len(expected)
+
+
+def test_search_unsupported(reader):
+    with pytest.raises(UnsupportedSearchError):
+        reader.get_books(None, ["foo"])
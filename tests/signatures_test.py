@@ -0,0 +1,62 @@
+import io
+
+import pytest
+
+from calibre_rest.calibre import CalibreWrapper
+from calibre_rest.signatures import SIGNATURES, valid_signature
+
+
+def palm(type_creator: bytes) -> bytes:
+    return b"\x00" * 60 + type_creator + b"\x00" * 10
+
+
+@pytest.mark.parametrize(
+    "ext, head",
+    (
+        pytest.param(".epub", b"PK\x03\x04mimetypeapplication/epub+zip", id="epub"),
+        pytest.param(".CBZ", b"PK\x03\x04", id="uppercase"),
+        pytest.param(".docx", b"PK\x05\x06", id="empty zip"),
+        pytest.param(".pdf", b"%PDF-1.7\n", id="pdf"),
+        pytest.param(".pdf", b"\r\n%PDF-1.4\n", id="pdf offset"),
+        pytest.param(".mobi", palm(b"BOOKMOBI"), id="mobi"),
+        pytest.param(".prc", palm(b"TEXtREAd"), id="prc"),
+        pytest.param(".azw", b"TPZ0", id="topaz"),
+        pytest.param(".pdb", palm(b"PNRdPPrs"), id="pdb"),
+        pytest.param(".cbr", b"Rar!\x1a\x07\x01\x00", id="rar5"),
+        pytest.param(".cb7", b"7z\xbc\xaf\x27\x1c\x00\x04", id="7z"),
+        pytest.param(".djvu", b"AT&TFORM\x00\x00\x00\x00DJVM", id="djvu"),
+        pytest.param(".rtf", b"{\\rtf1\\ansi", id="rtf"),
+        pytest.param(".txt", b"\x00\x01", id="text"),
+    ),
+)
+def test_valid_signature(ext, head):
+    assert valid_signature(io.BytesIO(head), ext)
+
+
+@pytest.mark.parametrize(
+    "ext, head",
+    (
+        pytest.param(".epub", b"<html></html>", id="html as epub"),
+        pytest.param(".epub", b"", id="empty"),
+        pytest.param(".pdf", b"PK\x03\x04", id="zip as pdf"),
+        pytest.param(".pdf", b"\x00" * 1024 + b"%PDF-1.4", id="pdf too late"),
+        pytest.param(".mobi", palm(b"BOOKMOBI")[:40], id="truncated"),
+        pytest.param(".azw3", b"PK\x03\x04", id="zip as azw3"),
+        pytest.param(".pdb", palm(b"\x00\x01\x02\x03\x04\x05\x06\x07"), id="pdb"),
+        pytest.param(".cbr", b"PK\x03\x04", id="cbz as cbr"),
+    ),
+)
+def test_invalid_signature(ext, head):
+    assert not valid_signature(io.BytesIO(head), ext)
+
+
+def test_valid_signature_keeps_position():
+    stream = io.BytesIO(b"PK\x03\x04foo")
+    stream.seek(5)
+
+    assert valid_signature(stream, ".epub")
+    assert stream.tell() == 5
+
+
+def test_signatures_allowed():
+    assert set(SIGNATURES) <= set(CalibreWrapper.ALLOWED_FILE_EXTENSIONS)
@@ -0,0 +1,304 @@
+import os
+import sqlite3
+
+import pytest
+
+from calibre_rest.calibre import CalibreWrapper
+from calibre_rest.models import Book, cursor_digest, encode_cursor
+from calibre_rest.sqlite import SQLiteReader, isoformat
+
+
+@pytest.fixture()
+def reader(library):
+    return SQLiteReader(library)
+
+
+def test_get_book(reader, library):
+    book = reader.get_book(1)
+
+    assert book.id == 1
+    assert book.title == "Children of Time"
+    assert book.authors == "Adrian Tchaikovsky"
+    assert book.author_sort == "Tchaikovsky"
+    assert book.tags == ["Science Fiction", "Aliens"]
+    assert book.series == "Children of Time"
+    assert book.series_index == 1.0
+    assert book.publisher == "Tor Books"
+    assert book.rating == 8
+    assert book.languages == ["eng"]
+    assert book.identifiers == {"isbn": "9781447273288", "isbn10": "1447273281"}
+    assert book.isbn == "9781447273288"
+    assert book.comments == "<p>Spiders</p>"
+    assert book.size == 518137
+    assert book.formats == [
+        os.path.join(
+            library,
+            "Adrian Tchaikovsky/Children of Time",
+            "Children of Time - Adrian Tchaikovsky.epub",
+        )
+    ]
+    assert book.cover == ""
+    assert book.timestamp == "2022-10-28T07:43:27+00:00"
+    assert book.last_modified == "2023-05-16T06:19:44.123456+00:00"
+    assert book.uuid != ""
+
+
+def test_get_book_multiple_values(reader, library):
+    book = reader.get_book(2)
+
+    assert book.authors == "Terry Pratchett & Neil Gaiman"
+    assert book.languages == ["eng", "fra"]
+    assert book.size == 2000
+    assert len(book.formats) == 2
+    assert book.cover == os.path.join(library, "Terry Pratchett/Good Omens/cover.jpg")
+    assert book.series == ""
+    assert book.isbn == ""
+
+
+def test_get_book_fields(reader):
+    queries = []
+    conn = reader.connect()
+    conn.set_trace_callback(queries.append)
+    book = reader.get_book(1, ["id", "title", "isbn"])
+    conn.set_trace_callback(None)
+
+    assert book.title == "Children of Time"
+    assert book.isbn == "9781447273288"
+    # link tables of fields that were not requested are not read
+    assert book.tags == []
+    assert not any("books_tags_link" in q for q in queries)
+    assert not any("FROM data" in q for q in queries)
+
+
+def test_get_book_not_exist(reader):
+    assert reader.get_book(1000) is None
+
+
+@pytest.mark.parametrize(
+    "sort, expected",
+    (
+        pytest.param(None, [1, 2, 3], id="default"),
+        pytest.param(["title"], [3, 1, 2], id="title"),
+        pytest.param(["-title"], [2, 1, 3], id="descending"),
+        pytest.param(["tags", "title"], [2, 3, 1], id="multiple"),
+        pytest.param(["languages", "-title"], [3, 1, 2], id="mixed directions"),
+        pytest.param(["-languages", "title"], [2, 1, 3], id="mixed descending"),
+        pytest.param(["not_exist"], [1, 2, 3], id="invalid"),
+    ),
+)
+def test_get_books_sort(reader, sort, expected):
+    books = reader.get_books(sort)
+    assert [b.id for b in books] == expected
+
+
+@pytest.mark.parametrize(
+    "start, limit, expected",
+    (
+        pytest.param(1, 2, [1, 2], id="first page"),
+        pytest.param(2, 2, [2, 3], id="offset"),
+        pytest.param(3, None, [3], id="no limit"),
+        pytest.param(4, 2, [], id="past end"),
+    ),
+)
+def test_get_books_page(reader, start, limit, expected):
+    books = reader.get_books(start=start, limit=limit)
+    assert [b.id for b in books] == expected
+
+
+def test_count_books(reader):
+    assert reader.count_books() == 3
+
+
+def test_read_only(reader):
+    with pytest.raises(sqlite3.OperationalError):
+        reader.connect().execute("DELETE FROM books")
+
+
+def test_wrapper_sqlite_engine(library):
+    wrapper = CalibreWrapper("foo", library, read_engine="sqlite")
+
+    assert wrapper.get_book(3).title == "Anathem"
+    assert len(wrapper.get_books()) == 3
+    assert wrapper.count_books() == 3
+
+
+@pytest.mark.parametrize("engine", ("sqlite", "index"))
+def test_wrapper_update_book(library, engine, monkeypatch):
+    wrapper = CalibreWrapper("foo", library, read_engine=engine)
+    cmds = []
+    monkeypatch.setattr(wrapper, "_run", lambda cmd: cmds.append(cmd) or ("", ""))
+
+    # the book is read back from metadata.db, so calibredb runs only once
+    assert wrapper.update_book(3, Book(title="Anathem")).title == "Anathem"
+    assert len(cmds) == 1
+
+
+@pytest.mark.parametrize("engine", ("sqlite", "index"))
+def test_wrapper_existing_ids(library, engine):
+    wrapper = CalibreWrapper("foo", library, read_engine=engine)
+    ids = list(range(1, 5001))
+
+    # one query for thousands of ids, without calibredb
+    assert wrapper.existing_ids(ids) == {1, 2, 3}
+    assert wrapper.existing_ids([]) == set()
+
+
+@pytest.mark.parametrize(
+    "start, limit",
+    (
+        pytest.param(0, 2, id="start"),
+        pytest.param(1, 0, id="limit"),
+    ),
+)
+def test_wrapper_invalid_page(library, start, limit):
+    wrapper = CalibreWrapper("foo", library, read_engine="sqlite")
+    with pytest.raises(ValueError, match="cannot be < 1"):
+        wrapper.get_books(start=start, limit=limit)
+
+
+@pytest.mark.parametrize("sort", (None, ["title"], ["-authors"], ["tags", "-id"]))
+def test_iter_books(reader, sort):
+    books = list(reader.iter_books(sort, None, batch_size=2))
+    assert books == reader.get_books(sort)
+
+
+def test_iter_books_search(reader):
+    books = reader.iter_books(None, ["tags:science"], batch_size=1)
+    assert [b.id for b in books] == [1, 3]
+
+
+def test_get_last_modified(reader):
+    assert reader.get_last_modified(1) == "2023-05-16T06:19:44.123456+00:00"
+    assert reader.get_last_modified(1000) is None
+
+
+def test_wrapper_library_version(library):
+    wrapper = CalibreWrapper("foo", library, read_engine="sqlite")
+    version, modified = wrapper.library_version()
+    assert wrapper.library_version() == (version, modified)
+    assert modified.tzinfo is not None
+
+    conn = sqlite3.connect(library / "metadata.db")
+    conn.create_function("title_sort", 1, lambda x: x)
+    conn.execute("UPDATE books SET pubdate = '2000-01-01' WHERE id = 1")
+    conn.commit()
+    conn.close()
+    assert wrapper.library_version()[0] != version
+
+
+def test_wrapper_invalid_engine(library):
+    with pytest.raises(ValueError, match="not supported"):
+        CalibreWrapper("foo", library, read_engine="foo")
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    (
+        ("2023-05-16 06:19:44+00:00", "2023-05-16T06:19:44+00:00"),
+        ("2023-05-16 06:19:44", "2023-05-16T06:19:44+00:00"),
+        ("0101-01-01 00:00:00+00:00", "0101-01-01T00:00:00+00:00"),
+        ("", ""),
+        (None, ""),
+    ),
+)
+def test_isoformat(value, expected):
+    assert isoformat(value) == expected
+
+
+@pytest.mark.parametrize(
+    "sort, key, before, expected",
+    (
+        pytest.param(None, None, False, [1, 2], id="first page"),
+        pytest.param(None, [1], False, [2, 3], id="after"),
+        pytest.param(None, [3], True, [1, 2], id="before"),
+        pytest.param(["title"], ["Anathem", 3], False, [1, 2], id="sorted"),
+        pytest.param(["-title"], ["Good Omens", 2], False, [1, 3], id="descending"),
+        pytest.param(["title"], ["Good Omens", 2], True, [3, 1], id="sorted before"),
+    ),
+)
+def test_get_books_by_keyset(reader, sort, key, before, expected):
+    books, keys, _ = reader.get_books_by_keyset(sort, None, key, before, limit=2)
+
+    assert [b.id for b in books] == expected
+    assert [k[-1] for k in keys] == expected
+
+
+def test_get_books_by_keyset_more(reader):
+    _, keys, more = reader.get_books_by_keyset(limit=2)
+    assert more
+
+    _, _, more = reader.get_books_by_keyset(key=keys[-1], limit=2)
+    assert not more
+
+
+def test_get_books_by_keyset_stable(reader, library):
+    _, keys, _ = reader.get_books_by_keyset(["title"], limit=1)
+
+    conn = sqlite3.connect(library / "metadata.db")
+    conn.execute("DELETE FROM books WHERE id = 3")
+    conn.commit()
+    conn.close()
+
+    books, _, _ = reader.get_books_by_keyset(["title"], key=keys[-1], limit=1)
+    assert books[0].id == 1
+
+
+def test_get_books_by_keyset_invalid_key(reader):
+    with pytest.raises(ValueError, match="cursor does not match"):
+        reader.get_books_by_keyset(["title"], key=[1])
+
+
+def test_wrapper_cursor(library):
+    wrapper = CalibreWrapper("foo", library, read_engine="sqlite")
+
+    books, prev, next = wrapper.get_books_by_cursor(["title"], None, "", 2)
+    assert [b.id for b in books] == [3, 1]
+    assert prev == ""
+
+    books, prev, next = wrapper.get_books_by_cursor(["title"], None, next, 2)
+    assert [b.id for b in books] == [2]
+    assert next == ""
+
+    books, prev, next = wrapper.get_books_by_cursor(["title"], None, prev, 2)
+    assert [b.id for b in books] == [3, 1]
+    assert prev == ""
+    assert next != ""
+
+
+def test_wrapper_cursor_sort_mismatch(library):
+    wrapper = CalibreWrapper("foo", library, read_engine="sqlite")
+
+    _, _, next = wrapper.get_books_by_cursor(["title"], None, "", 2)
+    with pytest.raises(ValueError, match="cursor does not match"):
+        wrapper.get_books_by_cursor(["id"], None, next, 2)
+
+
+def test_wrapper_cursor_search_mismatch(library):
+    wrapper = CalibreWrapper("foo", library, read_engine="sqlite")
+
+    _, _, next = wrapper.get_books_by_cursor(["title"], ["tags:science"], "", 1)
+    with pytest.raises(ValueError, match="cursor does not match"):
+        wrapper.get_books_by_cursor(["title"], None, next, 1)
+    with pytest.raises(ValueError, match="cursor does not match"):
+        wrapper.get_books_by_cursor(["title"], ["tags:fantasy"], next, 1)
+
+
+@pytest.mark.parametrize(
+    "data",
+    (
+        pytest.param({"d": "after", "o": []}, id="offset list"),
+        pytest.param({"d": "after", "o": "1"}, id="offset string"),
+        pytest.param({"d": "after", "o": True}, id="offset bool"),
+        pytest.param({"d": "after", "o": -1}, id="negative offset"),
+        pytest.param({"d": "sideways", "o": 0}, id="direction"),
+        pytest.param({"d": "after", "o": 1, "k": "Anathem"}, id="key string"),
+        pytest.param({"d": "after", "o": 1, "k": [{}, 3]}, id="key values"),
+        pytest.param({"d": "after", "o": 1, "k": ["Anathem", 3, 1]}, id="key length"),
+    ),
+)
+def test_wrapper_cursor_malformed(library, data):
+    wrapper = CalibreWrapper("foo", library, read_engine="sqlite")
+    cursor = encode_cursor({"q": cursor_digest(["title"], None), **data})
+
+    with pytest.raises(ValueError, match="Invalid cursor|cursor does not match"):
+        wrapper.get_books_by_cursor(["title"], None, cursor, 2)
@@ -0,0 +1,172 @@
+import hashlib
+import io
+import os
+
+import pytest
+from flask import Flask, jsonify, request
+
+from calibre_rest.errors import UploadOffsetError
+from calibre_rest.uploads import SpoolRequest, UploadStore, spooled_path
+
+
+@pytest.fixture()
+def app(tmp_path):
+    app = Flask(__name__)
+    app.request_class = SpoolRequest
+    app.config["spool_path"] = str(tmp_path / "spool")
+    os.makedirs(app.config["spool_path"])
+    app.config["spooled"] = []
+
+    @app.route("/upload", methods=["POST"])
+    def upload():
+        directory = request.form.get("directory")
+        files = list(request.files.values())
+        hashes = [f.stream.hexdigest() for f in files]
+        paths = [spooled_path(f.stream, directory) for f in files]
+        app.config["spooled"].extend(paths)
+        contents = []
+        for p in paths:
+            with open(p, "rb") as f:
+                contents.append(f.read().decode())
+        return jsonify(paths=paths, contents=contents, hashes=hashes)
+
+    return app
+
+
+def test_spool_request(app):
+    client = app.test_client()
+    data = {
+        "a": (io.BytesIO(b"foo"), "book.epub"),
+        "b": (io.BytesIO(b"bar"), "book.epub"),
+    }
+    res = client.post("/upload", data=data)
+
+    assert res.status_code == 200
+    paths = res.json["paths"]
+    assert res.json["contents"] == ["foo", "bar"]
+    assert res.json["hashes"] == [
+        hashlib.sha256(b"foo").hexdigest(),
+        hashlib.sha256(b"bar").hexdigest(),
+    ]
+    # files with the same name do not overwrite each other
+    assert len(set(paths)) == 2
+    assert all(os.path.basename(p) == "book.epub" for p in paths)
+    assert all(p.startswith(app.config["spool_path"]) for p in paths)
+
+    # the request's spool directory is removed with the request
+    assert not any(os.path.exists(p) for p in paths)
+    assert os.listdir(app.config["spool_path"]) == []
+
+
+def test_spool_request_private_dirs(app):
+    client = app.test_client()
+    dirs = set()
+    for _ in range(2):
+        res = client.post("/upload", data={"a": (io.BytesIO(b"foo"), "book.epub")})
+        dirs.add(os.path.dirname(os.path.dirname(res.json["paths"][0])))
+
+    assert len(dirs) == 2
+
+
+def test_spooled_path_directory(app, tmp_path):
+    client = app.test_client()
+    directory = str(tmp_path / "job")
+    data = {
+        "directory": directory,
+        "a": (io.BytesIO(b"foo"), "../book.epub"),
+        "b": (io.BytesIO(b"bar"), "book.epub"),
+    }
+    res = client.post("/upload", data=data)
+
+    paths = res.json["paths"]
+    assert len(set(paths)) == 2
+    # files moved out of the spool outlive the request
+    for p, content in zip(paths, ["foo", "bar"]):
+        assert p.startswith(directory)
+        assert os.path.basename(p) == "book.epub"
+        with open(p) as f:
+            assert f.read() == content
+    assert os.listdir(app.config["spool_path"]) == []
+
+
+@pytest.fixture()
+def store(tmp_path):
+    return UploadStore(str(tmp_path / "uploads"))
+
+
+def test_upload_store(store):
+    upload = store.create("big.cbz", 6)
+    assert upload["filename"] == "big.cbz"
+    assert upload["offset"] == 0
+
+    assert store.append(upload["id"], 0, io.BytesIO(b"foo"))["offset"] == 3
+    # a resent chunk only appends the bytes after the offset
+    assert store.append(upload["id"], 1, io.BytesIO(b"oob"))["offset"] == 4
+    assert store.append(upload["id"], 4, io.BytesIO(b"ar"))["offset"] == 6
+
+    with open(store.file_path(upload["id"]), "rb") as f:
+        assert f.read() == b"foobar"
+
+
+def test_upload_store_offset(store):
+    upload = store.create("big.cbz")
+    store.append(upload["id"], 0, io.BytesIO(b"foo"))
+
+    with pytest.raises(UploadOffsetError) as exc:
+        store.append(upload["id"], 4, io.BytesIO(b"bar"))
+    assert exc.value.offset == 3
+
+
+def test_upload_store_past_size(store):
+    upload = store.create("big.cbz", 4)
+
+    with pytest.raises(ValueError, match="past the upload size"):
+        store.append(upload["id"], 0, io.BytesIO(b"foobar"))
+    assert store.get(upload["id"])["offset"] == 4
+
+
+def test_upload_store_not_exist(store):
+    assert store.get("foo") is None
+    assert store.get("../uploads") is None
+    assert store.get("0" * 32) is None
+    with pytest.raises(KeyError):
+        store.append("0" * 32, 0, io.BytesIO(b"foo"))
+
+
+def test_upload_store_take(store, tmp_path):
+    upload = store.create("big.cbz")
+    store.append(upload["id"], 0, io.BytesIO(b"foo"))
+
+    filepath = store.take(upload["id"], str(tmp_path / "job"))
+    assert os.path.basename(filepath) == "big.cbz"
+    assert filepath.startswith(str(tmp_path / "job"))
+    assert store.get(upload["id"]) is None
+
+
+def test_upload_store_expire(store, monkeypatch):
+    old = store.create("old.cbz")
+    monkeypatch.setattr(store, "TTL", 60)
+    filepath = store.file_path(old["id"])
+    os.utime(filepath, (0, 0))
+
+    new = store.create("new.cbz")
+    assert store.get(old["id"]) is None
+    assert store.get(new["id"]) is not None
+
+
+def test_upload_store_chunk_length(store):
+    upload = store.create("big.cbz")
+
+    # a chunk longer than its range is cut at the end of the range
+    with pytest.raises(UploadOffsetError, match="does not match") as exc:
+        store.append(upload["id"], 0, io.BytesIO(b"foobar"), 3)
+    assert exc.value.offset == 3
+
+    # a chunk shorter than its range keeps the bytes that arrived
+    with pytest.raises(UploadOffsetError, match="does not match") as exc:
+        store.append(upload["id"], 3, io.BytesIO(b"ba"), 6)
+    assert exc.value.offset == 5
+
+    assert store.append(upload["id"], 5, io.BytesIO(b"r"), 6)["offset"] == 6
+    with open(store.file_path(upload["id"]), "rb") as f:
+        assert f.read() == b"foobar"
@@ -0,0 +1,156 @@
+import io
+import json
+import shlex
+import sys
+from os import path
+
+import pytest
+
+from calibre_rest.calibre import CalibreWrapper
+from calibre_rest.errors import CalibreRuntimeError
+from calibre_rest.worker import SCRIPT, CalibreWorker
+from calibre_rest.worker_script import Libraries, locked, serve
+
+# Stands in for calibredb's entry point in a worker run with the system Python
+FAKE_WORKER = f"""
+import os, sys
+sys.path.insert(0, {path.dirname(path.dirname(SCRIPT))!r})
+from calibre_rest.worker_script import Libraries, locked, serve
+
+def main(argv):
+    cmd, args = argv[1], argv[2:]
+    if cmd == "echo":
+        print(" ".join(args))
+    elif cmd == "list":
+        print('[{{"id": 1}}, {{"id": 2}}]')
+    elif cmd == "pid":
+        print(os.getpid())
+    elif cmd == "fail":
+        raise SystemExit("Error: foo")
+    elif cmd == "crash":
+        os._exit(3)
+
+serve(main, sys.stdin, sys.stdout)
+"""
+
+
+@pytest.fixture()
+def worker():
+    worker = CalibreWorker([sys.executable, "-c", FAKE_WORKER])
+    yield worker
+    worker.close()
+
+
+def fake_main(argv):
+    if argv[1] == "raise":
+        raise KeyError("foo")
+    print(argv[1:])
+    return 0
+
+
+def test_serve():
+    requests = io.StringIO('{"args": ["foo"]}\n\n{"args": ["raise"]}\n')
+    responses = io.StringIO()
+    serve(fake_main, requests, responses)
+
+    lines = [json.loads(line) for line in responses.getvalue().splitlines()]
+    assert lines[0] == {"ready": True}
+    assert lines[1] == {"returncode": 0, "stdout": "['foo']\n", "stderr": ""}
+    assert lines[2]["returncode"] == 1
+    assert "KeyError: 'foo'" in lines[2]["stderr"]
+
+
+def test_worker_run(worker):
+    assert worker.run(["echo", "foo", "bär"]) == (0, "foo bär\n", "")
+    assert worker.run(["fail"]) == (1, "", "Error: foo\n")
+
+
+def test_worker_persistent(worker):
+    _, pid, _ = worker.run(["pid"])
+    assert worker.run(["pid"])[1] == pid
+
+
+def test_worker_respawn(worker):
+    _, pid, _ = worker.run(["pid"])
+
+    returncode, _, stderr = worker.run(["crash"])
+    assert returncode == 3
+    assert "exited with status 3" in stderr
+
+    returncode, new_pid, _ = worker.run(["pid"])
+    assert returncode == 0
+    assert new_pid != pid
+
+
+def test_worker_not_found():
+    worker = CalibreWorker(["/foo/calibre-debug", "-e", SCRIPT])
+    with pytest.raises(FileNotFoundError):
+        worker.start()
+
+
+def test_worker_start_failed():
+    worker = CalibreWorker([sys.executable, "-c", "import sys; sys.exit(2)"])
+    with pytest.raises(RuntimeError, match="exited with status 2"):
+        worker.start()
+
+
+def test_wrapper_worker(worker):
+    wrapper = CalibreWrapper("foo", "bar", worker=True)
+    assert wrapper.worker.cmd[0] == path.join(
+        path.dirname(wrapper.cdb), "calibre-debug"
+    )
+    wrapper.worker = worker
+
+    assert wrapper._run("calibredb echo 'foo bar'") == ("foo bar\n", "")
+    assert list(wrapper._iter_json("calibredb list")) == [{"id": 1}, {"id": 2}]
+
+    with pytest.raises(CalibreRuntimeError, match="Error: foo"):
+        wrapper._run(f"{shlex.quote(wrapper.cdb)} fail")
+
+
+class FakeDatabase:
+    def __init__(self, library_path):
+        self.library_path = library_path
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_libraries_reopen(tmp_path):
+    (tmp_path / "metadata.db").write_bytes(b"foo")
+    libraries = Libraries(FakeDatabase)
+
+    db = libraries.get(str(tmp_path))
+    assert libraries.get(str(tmp_path)) is db
+
+    # written by another program
+    (tmp_path / "metadata.db").write_bytes(b"foobar")
+    new_db = libraries.get(str(tmp_path))
+    assert new_db is not db
+    assert db.closed
+
+    # written by the worker's own command
+    (tmp_path / "metadata.db").write_bytes(b"foobarbaz")
+    libraries.checkpoint()
+    assert libraries.get(str(tmp_path)) is new_db
+
+
+def test_locked():
+    held = []
+
+    def acquire():
+        if held:
+            return None
+        held.append(True)
+        return held.clear
+
+    libraries = Libraries(FakeDatabase)
+    main = locked(lambda argv: len(held), acquire, libraries)
+    assert main(["calibredb", "list"]) == 1
+    # released after each command
+    assert held == []
+
+    held.append(True)
+    with pytest.raises(SystemExit, match="Another calibre program"):
+        main(["calibredb", "list"])